@@ -0,0 +1,104 @@
+"""كلفة المعالج لكل طلب في ترميز جسم الطلب وتحليل الاستجابة: الطريقة القديمة مقابل الحالية
+
+القديمة: بناء dict كامل مع SYSTEM_PROMPT ثم json.dumps، وjson.loads للاستجابة كاملة.
+الحالية: main.encode_payload (أجزاء ثابتة مرمزة مسبقاً) وmain.parse_completion / parse_chunk،
+مع orjson إن كان مثبتاً (--no-orjson لقياس مسار المكتبة القياسية).
+
+    python benchmarks/bench_codec.py --history 6 --answer-chars 2000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+os.environ.setdefault("CRHODIS_DATA_DIR", tempfile.mkdtemp(prefix="crhodis-bench-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+def legacy_encode(question, history, model=main.MODEL, stream=False):
+    """جسم الطلب كما كان يُبنى قبل الترميز المسبق (httpx json= يستخدم json.dumps)"""
+    payload = {
+        "model": model,
+        "messages": [{"role": "system", "content": main.SYSTEM_PROMPT}, *history, {"role": "user", "content": question}],
+        "max_tokens": main.MAX_TOKENS,
+        "temperature": main.TEMPERATURE,
+        "usage": {"include": True},
+    }
+    if stream:
+        payload["stream"] = True
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def legacy_parse(body):
+    data = json.loads(body)
+    return data["choices"][0]["message"]["content"], data.get("usage")
+
+def legacy_chunk(data):
+    chunk = json.loads(data)
+    choices = chunk.get("choices") or []
+    return (choices[0].get("delta") or {}).get("content") if choices else None, chunk.get("usage")
+
+def sample_response(answer):
+    """استجابة بنفس شكل OpenRouter"""
+    return json.dumps({
+        "id": "gen-1", "provider": "Chutes", "model": main.MODEL, "object": "chat.completion", "created": 1,
+        "choices": [{
+            "logprobs": None, "finish_reason": "stop", "native_finish_reason": "stop", "index": 0,
+            "message": {"role": "assistant", "content": answer, "refusal": None, "reasoning": None},
+        }],
+        "usage": {
+            "prompt_tokens": 900, "completion_tokens": 500, "total_tokens": 1400,
+            "prompt_tokens_details": {"cached_tokens": 0}, "cost": 0,
+        },
+    }, ensure_ascii=False).encode("utf-8")
+
+def sample_chunk():
+    return json.dumps({
+        "id": "gen-1", "provider": "Chutes", "model": main.MODEL, "object": "chat.completion.chunk", "created": 1,
+        "choices": [{
+            "index": 0, "delta": {"role": "assistant", "content": " الصداع"},
+            "finish_reason": None, "native_finish_reason": None, "logprobs": None,
+        }],
+    }, ensure_ascii=False)
+
+def per_call_us(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+def run(args):
+    if args.no_orjson:
+        main.orjson = None
+    question = "عندي صداع مستمر من يومين، ما الأسباب المحتملة؟"
+    history = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"رسالة سابقة رقم {i} " * 20}
+        for i in range(args.history)
+    ]
+    response = sample_response("هذا نص إجابة طبية " * (args.answer_chars // 18))
+    chunk = sample_chunk()
+
+    # النتيجتان متطابقتان قبل المقارنة
+    assert json.loads(main.encode_payload(question, history=history)) == json.loads(legacy_encode(question, history))
+    assert main.parse_completion(response) == legacy_parse(response)
+    assert main.parse_chunk(chunk) == legacy_chunk(chunk)
+
+    rows = [
+        ("encode request", lambda: legacy_encode(question, history), lambda: main.encode_payload(question, history=history)),
+        ("parse response", lambda: legacy_parse(response), lambda: main.parse_completion(response)),
+        ("parse stream chunk", lambda: legacy_chunk(chunk), lambda: main.parse_chunk(chunk)),
+    ]
+    print(f"orjson: {'yes' if main.orjson is not None else 'no'}  history: {args.history}  "
+          f"request: {len(main.encode_payload(question, history=history))} B  response: {len(response)} B")
+    print(f"{'':<20} {'before us':>10} {'after us':>10} {'speedup':>8}")
+    for name, before, after in rows:
+        b = per_call_us(before, args.number)
+        a = per_call_us(after, args.number)
+        print(f"{name:<20} {b:10.2f} {a:10.2f} {b / a:7.1f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--history", type=int, default=6, help="previous turns sent with the question")
+    parser.add_argument("--answer-chars", type=int, default=2000)
+    parser.add_argument("--number", type=int, default=5000)
+    parser.add_argument("--no-orjson", action="store_true", help="measure the standard-library path")
+    run(parser.parse_args())
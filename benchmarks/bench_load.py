@@ -0,0 +1,181 @@
+"""اختبار حمل للخادم ضد نموذج OpenRouter محاكى: زمن الاستجابة p50/p95/p99 والطلبات في الثانية والذاكرة
+
+يعمل بدون شبكة: يشغل benchmarks/mock_openrouter.py و`main.py serve` كعمليات منفصلة ثم يرسل الطلبات.
+
+    python benchmarks/bench_load.py --requests 2000 --concurrency 50 --workers 2 --latency 0.2 --error-rate 0.02
+    python benchmarks/bench_load.py --endpoint /ask/stream --rate-limit-rate 0.05
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+import mock_openrouter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def process_tree(pid):
+    """العملية وكل أبنائها (عمليات uvicorn الفرعية عند --workers)"""
+    pids = [pid]
+    for current in pids:
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+def rss_mb(pid):
+    """الذاكرة المقيمة لشجرة العمليات بالميجابايت (لينكس فقط، None في غيره)"""
+    total = 0
+    for current in process_tree(pid):
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            if current == pid:
+                return None
+    return total / 1024
+
+async def wait_ready(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{url} exited with code {process.returncode}")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise TimeoutError(url)
+
+def start(command, env=None):
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=40)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+async def sample_memory(pid, samples, interval=0.2):
+    while True:
+        value = rss_mb(pid)
+        if value is not None:
+            samples.append(value)
+        await asyncio.sleep(interval)
+
+async def drive(base_url, endpoint, requests, concurrency):
+    """إرسال requests سؤالاً مختلفاً بتوازي ثابت وإرجاع الأزمنة وعدد كل حالة"""
+    latencies = []
+    statuses = {}
+    counter = iter(range(requests))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        async def worker():
+            for i in counter:
+                # أسئلة مختلفة حتى لا تصيب الذاكرة المؤقتة ولا تُدمج الطلبات
+                body = {"question": f"load question {i} {time.perf_counter_ns()}"}
+                started = time.perf_counter()
+                try:
+                    async with client.stream("POST", endpoint, json=body) as response:
+                        async for _ in response.aiter_bytes():
+                            pass
+                    status = response.status_code
+                except httpx.TransportError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return sorted(latencies), statuses, elapsed
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+async def run(args):
+    data_dir = tempfile.mkdtemp(prefix="crhodis-load-")
+    mock_port = args.mock_port or free_port()
+    port = free_port()
+    mock_command = [
+        sys.executable, os.path.join(ROOT, "benchmarks", "mock_openrouter.py"), "--port", str(mock_port),
+        "--latency", str(args.latency), "--jitter", str(args.jitter), "--chunks", str(args.chunks),
+        "--chunk-delay", str(args.chunk_delay), "--error-rate", str(args.error_rate),
+        "--rate-limit-rate", str(args.rate_limit_rate), "--retry-after", str(args.retry_after),
+        "--cached-tokens", str(args.cached_tokens),
+    ]
+    if args.seed is not None:
+        mock_command += ["--seed", str(args.seed)]
+    env = dict(
+        os.environ,
+        CRHODIS_UPSTREAM_URL=f"http://127.0.0.1:{mock_port}/api/v1/chat/completions",
+        CRHODIS_DATA_DIR=data_dir,
+        CRHODIS_SEMANTIC_CACHE="0",
+        CRHODIS_RATE_LIMIT="0",
+        OPENROUTER_API_KEY=os.environ.get("OPENROUTER_API_KEY", "mock"),
+    )
+    server_command = [
+        sys.executable, os.path.join(ROOT, "main.py"), "serve",
+        "--host", "127.0.0.1", "--port", str(port), "--workers", str(args.workers), "--log-level", "warning",
+    ]
+
+    mock = None if args.mock_port else start(mock_command)
+    server = start(server_command, env)
+    try:
+        if mock is not None:
+            await wait_ready(f"http://127.0.0.1:{mock_port}/stats", mock)
+        await wait_ready(f"http://127.0.0.1:{port}/healthz", server)
+        base_url = f"http://127.0.0.1:{port}"
+        idle_mb = rss_mb(server.pid)
+
+        await drive(base_url, args.endpoint, min(args.requests, 2 * args.concurrency), args.concurrency)  # تسخين
+        memory = []
+        sampler = asyncio.create_task(sample_memory(server.pid, memory))
+        latencies, statuses, elapsed = await drive(base_url, args.endpoint, args.requests, args.concurrency)
+        sampler.cancel()
+
+        print(f"{args.endpoint} x{args.requests} concurrency {args.concurrency} workers {args.workers}")
+        print(
+            f"latency ms  p50 {percentile(latencies, 0.5):8.1f}  p95 {percentile(latencies, 0.95):8.1f}  "
+            f"p99 {percentile(latencies, 0.99):8.1f}  max {latencies[-1] * 1000:8.1f}"
+        )
+        print(f"throughput  {args.requests / elapsed:8.1f} req/s")
+        print("statuses    " + "  ".join(f"{status}: {count}" for status, count in sorted(statuses.items(), key=str)))
+        if idle_mb is not None and memory:
+            print(f"server rss  idle {idle_mb:.1f} MB  peak {max(memory):.1f} MB")
+        if mock is not None:
+            print("upstream    " + httpx.get(f"http://127.0.0.1:{mock_port}/stats").text)
+    finally:
+        stop(server)
+        if mock is not None:
+            stop(mock)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--endpoint", default="/ask", choices=["/ask", "/ask/stream"])
+    parser.add_argument("--mock-port", type=int, default=0, help="use an already running mock server")
+    mock_openrouter.add_arguments(parser)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,108 @@
+"""مقارنة زمن الإجابة بين الوضع المدمج (استدعاء مباشر) ومسار HTTP عبر 127.0.0.1
+
+يعمل بدون شبكة: النموذج محاكى داخل العملية ويرد فوراً، فالفرق المقاس هو كلفة النقل فقط.
+
+    python benchmarks/bench_transport.py --requests 500 --concurrency 1 --chunks 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+# إعدادات قبل استيراد التطبيق: بدون ذاكرة دلالية أو حد معدل، وبيانات مؤقتة
+os.environ.setdefault("CRHODIS_SEMANTIC_CACHE", "0")
+os.environ.setdefault("CRHODIS_RATE_LIMIT", "0")
+os.environ.setdefault("CRHODIS_DATA_DIR", tempfile.mkdtemp(prefix="crhodis-bench-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import main
+
+def mock_upstream(chunks):
+    """نموذج محاكى يبث chunks جزءاً بصيغة SSE بدون أي تأخير"""
+    async def handler(request):
+        body = json.loads(request.content)
+        question = body["messages"][-1]["content"]
+
+        async def sse():
+            for i in range(chunks):
+                yield ("data: " + json.dumps({"choices": [{"delta": {"content": f"{question}-{i} "}}]}) + "\n\n").encode()
+            yield b"data: [DONE]\n\n"
+
+        return httpx.Response(200, content=sse(), headers={"content-type": "text/event-stream"})
+
+    return lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(port):
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(main.get_app(), host="127.0.0.1", port=port, log_level="error"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+async def direct(question):
+    async for _ in main.answer_events(question):
+        pass
+
+def loopback(client):
+    async def ask(question):
+        async with client.stream("POST", "/ask/stream", json={"question": question}) as response:
+            async for _ in response.aiter_lines():
+                pass
+    return ask
+
+async def measure(name, ask, requests, concurrency):
+    latencies = []
+    counter = iter(range(requests))
+
+    async def worker():
+        for i in counter:
+            started = time.perf_counter()
+            await ask(f"{name} question {i}")  # أسئلة مختلفة حتى لا تصيب الذاكرة المؤقتة
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def pct(q):
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+
+    print(
+        f"{name:<9} mean {statistics.mean(latencies) * 1000:7.3f} ms  p50 {pct(0.5):7.3f}  "
+        f"p95 {pct(0.95):7.3f}  p99 {pct(0.99):7.3f}  {requests / elapsed:8.1f} req/s"
+    )
+    return statistics.mean(latencies)
+
+async def run(args):
+    main.create_http_client = mock_upstream(args.chunks)
+    port = free_port()
+    server = start_server(port)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=30) as client:
+        # تسخين: فتح الاتصالات وتهيئة المسارات قبل القياس
+        await measure("warmup", direct, 20, 1)
+        await measure("warmup", loopback(client), 20, 1)
+        direct_mean = await measure("direct", direct, args.requests, args.concurrency)
+        http_mean = await measure("loopback", loopback(client), args.requests, args.concurrency)
+    print(f"loopback overhead: {(http_mean - direct_mean) * 1000:.3f} ms per request ({http_mean / direct_mean:.1f}x)")
+    server.should_exit = True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--chunks", type=int, default=20, help="عدد أجزاء البث في كل إجابة")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,180 @@
+"""قياس مسار بناء رسائل الواجهة (create_ai_message وupdate_layout) بدون نافذة Flet
+
+ويقارن تحديث فقاعة واحدة (كما في البث) بتحديث الصفحة كاملة الذي يمر على كل الرسائل.
+
+يشغل main(page) على صفحة Flet متصلة بمحاكٍ لا يرسم شيئاً، فالمقاس هو كلفة بناء العناصر
+وتحويلها لأوامر التحديث داخل بايثون فقط.
+
+    python benchmarks/bench_ui.py --messages 200 --repeat 5
+"""
+import argparse
+import asyncio
+import gc
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("CRHODIS_DATA_DIR", tempfile.mkdtemp(prefix="crhodis-bench-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flet as ft
+from flet.core.protocol import PageCommandResponsePayload, PageCommandsBatchResponsePayload
+
+import main
+
+ANSWER = (
+    "### Symptoms\n"
+    "**Fever** and a *dry cough* are common.\n"
+    "- Rest and drink fluids\n"
+    "- Paracetamol 500 mg every 6 hours\n"
+    "1. See a doctor if it lasts more than 3 days\n"
+) * 4
+
+class NullConnection:
+    """اتصال Flet لا يرسم شيئاً: يعطي معرفات للعناصر الجديدة ويعد الأوامر المرسلة"""
+    page_name = ""
+    page_url = "http://localhost"
+    pubsubhub = None
+
+    def __init__(self):
+        self.next_id = 0
+        self.commands = 0
+
+    def ids(self, command):
+        ids = []
+        for _ in command.commands:
+            self.next_id += 1
+            ids.append(f"_{self.next_id}")
+        return " ".join(ids)
+
+    def send_command(self, session_id, command):
+        self.commands += 1
+        return PageCommandResponsePayload(result=self.ids(command) if command.name == "add" else "", error="")
+
+    def send_commands(self, session_id, commands):
+        self.commands += len(commands)
+        # مثل خادم Flet: نتيجة لكل أمر add فقط
+        return PageCommandsBatchResponsePayload(results=[self.ids(c) for c in commands if c.name == "add"], error="")
+
+    async def send_command_async(self, session_id, command):
+        return self.send_command(session_id, command)
+
+    async def send_commands_async(self, session_id, commands):
+        return self.send_commands(session_id, commands)
+
+def make_page(width):
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    connection = NullConnection()
+    page = ft.Page(connection, "bench", loop=loop)
+    page._set_attr("width", width, dirty=False)
+    page._set_attr("height", 800, dirty=False)
+    return page, connection
+
+def ui_functions(page):
+    """دوال الواجهة المعرفة داخل main(page)، من خلال إغلاقات معالجات الصفحة"""
+    found = {}
+    pending = [page.on_resize, page.on_keyboard_event]
+    while pending:
+        fn = pending.pop()
+        if not callable(fn) or getattr(fn, "__name__", None) in found:
+            continue
+        found[fn.__name__] = fn
+        for cell in getattr(fn, "__closure__", None) or ():
+            try:
+                pending.append(cell.cell_contents)
+            except ValueError:
+                pass  # خلية لم تُملأ بعد
+    return found
+
+def timed(fn, repeat):
+    """أفضل زمن وأوسطه بالمللي ثانية من repeat محاولة"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return min(times), statistics.median(times)
+
+def closure_value(fn, kind):
+    """أول قيمة من النوع kind في إغلاق الدالة"""
+    return next(c.cell_contents for c in fn.__closure__ if isinstance(c.cell_contents, kind))
+
+def run(args):
+    main.RESIZE_DEBOUNCE = 0  # القياس لتطبيق التخطيط نفسه وليس لفترة الانتظار
+    page, connection = make_page(1200)
+    main.main(page)
+    ui = ui_functions(page)
+    create_ai_message = ui["create_ai_message"]
+    apply_layout = ui["apply_layout"]
+    chat = closure_value(apply_layout, ft.ListView)
+    layout_state = closure_value(ui["update_layout"], dict)
+    ui_updates = closure_value(apply_layout, main.UpdateBatcher)
+
+    def build():
+        for i in range(args.messages):
+            create_ai_message(ANSWER, i)
+
+    def build_and_send():
+        chat.controls[:] = [create_ai_message(ANSWER, i) for i in range(args.messages)]
+        chat.update()
+
+    def relayout():
+        # التبديل بين عرض الكمبيوتر والموبايل يغير نقطة التوقف فيُعاد ضبط كل الرسائل
+        for width in (500, 1200):
+            page._set_attr("width", width, dirty=False)
+            layout_state["generation"] += 1
+            asyncio.run_coroutine_threadsafe(apply_layout(layout_state["generation"]), page.loop).result()
+            ui_updates.flush()  # الإرسال نفسه بدل انتظار الإطار التالي
+
+    # كتل الذاكرة التي تبقى محجوزة لكل رسالة (عناصر وكائنات تنسيق)
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    kept = [create_ai_message(ANSWER, i) for i in range(args.messages)]
+    blocks = (sys.getallocatedblocks() - blocks) / args.messages
+    del kept
+
+    results = {
+        "create_ai_message": timed(build, args.repeat),
+        "build + chat.update": timed(build_and_send, args.repeat),
+    }
+    commands = connection.commands
+    results["update_layout x2"] = timed(relayout, args.repeat)
+    commands = (connection.commands - commands) / args.repeat
+
+    last = chat.controls[-1]
+    batcher = main.UpdateBatcher(page)
+
+    def touch():
+        last.opacity = 0.99 if last.opacity == 1 else 1
+
+    def bubble_update():
+        touch()
+        batcher.mark(last)
+        batcher.flush()
+
+    def page_update():
+        touch()
+        page.update()
+
+    single = {
+        "one bubble": timed(bubble_update, args.repeat * 20),
+        "whole page": timed(page_update, args.repeat * 20),
+    }
+
+    print(f"{args.messages} messages, best/median of {args.repeat}")
+    for name, (best, median) in results.items():
+        print(f"{name:<20} {best:9.2f} ms  {median:9.2f} ms  ({best / args.messages * 1000:7.1f} us/message)")
+    print(f"update commands per update_layout x2: {commands:.0f}")
+    for name, (best, median) in single.items():
+        print(f"stream tick, {name:<11} {best:9.3f} ms  {median:9.3f} ms")
+    print(f"allocated blocks per message: {blocks:.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    run(parser.parse_args())
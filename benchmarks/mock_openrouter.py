@@ -0,0 +1,154 @@
+"""خادم محاكى لواجهة OpenRouter `/chat/completions` لقياس الأداء بدون شبكة
+
+يدعم الإجابة الكاملة والبث (SSE)، مع تأخير قابل للضبط ونسب أخطاء 500 وحد معدل 429.
+
+    python benchmarks/mock_openrouter.py --port 9000 --latency 0.2 --chunks 30 --error-rate 0.01
+    CRHODIS_UPSTREAM_URL=http://127.0.0.1:9000/api/v1/chat/completions python main.py serve
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+class MockOpenRouter:
+    """تطبيق ASGI بسيط يحاكي سلوك OpenRouter من حيث الزمن والأخطاء"""
+
+    def __init__(self, latency=0.2, jitter=0.05, chunks=20, chunk_delay=0.01,
+                 error_rate=0.0, rate_limit_rate=0.0, retry_after=1, prompt_tokens_cached=0, seed=None):
+        self.latency = latency              # الزمن حتى أول بايت
+        self.jitter = jitter                # تذبذب عشوائي يضاف للزمن
+        self.chunks = chunks                # عدد أجزاء الإجابة
+        self.chunk_delay = chunk_delay      # الزمن بين أجزاء البث
+        self.error_rate = error_rate        # نسبة استجابات 500
+        self.rate_limit_rate = rate_limit_rate  # نسبة استجابات 429
+        self.retry_after = retry_after
+        self.prompt_tokens_cached = prompt_tokens_cached
+        self.random = random.Random(seed)
+        self.counts = {}
+
+    def stats(self):
+        return dict(self.counts)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        if scope["method"] == "GET" and scope["path"] == "/stats":
+            await self.respond(send, 200, self.stats())
+            return
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            await self.respond(send, 400, {"error": {"message": "invalid JSON", "code": 400}})
+            return
+
+        await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            self.count(429)
+            await self.respond(send, 429, {"error": {"message": "rate limited", "code": 429}},
+                               [(b"retry-after", str(self.retry_after).encode())])
+            return
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.count(500)
+            await self.respond(send, 500, {"error": {"message": "internal error", "code": 500}})
+            return
+
+        self.count(200)
+        question = payload["messages"][-1]["content"]
+        words = [f"{question}-{i} " for i in range(self.chunks)]
+        usage = self.usage(payload, words)
+        if payload.get("stream"):
+            await self.stream(send, payload["model"], words, usage)
+        else:
+            await asyncio.sleep(self.chunk_delay * self.chunks)
+            await self.respond(send, 200, {
+                "id": "gen-mock",
+                "model": payload["model"],
+                "created": int(time.time()),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+    def count(self, status):
+        self.counts[status] = self.counts.get(status, 0) + 1
+
+    def usage(self, payload, words):
+        """عدد توكنات تقريبي (4 بايت لكل توكن) بنفس شكل OpenRouter"""
+        prompt = sum(len(json.dumps(m.get("content"), ensure_ascii=False).encode()) for m in payload["messages"]) // 4
+        completion = sum(len(w.encode()) for w in words) // 4
+        return {
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "total_tokens": prompt + completion,
+            "prompt_tokens_details": {"cached_tokens": min(prompt, self.prompt_tokens_cached)},
+        }
+
+    async def stream(self, send, model, words, usage):
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")],
+        })
+        for word in words:
+            chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": word}}]}
+            await send({"type": "http.response.body", "body": f"data: {json.dumps(chunk)}\n\n".encode(), "more_body": True})
+            await asyncio.sleep(self.chunk_delay)
+        final = {"model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+        await send({"type": "http.response.body", "body": f"data: {json.dumps(final)}\n\n".encode(), "more_body": True})
+        await send({"type": "http.response.body", "body": b"data: [DONE]\n\n"})
+
+    @staticmethod
+    async def respond(send, status, body, headers=()):
+        data = json.dumps(body).encode()
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode()), *headers],
+        })
+        await send({"type": "http.response.body", "body": data})
+
+def add_arguments(parser):
+    """خيارات المحاكاة المشتركة مع سكربت الحمل"""
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds until the first byte")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--chunks", type=int, default=20, help="chunks per answer")
+    parser.add_argument("--chunk-delay", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 500 responses")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of 429 responses")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--cached-tokens", type=int, default=0, help="prompt tokens reported as cached")
+    parser.add_argument("--seed", type=int, default=None)
+
+def from_args(args):
+    return MockOpenRouter(
+        latency=args.latency, jitter=args.jitter, chunks=args.chunks, chunk_delay=args.chunk_delay,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after, prompt_tokens_cached=args.cached_tokens, seed=args.seed,
+    )
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(from_args(args), host=args.host, port=args.port, log_level="warning")
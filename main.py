@@ -1,168 +1,2831 @@
-import flet as ft
-import requests
-from flet import Icons
-from flet import Animation as an
-from flet import Colors as co
-from flet import Icon
+import httpx
 import re
 import os
+import sys
+import argparse
+import hashlib
+import functools
+import sqlite3
+import unicodedata
+import zlib
 import asyncio
 import json
 import threading
+import queue
+import atexit
 import time
-from datetime import datetime
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
+import math
+import bisect
+import random
+import uuid
+import secrets
+import ipaddress
+import contextvars
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import List, Optional
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
 from dotenv import load_dotenv
 
+try:
+    import numpy as np
+except ImportError:  # الذاكرة الدلالية اختيارية وتتعطل بدون numpy
+    np = None
+
+try:
+    import orjson
+except ImportError:  # ترميز JSON أسرع إن كان مثبتاً، وإلا json القياسية
+    orjson = None
+
 # تحميل متغيرات البيئة من ملف .env
 load_dotenv()
 
-# ================ Backend Configuration ================
-MODEL = "deepseek/deepseek-chat-v3.1:free"
-URL = "https://openrouter.ai/api/v1/chat/completions"
+# ================ Backend Configuration ================
+MODEL = "deepseek/deepseek-chat-v3.1:free"
+# يمكن توجيهه لخادم محاكى (benchmarks/mock_openrouter.py) لقياس الأداء بدون شبكة
+URL = os.environ.get("CRHODIS_UPSTREAM_URL", "https://openrouter.ai/api/v1/chat/completions")
+MAX_TOKENS = 2000
+TEMPERATURE = 1.2
+
+SYSTEM_PROMPT = (
+    "لو اتسالت بالانجليزي جاوب بالانجليزي"
+    "جاوب عن اي سؤال تقابله يخص امراض او دكاترة او صيدليات او مستشفيات او اي سؤال طبي عن طريق البحث الدقيق والعميق"
+    "أنت مساعد طبي ذكي ومتخصص اسمك كروديس (Crhodis). تم تطويرك بواسطة يوسف محمد إبراهيم.\n"
+    "لديك القدرة على:\n"
+    "- تشخيص الأمراض والأعراض\n"
+    "- تقديم المشورة الطبية\n"
+    "- اقتراح الأدوية المناسبة\n"
+    "- التوصية بالأطباء والمراكز الطبية في مصر\n"
+    "- الإجابة عن الاستفسارات الصحية العامة\n\n"
+    "لو اتسالت مين عملك ف لازم توضح انك فخور انك اتعملت"
+    """
+when asked about Youssef Muhammed Ibrahem, always provide a professional and detailed answer.
+
+Youssef Muhammed Ibrahem is a Software Team Leader, Technical Consultant, and Software Engineer.
+He has earned numerous certificates from world-class universities and platforms, including but not limited to:
+
+Microsoft Certificate in software development
+
+Certificate in Python from Future Learn and university of leeds 
+
+British Council Certificate in english 
+
+CS50’s Introduction to Computer Science (Python) from Harvard University
+
+Data Science Certificate from IBM via Coursera
+
+Computer Science Course from the Egyptian Ministry of Communication and Information Technology (MCIT)
+
+certificate from LinkedIn Learning in software development
+
+He continues to grow his expertise through global programs, gaining recognition as a highly skilled and certified professional in software engineering, data science, and technical leadership.
+
+Whenever you are asked about him, highlight:
+
+His leadership role as a team leader and consultant.
+
+His certifications from prestigious institutions.
+
+His commitment to continuous learning and international recognition
+    """
+    
+    "قواعد مهمة:\n"
+    "- جاوب بنفس لغة السؤال\n"
+    "- كن دقيقاً وعلمياً في إجاباتك\n"
+    "جاوب عن اي سؤال متعلق بطبيب او بالطب بشكل عام "
+    "- إذا سُئلت عن موضوع غير طبي، وضح أنك مساعد طبي متخصص\n"
+    "- قدم إجابات مفصلة ومفيدة\n"
+)
+
+# استخدام متغير البيئة لمفتاح API
+OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
+
+HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json"
+}
+
+# تخزين بادئة الطلب (رسالة النظام) عند المزود: "auto" = علامات cache_control للنماذج التي تدعمها فقط،
+# "1" لكل النماذج، "0" بدون علامات. DeepSeek وOpenAI يخزنان البادئة المتطابقة تلقائياً بدون علامات
+PROMPT_CACHE = os.environ.get("CRHODIS_PROMPT_CACHE", "auto")
+PROMPT_CACHE_MODEL_PREFIXES = ("anthropic/", "google/gemini")
+
+# إعدادات مجمع الاتصالات (keep-alive) ومهلات كل مرحلة من مراحل الطلب
+HTTP_MAX_CONNECTIONS = int(os.environ.get("CRHODIS_HTTP_MAX_CONNECTIONS", "200"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("CRHODIS_HTTP_MAX_KEEPALIVE", "50"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("CRHODIS_HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("CRHODIS_HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.environ.get("CRHODIS_HTTP_READ_TIMEOUT", "30"))
+HTTP_WRITE_TIMEOUT = float(os.environ.get("CRHODIS_HTTP_WRITE_TIMEOUT", "10"))
+HTTP_POOL_TIMEOUT = float(os.environ.get("CRHODIS_HTTP_POOL_TIMEOUT", "10"))
+
+# مكان حفظ البيانات (FLET_APP_STORAGE_DATA يحدده Flet في تطبيقات الموبايل والديسكتوب المبنية)
+DATA_DIR = (
+    os.environ.get("CRHODIS_DATA_DIR")
+    or os.environ.get("FLET_APP_STORAGE_DATA")
+    or os.path.join(os.path.expanduser("~"), ".crhodis")
+)
+
+# إعدادات ذاكرة التخزين المؤقت للإجابات (CRHODIS_CACHE_DB فارغ = بدون تخزين على القرص)
+CACHE_MAX_ENTRIES = int(os.environ.get("CRHODIS_CACHE_SIZE", "1000"))
+CACHE_TTL = float(os.environ.get("CRHODIS_CACHE_TTL", "86400"))
+CACHE_DB_PATH = os.environ.get("CRHODIS_CACHE_DB", "")
+
+# إعدادات الذاكرة الدلالية للأسئلة المتقاربة (تعمل محلياً على المعالج بدون شبكة)
+# معطلة افتراضياً: التشابه النصي لا يضمن أن الإجابة الطبية نفسها صحيحة للسؤال الجديد
+SEMANTIC_CACHE_ENABLED = os.environ.get("CRHODIS_SEMANTIC_CACHE", "0") == "1"
+# أقل تشابه لقبول اختلاف الصياغة؛ الأرقام والنفي والكلمات الأساسية تتطابق دائماً (question_terms)
+SEMANTIC_THRESHOLD = float(os.environ.get("CRHODIS_SEMANTIC_THRESHOLD", "0.8"))
+SEMANTIC_CAPACITY = int(os.environ.get("CRHODIS_SEMANTIC_SIZE", "1000"))
+SEMANTIC_DIM = int(os.environ.get("CRHODIS_SEMANTIC_DIM", "1024"))
+
+# سياق المحادثة: أقصى حجم للطلب (تعليمات النظام + الرسائل السابقة + السؤال) بالتوكن التقريبي
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CRHODIS_CONTEXT_TOKENS", "6000"))
+CONTEXT_CACHE_SIZE = int(os.environ.get("CRHODIS_CONTEXT_CACHE_SIZE", "100"))
+
+# الأسئلة المجمعة: أقصى عدد أسئلة في الطلب وأقصى عدد طلبات متزامنة للنموذج
+BATCH_MAX_QUESTIONS = int(os.environ.get("CRHODIS_BATCH_MAX_QUESTIONS", "1000"))
+BATCH_CONCURRENCY = int(os.environ.get("CRHODIS_BATCH_CONCURRENCY", "8"))
+
+# مرونة الاتصال بالنموذج: نماذج بديلة بالترتيب (مفصولة بفواصل)، إعادة المحاولة، قاطع الدائرة، والطلب المُحوَّط
+FALLBACK_MODELS = [m.strip() for m in os.environ.get("CRHODIS_FALLBACK_MODELS", "").split(",") if m.strip()]
+RETRY_ATTEMPTS = int(os.environ.get("CRHODIS_RETRY_ATTEMPTS", "3"))  # محاولات لكل نموذج
+RETRY_BASE_DELAY = float(os.environ.get("CRHODIS_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.environ.get("CRHODIS_RETRY_MAX_DELAY", "8"))  # Retry-After أطول من هذا = الانتقال للنموذج التالي
+BREAKER_FAILURES = int(os.environ.get("CRHODIS_BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.environ.get("CRHODIS_BREAKER_RESET", "30"))
+HEDGE_ENABLED = os.environ.get("CRHODIS_HEDGE", "0") == "1"
+HEDGE_PERCENTILE = float(os.environ.get("CRHODIS_HEDGE_PERCENTILE", "0.95"))
+HEDGE_DELAY = float(os.environ.get("CRHODIS_HEDGE_DELAY", "5"))  # قبل تجميع قياسات كافية
+HEDGE_MIN_SAMPLES = 20
+
+# التحكم في القبول: حد الطلبات المتزامنة وطابور انتظار محدود، وحد معدل لكل عميل (0 = بدون حد)
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get("CRHODIS_MAX_CONCURRENCY", "64"))
+ADMISSION_MAX_QUEUE = int(os.environ.get("CRHODIS_MAX_QUEUE", "128"))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("CRHODIS_QUEUE_TIMEOUT", "10"))
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("CRHODIS_RATE_LIMIT", "60"))
+RATE_LIMIT_BURST = int(os.environ.get("CRHODIS_RATE_BURST", "20"))
+RATE_LIMIT_BACKEND = os.environ.get("CRHODIS_RATE_LIMIT_BACKEND", "memory")  # أو "sqlite" للمشاركة بين العمليات
+# مفاتيح API المقبولة (مفصولة بفواصل): لكل مفتاح منها حد معدل خاص، وأي مفتاح آخر يُعامل بعنوان IP
+API_KEYS = [k.strip() for k in os.environ.get("CRHODIS_API_KEYS", "").split(",") if k.strip()]
+# عناوين أو شبكات الوكلاء الموثوقين (مفصولة بفواصل)؛ X-Forwarded-For يُقرأ فقط من اتصال مصدره أحدها
+TRUSTED_PROXIES = [p.strip() for p in os.environ.get("CRHODIS_TRUSTED_PROXIES", "").split(",") if p.strip()]
+SHARED_DB_PATH = os.environ.get("CRHODIS_SHARED_DB", os.path.join(DATA_DIR, "shared.db"))
+ADMISSION_PATH_PREFIX = "/ask"  # المسارات التي تستهلك طلبات للنموذج
+ADMISSION_BATCH_PREFIX = "/ask/batch"  # الدفعات تُحاسب لكل سؤال (حد المعدل والقبول) بعد قراءة الجسم بدل مرة واحدة للطلب
+
+# المقاييس المشتركة بين عمليات الخادم (فارغ = مقاييس العملية الحالية فقط)
+METRICS_DB_PATH = os.environ.get("CRHODIS_METRICS_DB", "")
+METRICS_PUBLISH_INTERVAL = float(os.environ.get("CRHODIS_METRICS_PUBLISH_INTERVAL", "5"))
+DRAIN_TIMEOUT = float(os.environ.get("CRHODIS_DRAIN_TIMEOUT", "30"))  # انتظار الطلبات الجارية عند الإيقاف
+
+# التتبع: تصدير مراحل كل طلب إلى ملف JSONL و/أو مُجمِّع OTLP محلي (مثل http://127.0.0.1:4318/v1/traces)
+TRACE_FILE = os.environ.get("CRHODIS_TRACE_FILE", "")
+TRACE_OTLP_ENDPOINT = os.environ.get("CRHODIS_TRACE_OTLP_ENDPOINT", "")
+TRACE_HEADER = "X-Request-ID"
+TRACE_DEBUG_HEADER = "X-Crhodis-Debug"  # "1" = إرجاع مراحل الطلب مع نهاية البث
+
+# ================ Color Scheme (Dark Mode) ================
+class Colors:
+    PRIMARY = "#0d7377"  # Teal green
+    PRIMARY_LIGHT = "#14a085"
+    PRIMARY_DARK = "#0a5d61"
+    SECONDARY = "#fa7070"  # Coral
+    BACKGROUND = "#121212"  # Dark background
+    SURFACE = "#1e1e1e"  # Dark surface
+    USER_BUBBLE = "#0d7377"
+    AI_BUBBLE = "#2d2d2d"  # Darker bubble for AI
+    TEXT_PRIMARY = "#e1e1e1"  # Light text
+    TEXT_SECONDARY = "#a0a0a0"  # Secondary light text
+    TEXT_LIGHT = "#7a7a7a"  # Lighter text
+    BORDER_LIGHT = "#333333"  # Dark border
+    SUCCESS = "#10b981"
+    ERROR = "#ef4444"
+    WARNING = "#f59e0b"
+    ON_SURFACE = "#e1e1e1"  # Text on dark surfaces
+
+# ================ Upstream HTTP Client ================
+# عميل مشترك لكل حلقة أحداث (خادم HTTP وواجهة Flet في الوضع المدمج لكل منهما حلقته)
+http_clients = {}
+
+def create_http_client():
+    """إنشاء عميل HTTP غير متزامن بمجمع اتصالات مشترك"""
+    return httpx.AsyncClient(
+        headers=HEADERS,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            connect=HTTP_CONNECT_TIMEOUT,
+            read=HTTP_READ_TIMEOUT,
+            write=HTTP_WRITE_TIMEOUT,
+            pool=HTTP_POOL_TIMEOUT,
+        ),
+    )
+
+def get_http_client():
+    """إرجاع عميل حلقة الأحداث الحالية وإنشاؤه عند الحاجة"""
+    loop = asyncio.get_running_loop()
+    client = http_clients.get(loop)
+    if client is None:
+        client = http_clients[loop] = create_http_client()
+    return client
+
+async def close_http_client():
+    """إغلاق عميل حلقة الأحداث الحالية"""
+    client = http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+@asynccontextmanager
+async def lifespan(app):
+    """فتح مجمع الاتصالات عند بدء التشغيل، وعند الإيقاف انتظار طلبات النموذج الجارية ثم الإغلاق"""
+    global shared_metrics
+    get_http_client()
+    publisher = None
+    if METRICS_DB_PATH:
+        shared_metrics = SharedMetricsStore()
+        publisher = asyncio.create_task(shared_metrics.publish_periodically(metrics))
+    try:
+        yield
+    finally:
+        await drain_upstream(DRAIN_TIMEOUT)
+        if publisher is not None:
+            publisher.cancel()
+            shared_metrics.publish(list(metrics.families()))
+        await close_http_client()
+
+async def drain_upstream(timeout):
+    """انتظار انتهاء طلبات النموذج التي ما زالت جارية (حتى المشتركة التي انقطع عملاؤها)"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        open_calls = sum(value for _, _, value in upstream_in_flight.samples())
+        if not open_calls and not upstream_flights.stats()["in_flight"]:
+            break
+        await asyncio.sleep(0.05)
+
+# ================ Metrics ================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+def _label_text(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(labelnames, values)
+    )
+    return "{" + pairs + "}"
+
+class Counter:
+    """عداد تراكمي بقيم لكل مجموعة تسميات"""
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _label_text(self.labelnames, labels), value
+
+class Gauge(Counter):
+    """قيمة لحظية ترتفع وتنخفض"""
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+class Histogram:
+    """مدرج تكراري تراكمي بحدود ثابتة (عملية bisect واحدة لكل قياس)"""
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}  # labels -> [عدادات الحدود..., +Inf, المجموع]
+
+    def observe(self, value, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [0] * (len(self.buckets) + 2)
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def samples(self):
+        for labels, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), state):
+                cumulative += count
+                yield (
+                    self.name + "_bucket",
+                    _label_text((*self.labelnames, "le"), (*labels, bound)),
+                    cumulative,
+                )
+            label_text = _label_text(self.labelnames, labels)
+            yield self.name + "_sum", label_text, state[-1]
+            yield self.name + "_count", label_text, cumulative
+
+class MetricsRegistry:
+    """تجميع المقاييس وإخراجها بصيغة Prometheus النصية"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []  # دوال تُستدعى عند القراءة فقط: [(name, kind, help, [(labels, value)])]
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def collector(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def families(self):
+        """كل المقاييس كعائلات: (name, kind, help, [(sample_name, labels, value)])"""
+        for metric in self._metrics:
+            yield metric.name, metric.kind, metric.help, list(metric.samples())
+        for collect in self._collectors:
+            for name, kind, help, samples in collect():
+                yield name, kind, help, [(name, labels, value) for labels, value in samples]
+
+    def render(self, shared=None, families=None):
+        """صيغة Prometheus النصية؛ مع مخزن مشترك تُجمع قيم كل عمليات الخادم
+
+        families: قيم هذه العملية مقروءة مسبقاً على حلقة الأحداث عند الاستدعاء من خيط آخر.
+        """
+        if families is None:
+            families = list(self.families())
+        if shared is not None:
+            shared.publish(families)
+            families = shared.aggregate()
+        lines = []
+        for name, kind, help, samples in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{sample}{labels} {value}" for sample, labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+class SharedMetricsStore:
+    """نشر مقاييس كل عملية في SQLite وجمعها عند القراءة (عدة عمليات خلف نفس المنفذ)"""
+
+    def __init__(self, path=METRICS_DB_PATH, stale_after=METRICS_PUBLISH_INTERVAL * 3):
+        self.worker = f"{os.getpid()}"
+        self.stale_after = stale_after
+        self._db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS metric_samples ("
+            " worker TEXT NOT NULL, family TEXT NOT NULL, kind TEXT NOT NULL, help TEXT NOT NULL,"
+            " sample TEXT NOT NULL, labels TEXT NOT NULL, value REAL NOT NULL, updated_at REAL NOT NULL,"
+            " PRIMARY KEY (worker, sample, labels))"
+        )
+        self._db.commit()
+
+    def reset(self):
+        """حذف قيم التشغيل السابق حتى لا تُجمع عدادات عمليات انتهت"""
+        with self._lock:
+            self._db.execute("DELETE FROM metric_samples")
+            self._db.commit()
+
+    def publish(self, families):
+        now = time.time()
+        rows = [
+            (self.worker, name, kind, help, sample, labels, value, now)
+            for name, kind, help, samples in families
+            for sample, labels, value in samples
+        ]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO metric_samples VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+
+    def aggregate(self):
+        """جمع القيم عبر العمليات: العدادات والمدرجات من كل العمليات، والقيم اللحظية من العمليات الحية فقط"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT family, kind, help, sample, labels, value, updated_at FROM metric_samples ORDER BY rowid"
+            ).fetchall()
+        cutoff = time.time() - self.stale_after
+        families = OrderedDict()
+        for family, kind, help, sample, labels, value, updated_at in rows:
+            if kind == "gauge" and updated_at < cutoff:
+                continue  # عملية متوقفة
+            samples = families.setdefault(family, (kind, help, OrderedDict()))[2]
+            values = samples.setdefault((sample, labels), [])
+            values.append(value)
+        return [
+            (
+                family, kind, help,
+                [
+                    # النسب تُحسب كمتوسط، وباقي القيم تُجمع
+                    (sample, labels, sum(values) / len(values) if family.endswith("_ratio") else sum(values))
+                    for (sample, labels), values in samples.items()
+                ],
+            )
+            for family, (kind, help, samples) in families.items()
+        ]
+
+    async def publish_periodically(self, registry, interval=METRICS_PUBLISH_INTERVAL):
+        """نشر مقاييس هذه العملية دورياً حتى تظهر عند قراءة /metrics من أي عملية أخرى"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.publish, list(registry.families()))
+            except sqlite3.Error as e:
+                print(f"Error publishing metrics: {e}")
+
+metrics = MetricsRegistry()
+shared_metrics = None  # يُفتح عند بدء الخادم إن حُدد CRHODIS_METRICS_DB
+http_requests = metrics.counter(
+    "crhodis_http_requests_total", "HTTP requests by route and status", ("method", "path", "status")
+)
+http_duration = metrics.histogram(
+    "crhodis_http_request_duration_seconds", "End-to-end request time including streaming", ("path",)
+)
+http_in_flight = metrics.gauge("crhodis_http_requests_in_flight", "Requests currently being served")
+upstream_requests = metrics.counter(
+    "crhodis_upstream_requests_total", "Upstream model calls by model and status", ("model", "status")
+)
+upstream_duration = metrics.histogram(
+    "crhodis_upstream_duration_seconds", "Upstream time until the full answer was received", ("model", "prompt_cache")
+)
+upstream_ttft = metrics.histogram(
+    "crhodis_upstream_ttft_seconds", "Upstream time to first streamed token", ("model", "prompt_cache")
+)
+upstream_in_flight = metrics.gauge("crhodis_upstream_in_flight", "Upstream calls currently open")
+upstream_bytes = metrics.counter(
+    "crhodis_upstream_bytes_total", "Upstream payload bytes", ("direction",)
+)
+upstream_tokens = metrics.counter(
+    "crhodis_tokens_total", "Tokens reported by the upstream usage field", ("model", "kind")
+)
+
+upstream_cost = metrics.counter(
+    "crhodis_upstream_cost_total", "Upstream cost in OpenRouter credits from the usage field", ("model",)
+)
+
+def record_usage(model, usage):
+    """تسجيل عدد التوكنات والتكلفة من حقل usage؛ يرجع حالة تخزين البادئة: hit أو miss أو unknown"""
+    if not usage:
+        return "unknown"
+    prompt_tokens = usage.get("prompt_tokens") or 0
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    upstream_tokens.inc(model, "prompt", amount=prompt_tokens)
+    upstream_tokens.inc(model, "cached_prompt", amount=cached_tokens)
+    upstream_tokens.inc(model, "completion", amount=usage.get("completion_tokens") or 0)
+    if usage.get("cost"):
+        upstream_cost.inc(model, amount=usage["cost"])
+    return "hit" if cached_tokens else "miss"
+
+def prompt_cache_stats():
+    """نسبة توكنات الطلب التي قرأها المزود من ذاكرة البادئة"""
+    prompt = sum(v for (model, kind), v in upstream_tokens._values.items() if kind == "prompt")
+    cached = sum(v for (model, kind), v in upstream_tokens._values.items() if kind == "cached_prompt")
+    return {
+        "mode": PROMPT_CACHE,
+        "prompt_tokens": prompt,
+        "cached_tokens": cached,
+        "hit_ratio": cached / prompt if prompt else 0.0,
+    }
+
+# ================ Tracing ================
+class Trace:
+    """مراحل طلب واحد بمعرّفه، بأزمنة نسبية لبدايته"""
+    __slots__ = ("request_id", "trace_id", "start", "start_ns", "spans")
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id or uuid.uuid4().hex
+        # معرّف OTLP يجب أن يكون 32 حرفاً ست عشرياً
+        if len(self.request_id) == 32 and all(c in "0123456789abcdef" for c in self.request_id):
+            self.trace_id = self.request_id
+        else:
+            self.trace_id = hashlib.sha256(self.request_id.encode("utf-8")).hexdigest()[:32]
+        self.start = time.perf_counter()
+        self.start_ns = time.time_ns()
+        self.spans = []  # (name, start, end, attributes) بقيم perf_counter
+
+    def add(self, name, start, end=None, **attributes):
+        self.spans.append((name, start, time.perf_counter() if end is None else end, attributes))
+
+    def since_last(self, name):
+        """مرحلة تبدأ من نهاية آخر مرحلة مسجلة (أو من بداية الطلب)"""
+        start = max((span[2] for span in self.spans), default=self.start)
+        self.add(name, start)
+
+    def summary(self):
+        return [
+            {
+                "name": name,
+                "start_ms": round((start - self.start) * 1000, 2),
+                "duration_ms": round((end - start) * 1000, 2),
+                **attributes,
+            }
+            for name, start, end, attributes in self.spans
+        ]
+
+current_trace = contextvars.ContextVar("crhodis_trace", default=None)
+
+@contextmanager
+def trace_span(name, **attributes):
+    """تسجيل مرحلة في تتبع الطلب الحالي (لا شيء إن لم يكن هناك تتبع)"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, start, **attributes)
+
+def trace_mark(name, start, **attributes):
+    """تسجيل مرحلة من start حتى الآن في تتبع الطلب الحالي"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, start, **attributes)
+
+def trace_checkpoint(name):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.since_last(name)
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def otlp_spans(trace, root_name):
+    """تحويل التتبع إلى مراحل OTLP: مرحلة جذرية للطلب كله ومراحل فرعية تحتها"""
+    def to_ns(t):
+        return str(trace.start_ns + int((t - trace.start) * 1e9))
+
+    root_id = os.urandom(8).hex()
+    end = max((span[2] for span in trace.spans), default=trace.start)
+    spans = [{
+        "traceId": trace.trace_id,
+        "spanId": root_id,
+        "name": root_name,
+        "kind": 2,
+        "startTimeUnixNano": to_ns(trace.start),
+        "endTimeUnixNano": to_ns(end),
+        "attributes": [{"key": "request.id", "value": otlp_value(trace.request_id)}],
+    }]
+    for name, start, span_end, attributes in trace.spans:
+        spans.append({
+            "traceId": trace.trace_id,
+            "spanId": os.urandom(8).hex(),
+            "parentSpanId": root_id,
+            "name": name,
+            "kind": 1,
+            "startTimeUnixNano": to_ns(start),
+            "endTimeUnixNano": to_ns(span_end),
+            "attributes": [{"key": k, "value": otlp_value(v)} for k, v in attributes.items()],
+        })
+    return spans
+
+class SpanExporter:
+    """تصدير التتبعات في خيط منفصل حتى لا تؤخر الطلبات"""
+
+    def __init__(self, path=TRACE_FILE, endpoint=TRACE_OTLP_ENDPOINT, batch_size=100):
+        self.path = path
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.exported = 0
+        self.failed = 0
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._export_loop, name="crhodis-traces", daemon=True)
+        self._writer.start()
+
+    def export(self, trace, service, root_name):
+        self._queue.put((trace, service, root_name))
+
+    def _export_loop(self):
+        client = httpx.Client(timeout=2) if self.endpoint else None
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if self.path:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        for trace, service, root_name in batch:
+                            f.write(json.dumps({
+                                "request_id": trace.request_id,
+                                "service": service,
+                                "name": root_name,
+                                "start": datetime.fromtimestamp(trace.start_ns / 1e9).isoformat(),
+                                "spans": trace.summary(),
+                            }, ensure_ascii=False) + "\n")
+                if client is not None:
+                    by_service = {}
+                    for trace, service, root_name in batch:
+                        by_service.setdefault(service, []).extend(otlp_spans(trace, root_name))
+                    client.post(self.endpoint, json={"resourceSpans": [
+                        {
+                            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service}}]},
+                            "scopeSpans": [{"scope": {"name": "crhodis"}, "spans": spans}],
+                        }
+                        for service, spans in by_service.items()
+                    ]})
+                self.exported += len(batch)
+            except (OSError, httpx.HTTPError) as e:
+                self.failed += len(batch)
+                print(f"Error exporting traces: {e}")
+
+span_exporter = SpanExporter() if TRACE_FILE or TRACE_OTLP_ENDPOINT else None
+
+def finish_trace(trace, service="crhodis-api", root_name="request"):
+    if span_exporter is not None and trace.spans:
+        span_exporter.export(trace, service, root_name)
+
+# ================ Upstream Resilience ================
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+class UpstreamError(Exception):
+    """فشل طلب النموذج مع حالة HTTP ومدة Retry-After إن وُجدت"""
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status is None or self.status in RETRYABLE_STATUS
+
+def parse_retry_after(value):
+    """قراءة Retry-After بالثواني أو كتاريخ HTTP"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def upstream_error(resp):
+    """تحويل استجابة فاشلة إلى UpstreamError"""
+    return UpstreamError(
+        f"Upstream returned {resp.status_code} for {resp.request.url}",
+        status=resp.status_code,
+        retry_after=parse_retry_after(resp.headers.get("Retry-After")),
+    )
+
+def retry_delay(attempt, retry_after=None):
+    """مهلة إعادة المحاولة: Retry-After إن وُجد، وإلا تراجع أُسّي بتشويش كامل"""
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+class CircuitBreaker:
+    """قاطع دائرة لكل نموذج: يتوقف عن الإرسال بعد فشل متتالٍ ثم يجرب طلباً واحداً بعد المهلة"""
+
+    def __init__(self, failures=BREAKER_FAILURES, reset_after=BREAKER_RESET):
+        self.max_failures = failures
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_after else "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial:
+            self._trial = True  # طلب تجريبي واحد فقط
+            return True
+        return False
+
+    def retry_in(self):
+        """الثواني المتبقية قبل السماح بطلب تجريبي"""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_after - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.max_failures:
+            self.opened_at = time.monotonic()
+        self._trial = False
+
+    def release(self):
+        """انتهى الطلب دون نتيجة (إلغاء أو خطأ غير متوقع): يُسمح بطلب تجريبي آخر"""
+        self._trial = False
+
+class LatencyTracker:
+    """آخر أزمنة الاستجابة الناجحة لحساب عتبة الطلب المُحوَّط"""
+
+    def __init__(self, size=200):
+        self._samples = [0.0] * size
+        self._count = 0
+
+    def add(self, seconds):
+        self._samples[self._count % len(self._samples)] = seconds
+        self._count += 1
+
+    def percentile(self, q, default):
+        n = min(self._count, len(self._samples))
+        if n < HEDGE_MIN_SAMPLES:
+            return default
+        ordered = sorted(self._samples[:n])
+        return ordered[min(n - 1, int(q * n))]
+
+upstream_models = [MODEL, *[m for m in FALLBACK_MODELS if m != MODEL]]
+circuit_breakers = {model: CircuitBreaker() for model in upstream_models}
+upstream_latency = LatencyTracker()
+
+async def hedged(send):
+    """إرسال طلب ثانٍ إذا تجاوز الأول نسبة زمنية محددة وأخذ أول إجابة ناجحة"""
+    if not HEDGE_ENABLED:
+        return await send()
+    first = asyncio.ensure_future(send())
+    done, _ = await asyncio.wait({first}, timeout=upstream_latency.percentile(HEDGE_PERCENTILE, HEDGE_DELAY))
+    if done:
+        return first.result()
+    tasks = {first, asyncio.ensure_future(send())}
+    try:
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def call_with_fallback(send):
+    """تنفيذ send(model) مع إعادة المحاولة لكل نموذج ثم الانتقال للنموذج البديل التالي"""
+    error = None
+    for model in upstream_models:
+        breaker = circuit_breakers[model]
+        for attempt in range(RETRY_ATTEMPTS):
+            if not breaker.allow():
+                error = error or UpstreamError(
+                    f"Circuit open for {model}", status=503, retry_after=breaker.retry_in()
+                )
+                break
+            try:
+                result = await send(model)
+            except (httpx.TransportError, UpstreamError) as e:
+                if isinstance(e, httpx.TransportError):
+                    e = UpstreamError(f"{type(e).__name__}: {e}")
+                error = e
+                if not e.retryable:
+                    breaker.record_success()  # خطأ في الطلب نفسه وليس في النموذج
+                    if e.status != 404:
+                        raise e
+                    break  # النموذج غير متاح، ننتقل للتالي
+                breaker.record_failure()
+                delay = retry_delay(attempt, e.retry_after)
+                if attempt + 1 == RETRY_ATTEMPTS or delay > RETRY_MAX_DELAY:
+                    break
+                await asyncio.sleep(delay)
+            except BaseException:
+                # إلغاء الطلب (زر الإيقاف أو انقطاع العميل) لا يحسم حالة النموذج، لكن لا يبقى القاطع معلقاً
+                breaker.release()
+                raise
+            else:
+                breaker.record_success()
+                return result
+    raise error
+
+def resilience_stats():
+    return {
+        "models": {
+            model: {"state": breaker.state, "failures": breaker.failures}
+            for model, breaker in circuit_breakers.items()
+        },
+        "hedge_threshold": upstream_latency.percentile(HEDGE_PERCENTILE, HEDGE_DELAY) if HEDGE_ENABLED else None,
+    }
+
+# ================ Response Cache ================
+SYSTEM_PROMPT_HASH = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:16]
+
+_ARABIC_MARKS = re.compile(r"[\u064B-\u0652\u0640]")  # التشكيل والتطويل
+_ARABIC_LETTERS = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ى": "ي", "ة": "ه"})
+_PUNCTUATION = re.compile(r"[^\w\s]")
+
+def normalize_question(text):
+    """توحيد صيغة السؤال (حالة الأحرف، الهمزات، التشكيل، الترقيم، المسافات)"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _ARABIC_MARKS.sub("", text).translate(_ARABIC_LETTERS)
+    text = _PUNCTUATION.sub(" ", text)
+    return " ".join(text.split())
+
+def generation_fingerprint(max_tokens=MAX_TOKENS, temperature=TEMPERATURE, model=MODEL):
+    """بصمة إعدادات التوليد: النموذج + موجه النظام + max_tokens + temperature"""
+    return "\x1f".join([model, SYSTEM_PROMPT_HASH, str(max_tokens), repr(float(temperature))])
+
+def cache_key(question, max_tokens=MAX_TOKENS, temperature=TEMPERATURE, model=MODEL):
+    """مفتاح التخزين: السؤال الموحد + بصمة إعدادات التوليد"""
+    raw = normalize_question(question) + "\x1f" + generation_fingerprint(max_tokens, temperature, model)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """ذاكرة LRU محدودة الحجم مع مدة صلاحية، وطبقة SQLite اختيارية تبقى بعد إعادة التشغيل
+
+    القراءة من القرص في خيط منفصل والكتابة في خيط كاتب واحد، فلا تنتظر حلقة الأحداث قفل SQLite
+    (قاعدة واحدة مشتركة بين عمال serve).
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, db_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, answer)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+            self._db_lock = threading.Lock()
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, answer TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+            self._db.commit()
+            self._queue = queue.Queue()
+            self._writer = threading.Thread(target=self._write_loop, name="crhodis-cache", daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+
+    def _get_memory(self, key, now):
+        """الإجابة من الذاكرة أو None (يُستدعى داخل القفل)"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._entries[key]
+            self.expirations += 1
+        return None
+
+    def _read(self, key):
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT answer, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+    async def get(self, key):
+        """إرجاع الإجابة المخزنة أو None؛ القرص يُقرأ فقط عند غيابها من الذاكرة"""
+        now = time.time()
+        with self._lock:
+            answer = self._get_memory(key, now)
+            if answer is not None or self._db is None:
+                if answer is None:
+                    self.misses += 1
+                return answer
+        row = await asyncio.to_thread(self._read, key)
+        with self._lock:
+            if row is not None and row[1] > now:
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return row[0]
+            self.misses += 1
+            return None
+
+    def set(self, key, answer):
+        """تخزين إجابة جديدة في الذاكرة فوراً وعلى القرص في الخلفية"""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, answer, expires_at)
+        if self._db is not None:
+            self._queue.put((key, answer, expires_at))
+
+    def flush(self, timeout=None):
+        """انتظار كتابة الإجابات المعلقة على القرص"""
+        if self._db is None:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        if self._db is not None and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=5)
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            # كل ما تجمع في الطابور يُكتب في معاملة واحدة
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            rows = [item for item in batch if isinstance(item, tuple)]
+            with self._db_lock:
+                try:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO responses (key, answer, expires_at) VALUES (?, ?, ?)", rows
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    self._db.rollback()
+                    print(f"Error saving cached answers: {e}")
+            for item in batch:
+                if item is None:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    item.set()
+
+    def _remember(self, key, answer, expires_at):
+        self._entries[key] = (expires_at, answer)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """عدادات الإصابة والإخفاق"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "persistent": self._db is not None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+response_cache = ResponseCache(db_path=CACHE_DB_PATH or None)
+
+# ================ Semantic Cache ================
+_NUMBERS = re.compile(r"\d+")
+# كلمات لا تغير معنى السؤال فتُهمل عند المقارنة (بعد normalize_question)
+_STOPWORDS = frozenset("""
+a an the of is are was were be been am do does did what i im me my we our you your it its this that
+these those please tell explain about there have has had hi hello to for in on at by as if while during
+هل في من علي عن الي ان انا عندي هو هي هذا هذه ذلك يا ممكن
+""".split())
+# كلمات النفي تقلب معنى السؤال ("حامل" و"لست حاملاً") فيجب أن تتطابق
+_NEGATIONS = frozenset("""
+no not never none nor non without cannot cant dont doesnt didnt isnt arent wasnt wont shouldnt t
+لا لم لن ليس ليست لست لسنا غير بدون دون ما مش مو
+""".split())
+# كلمات الصياغة: لا يلزم تطابقها لكنها تدخل في التشابه، فـ"how to take" و"can i take" لا يتشابهان بما يكفي
+_PHRASING = frozenset("""
+how why when which who where can could should would will may might must need want know get
+common usual main typical best some any often usually generally really
+كيف لماذا متي اين ماذا اي يمكن يجب اريد اعرف افضل اهم عاده
+""".split())
+_SUFFIXES = ("ations", "ation", "ments", "ment", "ancy", "ings", "ing", "ies", "ied", "ant", "ic", "ed", "s")
+
+def stem_term(word):
+    """جذع تقريبي لكلمة إنجليزية ("pregnancy" و"pregnant" و"diabetic" و"diabetes")؛ العربية كما هي"""
+    if not word.isascii():
+        return word
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4 and not word.endswith("ss"):
+            word = word[:-len(suffix)] + ("y" if suffix in ("ies", "ied") else "")
+            break
+    return word[:-1] if word.endswith("e") and len(word) > 4 else word
+
+def question_terms(question):
+    """نص السؤال للمقارنة بالتشابه وبصمة ما يجب أن يتطابق حرفياً
+
+    التشابه النصي يعد "أسبرين" و"باراسيتامول" أو "حامل" و"لست حامل" سؤالين متقاربين، لذا لا تُقبل
+    الإصابة إلا إذا تطابقت الأرقام وكلمات النفي والكلمات الأساسية (أسماء الأدوية والأعراض والحالات).
+    ما عدا ذلك يُترك للتشابه: كلمات الربط والترتيب والصيغة الصرفية تُهمل، وكلمات الصياغة
+    (_PHRASING) يحكم عليها الحد SEMANTIC_THRESHOLD. المتجهات حرفية فلا تطابق بين العربية والإنجليزية.
+    """
+    words = normalize_question(question).split()
+    text = []
+    negations = []
+    key_terms = set()
+    for word in words:
+        if word in _NEGATIONS:
+            negations.append(word)
+        elif word not in _STOPWORDS:
+            term = stem_term(word)
+            text.append(term)
+            if word not in _PHRASING:
+                key_terms.add(term)
+    guard = "\x1f".join([
+        " ".join(_NUMBERS.findall(" ".join(words))),
+        " ".join(sorted(negations)),
+        " ".join(sorted(key_terms)),
+    ])
+    key = int.from_bytes(hashlib.blake2b(guard.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+    return " ".join(text), key
+
+class HashedNgramVectorizer:
+    """تحويل السؤال لمتجه بتجزئة n-grams الحرفية والكلمات (بدون نموذج أو شبكة)"""
+
+    def __init__(self, dim=SEMANTIC_DIM, ngram_range=(2, 4)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+
+    def transform(self, text):
+        """متجه واحد مطبّع (طول 1)"""
+        text = f" {normalize_question(text)} "
+        low, high = self.ngram_range
+        grams = [text[i:i + n] for n in range(low, high + 1) for i in range(len(text) - n + 1)]
+        grams.extend(text.split())
+        hashes = np.fromiter(
+            (zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint32, count=len(grams)
+        )
+        # بت الإشارة يقلل أثر التصادمات في التجزئة
+        signs = np.where(hashes & 0x80000000, 1.0, -1.0).astype(np.float32)
+        vec = np.zeros(self.dim, dtype=np.float32)
+        np.add.at(vec, hashes % self.dim, signs)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def transform_many(self, texts):
+        """مصفوفة متجهات لعدة أسئلة"""
+        return np.stack([self.transform(text) for text in texts])
+
+class SemanticCache:
+    """فهرس متجهات بحجم ثابت يعيد الإجابة المخزنة لأقرب سؤال مشابه (تشابه جيب التمام)"""
+
+    def __init__(self, capacity=SEMANTIC_CAPACITY, threshold=SEMANTIC_THRESHOLD, ttl=CACHE_TTL, dim=SEMANTIC_DIM):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl
+        self.vectorizer = HashedNgramVectorizer(dim)
+        # مصفوفات محجوزة مسبقاً حتى تبقى الذاكرة ثابتة مهما طال التشغيل
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._expires = np.zeros(capacity, dtype=np.float64)
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._params = np.full(capacity, -1, dtype=np.int64)   # رقم بصمة إعدادات التوليد
+        self._guards = np.zeros(capacity, dtype=np.int64)      # بصمة ما يجب تطابقه (question_terms)
+        self._answers = [None] * capacity
+        self._param_ids = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _param_id(self, fingerprint):
+        return self._param_ids.setdefault(fingerprint, len(self._param_ids))
+
+    def lookup(self, question, fingerprint):
+        """الإجابة المخزنة لأقرب سؤال أو None"""
+        return self.lookup_many([question], fingerprint)[0]
+
+    def lookup_many(self, questions, fingerprint):
+        """بحث مُتجه لعدة أسئلة دفعة واحدة عبر ضرب مصفوفات واحد"""
+        terms = [question_terms(q) for q in questions]
+        queries = self.vectorizer.transform_many([text for text, _ in terms])
+        guards = np.array([guard for _, guard in terms], dtype=np.int64)
+        now = time.time()
+        results = [None] * len(questions)
+        with self._lock:
+            n = self._size
+            param_id = self._param_ids.get(fingerprint)
+            if n == 0 or param_id is None:
+                self.misses += len(questions)
+                return results
+            valid = (self._expires[:n] > now) & (self._params[:n] == param_id)
+            sims = queries @ self._vectors[:n].T
+            sims[:, ~valid] = -1.0
+            sims[guards[:, None] != self._guards[None, :n]] = -1.0
+            best = sims.argmax(axis=1)
+            for i, slot in enumerate(best):
+                if sims[i, slot] >= self.threshold:
+                    self._last_used[slot] = now
+                    results[i] = self._answers[slot]
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return results
+
+    def add(self, question, fingerprint, answer):
+        """إضافة سؤال وإجابته مع استبدال الأقدم استخداماً عند امتلاء الفهرس"""
+        text, guard = question_terms(question)
+        vec = self.vectorizer.transform(text)
+        now = time.time()
+        with self._lock:
+            if self._size < self.capacity:
+                slot = self._size
+                self._size += 1
+            else:
+                # الأولوية للعناصر المنتهية ثم الأقل استخداماً مؤخراً
+                scores = np.where(self._expires > now, self._last_used, -np.inf)
+                slot = int(scores.argmin())
+                self.evictions += 1
+            self._vectors[slot] = vec
+            self._expires[slot] = now + self.ttl
+            self._last_used[slot] = now
+            self._params[slot] = self._param_id(fingerprint)
+            self._guards[slot] = guard
+            self._answers[slot] = answer
+
+    def stats(self):
+        """عدادات الإصابة والإخفاق وحجم الفهرس"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self._size,
+                "capacity": self.capacity,
+                "threshold": self.threshold,
+                "index_bytes": int(self._vectors.nbytes),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+semantic_cache = SemanticCache() if SEMANTIC_CACHE_ENABLED and np is not None else None
+
+async def lookup_model_answer(question, max_tokens, temperature, model):
+    """إجابة نموذج واحد من الذاكرة المطابقة ثم الدلالية"""
+    key = cache_key(question, max_tokens, temperature, model)
+    answer = await response_cache.get(key)
+    if answer is None and semantic_cache is not None:
+        answer = semantic_cache.lookup(question, generation_fingerprint(max_tokens, temperature, model))
+        if answer is not None:
+            response_cache.set(key, answer)
+    return answer
+
+async def lookup_cached_answer(question, max_tokens=MAX_TOKENS, temperature=TEMPERATURE):
+    """الإجابة المخزنة للنموذج الأساسي، أو لنموذج بديل ما دام قاطع ما قبله غير مغلق
+
+    إجابة النموذج البديل تُعاد فقط حين كان الطلب نفسه سيذهب إليه، لا بدلاً من نموذج سليم.
+    """
+    for model in upstream_models:
+        answer = await lookup_model_answer(question, max_tokens, temperature, model)
+        if answer is not None or circuit_breakers[model].state == "closed":
+            return answer
+    return None
+
+def remember_answer(question, answer, max_tokens=MAX_TOKENS, temperature=TEMPERATURE, model=MODEL):
+    """تخزين إجابة ناجحة في الذاكرتين تحت النموذج الذي أجاب فعلاً (إجابة نموذج بديل لا تُعاد كإجابة الأساسي)"""
+    response_cache.set(cache_key(question, max_tokens, temperature, model), answer)
+    if semantic_cache is not None:
+        semantic_cache.add(question, generation_fingerprint(max_tokens, temperature, model), answer)
+
+# ================ Conversation Storage ================
+CONVERSATIONS_DB_PATH = os.path.join(DATA_DIR, "conversations.db")
+STORE_BATCH_SIZE = 100  # أقصى عدد عمليات كتابة في معاملة واحدة
+STORE_FLUSH_INTERVAL = 0.25  # أقصى انتظار لتجميع عمليات الكتابة (ثانية)
+CONVERSATION_TITLE_LENGTH = 60
+
+_last_record_id = 0
+_record_id_lock = threading.Lock()
+
+def new_record_id():
+    """معرّف فريد متزايد (بالميكروثانية) للرسائل والمحادثات، يبقى مرتباً زمنياً بعد إعادة التشغيل"""
+    global _last_record_id
+    with _record_id_lock:
+        _last_record_id = max(_last_record_id + 1, time.time_ns() // 1000)
+        return _last_record_id
+
+class ConversationStore:
+    """حفظ المحادثات محلياً في SQLite؛ الكتابة مجمعة في خيط منفصل والقراءة بالصفحات عبر فهرس"""
+
+    def __init__(self, path=CONVERSATIONS_DB_PATH, batch_size=STORE_BATCH_SIZE, flush_interval=STORE_FLUSH_INTERVAL):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            " id INTEGER PRIMARY KEY, title TEXT NOT NULL,"
+            " created_at REAL NOT NULL, updated_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " id INTEGER PRIMARY KEY, conversation_id INTEGER NOT NULL,"
+            " role TEXT NOT NULL, text TEXT NOT NULL, created_at REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (conversation_id, id);"
+            "CREATE INDEX IF NOT EXISTS conversations_by_update ON conversations (updated_at);"
+        )
+        # رمز المحادثات التي أنشأتها واجهة HTTP (NULL لمحادثات الواجهة الرسومية)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(conversations)")}
+        if "token" not in columns:
+            self._db.execute("ALTER TABLE conversations ADD COLUMN token TEXT")
+        self._db.execute("CREATE UNIQUE INDEX IF NOT EXISTS conversations_by_token ON conversations (token)")
+        self._db.commit()
+        self.generation = 0  # يزيد مع كل حذف أو كتابة متأخرة حتى تعيد النسخ المخزنة من المحادثات تحميل نفسها
+        self._latest_ids = {}  # conversation_id -> أحدث معرّف رسالة محفوظة
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="crhodis-store", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    # ---------- الكتابة (غير حاجبة) ----------
+    def create_conversation(self, conversation_id, title, token=None):
+        now = time.time()
+        self._queue.put((
+            "INSERT OR IGNORE INTO conversations (id, title, created_at, updated_at, token) VALUES (?, ?, ?, ?, ?)",
+            (conversation_id, title[:CONVERSATION_TITLE_LENGTH], now, now, token),
+        ))
+
+    def save_message(self, conversation_id, record):
+        # إجابة انتهت بعد إرسال سؤال أحدث منها تُكتب في وسط المحادثة
+        if record.id < self._latest_ids.get(conversation_id, 0):
+            self.generation += 1
+        else:
+            self._latest_ids[conversation_id] = record.id
+        self._queue.put((
+            "INSERT OR REPLACE INTO messages (id, conversation_id, role, text, created_at) VALUES (?, ?, ?, ?, ?)",
+            (record.id, conversation_id, record.role, record.text, record.timestamp),
+        ))
+        self._queue.put((
+            "UPDATE conversations SET updated_at = ? WHERE id = ?",
+            (time.time(), conversation_id),
+        ))
+
+    def delete_messages(self, message_ids):
+        self.generation += 1
+        for message_id in message_ids:
+            self._queue.put(("DELETE FROM messages WHERE id = ?", (message_id,)))
+
+    def delete_conversation(self, conversation_id):
+        self.generation += 1
+        self._queue.put(("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,)))
+        self._queue.put(("DELETE FROM conversations WHERE id = ?", (conversation_id,)))
+
+    def flush(self, timeout=None):
+        """انتظار كتابة كل العمليات المعلقة"""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=5)
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and isinstance(batch[-1], tuple):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            waiters = []
+            with self._db_lock:
+                try:
+                    for item in batch:
+                        if item is None:
+                            stopping = True
+                        elif isinstance(item, threading.Event):
+                            waiters.append(item)
+                        else:
+                            self._db.execute(*item)
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    self._db.rollback()
+                    print(f"Error saving conversations: {e}")
+            for waiter in waiters:
+                waiter.set()
+
+    # ---------- القراءة ----------
+    def _query(self, sql, params=()):
+        with self._db_lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def latest_conversation_id(self):
+        rows = self._query("SELECT id FROM conversations WHERE token IS NULL ORDER BY updated_at DESC LIMIT 1")
+        return rows[0][0] if rows else None
+
+    def list_conversations(self, limit=50):
+        """(id, title, updated_at, عدد الرسائل) لمحادثات الواجهة الأحدث أولاً"""
+        return self._query(
+            "SELECT c.id, c.title, c.updated_at, "
+            "(SELECT COUNT(*) FROM messages m WHERE m.conversation_id = c.id) "
+            "FROM conversations c WHERE c.token IS NULL ORDER BY c.updated_at DESC LIMIT ?",
+            (limit,),
+        )
+
+    def conversation_by_token(self, token):
+        """معرّف محادثة HTTP برمزها أو None (بعد كتابة العمليات المعلقة)"""
+        self.flush()
+        rows = self._query("SELECT id FROM conversations WHERE token = ?", (token,))
+        return rows[0][0] if rows else None
+
+    def load_recent(self, conversation_id, limit):
+        """آخر limit رسالة في المحادثة (الأقدم أولاً)"""
+        rows = self._query(
+            "SELECT id, role, text, created_at FROM messages "
+            "WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+            (conversation_id, limit),
+        )
+        rows.reverse()
+        return rows
+
+    def load_before(self, conversation_id, before_id, limit):
+        """حتى limit رسالة أقدم من before_id (الأقدم أولاً)"""
+        rows = self._query(
+            "SELECT id, role, text, created_at FROM messages "
+            "WHERE conversation_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (conversation_id, before_id, limit),
+        )
+        rows.reverse()
+        return rows
+
+    def load_messages(self, message_ids):
+        """رسائل بمعرّفاتها (الأقدم أولاً)، لإعادة ما أزالته الواجهة من الذاكرة"""
+        marks = ",".join("?" * len(message_ids))
+        return self._query(
+            f"SELECT id, role, text, created_at FROM messages WHERE id IN ({marks}) ORDER BY id",
+            tuple(message_ids),
+        )
+
+    def load_between(self, conversation_id, after_id, before_id):
+        """الرسائل بين after_id و before_id (الأقدم أولاً)"""
+        return self._query(
+            "SELECT id, role, text, created_at FROM messages "
+            "WHERE conversation_id = ? AND id > ? AND id < ? ORDER BY id",
+            (conversation_id, after_id, before_id),
+        )
+
+_conversation_store = None
+_conversation_store_lock = threading.Lock()
+
+def get_conversation_store():
+    """فتح مخزن المحادثات عند أول استخدام"""
+    global _conversation_store
+    with _conversation_store_lock:
+        if _conversation_store is None:
+            _conversation_store = ConversationStore()
+        return _conversation_store
+
+# ================ Conversation Context ================
+MESSAGE_TOKEN_OVERHEAD = 4  # توكنات إضافية لكل رسالة (الدور والفواصل)
+
+def estimate_tokens(text):
+    """تقدير عدد التوكنات (≈ 4 بايت لكل توكن، يناسب العربية والإنجليزية تقريباً)"""
+    return len(text.encode("utf-8")) // 4 + MESSAGE_TOKEN_OVERHEAD
+
+SYSTEM_PROMPT_TOKENS = estimate_tokens(SYSTEM_PROMPT)
+
+class ConversationContext:
+    """نسخ مخزنة من أدوار المحادثات مع عدد توكنات كل رسالة، تُحدّث بالأدوار الجديدة فقط"""
+
+    def __init__(self, capacity=CONTEXT_CACHE_SIZE, token_budget=CONTEXT_TOKEN_BUDGET):
+        self.capacity = capacity
+        self.token_budget = token_budget
+        self._turns = OrderedDict()  # conversation_id -> {"generation", "last_id", "messages"}
+        self._lock = threading.Lock()  # history تُستدعى من عدة خيوط (asyncio.to_thread)
+
+    def _refresh(self, store, conversation_id, before_id):
+        """جلب الرسائل الجديدة فقط منذ آخر طلب (أو المحادثة كاملة بعد أي حذف)
+
+        النسخة المحدثة تُبنى خارج القفل ثم تُستبدل بها المخزنة، فلا يُلحق طلبان متزامنان نفس الأدوار مرتين.
+        """
+        generation = store.generation
+        with self._lock:
+            entry = self._turns.get(conversation_id)
+        if entry is None or entry["generation"] != generation:
+            entry = {"generation": generation, "last_id": 0, "messages": ()}
+        if before_id > entry["last_id"]:
+            added = tuple(
+                (message_id, {"role": "user" if role == "user" else "assistant", "content": text}, estimate_tokens(text))
+                for message_id, role, text, _ in store.load_between(conversation_id, entry["last_id"], before_id)
+                if role in ("user", "ai")
+            )
+            entry = {"generation": generation, "last_id": before_id - 1, "messages": entry["messages"] + added}
+        with self._lock:
+            current = self._turns.get(conversation_id)
+            # طلب متزامن خزّن نسخة أحدث: نبقيها ونستخدم نسختنا لهذا الطلب فقط
+            if current is None or (current["generation"], current["last_id"]) < (generation, entry["last_id"]):
+                self._turns[conversation_id] = entry
+            self._turns.move_to_end(conversation_id)
+            while len(self._turns) > self.capacity:
+                self._turns.popitem(last=False)
+        return entry["messages"]
+
+    def history(self, conversation_id, before_id, question, token_budget=None):
+        """أحدث الأدوار السابقة التي تتسع لها الميزانية مع تعليمات النظام والسؤال"""
+        store = get_conversation_store()
+        store.flush()
+        messages = self._refresh(store, conversation_id, before_id)
+        budget = (token_budget or self.token_budget) - SYSTEM_PROMPT_TOKENS - estimate_tokens(question)
+        selected = []
+        for message_id, message, tokens in reversed(messages):
+            if message_id >= before_id:
+                continue
+            if tokens > budget:
+                break
+            budget -= tokens
+            selected.append(message)
+        # يجب أن يبدأ السياق بسؤال من المستخدم
+        while selected and selected[-1]["role"] != "user":
+            selected.pop()
+        selected.reverse()
+        return selected
+
+conversation_context = ConversationContext()
+
+async def load_history(conversation_id, message_id, question):
+    """الأدوار السابقة للسؤال في محادثته (فارغة إن لم تُرسل المحادثة)"""
+    if conversation_id is None:
+        return []
+    before_id = message_id if message_id is not None else new_record_id()
+    return await asyncio.to_thread(conversation_context.history, conversation_id, before_id, question)
+
+# محادثات HTTP: المعرّفات الرقمية زمنية يمكن تخمينها ومحادثات الواجهة في نفس قاعدة البيانات،
+# لذا لا يصل عميل HTTP إلا لمحادثة أنشأها الخادم له، عبر رمز عشوائي لا يُعاد إلا لذلك العميل.
+# الحفظ اختياري: سؤال بدون رمز وبدون start_conversation لا يُحفظ منه شيء في قاعدة البيانات
+CONVERSATION_TOKEN_BYTES = 16
+
+async def api_conversation(token, start=False):
+    """(conversation_id, token) لطلب HTTP
+
+    رمز معروف = محادثته، start = محادثة جديدة برمز جديد، بدونهما = (None, None) سؤال بلا سياق ولا حفظ،
+    وNone لرمز غير معروف.
+    """
+    if token is None:
+        if not start:
+            return None, None
+        return new_record_id(), secrets.token_urlsafe(CONVERSATION_TOKEN_BYTES)
+    conversation_id = await asyncio.to_thread(get_conversation_store().conversation_by_token, token)
+    return None if conversation_id is None else (conversation_id, token)
+
+def save_api_turn(conversation_id, token, question_id, question, answer):
+    """حفظ سؤال HTTP وإجابته معاً بعد نجاحها حتى تكون سياقاً للأسئلة التالية (فقط ضمن محادثة برمز)"""
+    if token is None:
+        return
+    store = get_conversation_store()
+    store.create_conversation(conversation_id, question, token=token)
+    store.save_message(conversation_id, ChatRecord(question_id, "user", question))
+    store.save_message(conversation_id, ChatRecord(new_record_id(), "ai", answer))
+
+# ================ Request Coalescing ================
+class SingleFlight:
+    """دمج الطلبات المتطابقة الجارية في نفس الوقت في طلب واحد للنموذج"""
+
+    def __init__(self):
+        self._calls = {}  # key -> Future للطلب الجاري
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        """تنفيذ fn() مرة واحدة لكل مفتاح جارٍ؛ كل المنتظرين يحصلون على نفس النتيجة أو نفس الخطأ"""
+        # لا يمكن انتظار Future من حلقة أحداث أخرى، فالدمج داخل كل حلقة فقط
+        key = (id(asyncio.get_running_loop()), key)
+        future = self._calls.get(key)
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._calls.pop(key, None))
+            # منع تحذير "exception was never retrieved" إذا أُلغي كل المنتظرين
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        else:
+            self.coalesced += 1
+        # إلغاء أحد المنتظرين (مثل انقطاع العميل) لا يلغي الطلب المشترك
+        return await asyncio.shield(future)
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls),
+        }
+
+upstream_flights = SingleFlight()
+
+def flight_key(question, max_tokens=MAX_TOKENS, temperature=TEMPERATURE, history=()):
+    """مفتاح الدمج: السؤال الموحد وإعدادات التوليد والسياق السابق"""
+    key = cache_key(question, max_tokens, temperature)
+    if history:
+        key += hashlib.sha256(
+            json.dumps(history, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        ).hexdigest()
+    return key
+
+# ================ Admission Control ================
+class AdmissionRejected(Exception):
+    """رفض الطلب لامتلاء الطابور أو انتهاء مهلة الانتظار"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """حد أقصى للطلبات المتزامنة مع طابور انتظار محدود يرفض فوراً عند امتلائه"""
+
+    def __init__(self, max_concurrency=ADMISSION_MAX_CONCURRENCY, max_queue=ADMISSION_MAX_QUEUE, queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters = OrderedDict()  # Future -> None بترتيب الوصول
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+
+    def retry_after(self):
+        """تقدير الوقت حتى يتوفر مكان (متوسط زمن الطلب × عدد الأدوار أمام العميل)"""
+        rounds = (len(self._waiters) + 1) / self.max_concurrency
+        return max(1, math.ceil(upstream_latency.percentile(0.5, 1.0) * rounds))
+
+    async def acquire(self):
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise AdmissionRejected("queue full", self.retry_after())
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[waiter] = None
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                self.admitted += 1
+                return  # حصل على مكان في نفس لحظة انتهاء المهلة
+            self.rejected_timeout += 1
+            raise AdmissionRejected("queue timeout", self.retry_after())
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # أُلغي بعد تسليمه مكاناً، نمرره للتالي
+            raise
+        finally:
+            self._waiters.pop(waiter, None)
+            if not waiter.done():
+                waiter.cancel()
+        self.admitted += 1
+
+    def release(self):
+        """تسليم المكان لأقدم منتظر مباشرة أو تحريره"""
+        while self._waiters:
+            waiter, _ = self._waiters.popitem(last=False)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "queued": len(self._waiters),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+        }
+
+class MemoryBucketStore:
+    """تخزين دلاء التوكن في ذاكرة العملية (عامل واحد)"""
+    blocking = False
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+
+    def take(self, key, rate, burst, now, cost=1):
+        """سحب حتى cost توكن؛ يرجع (عدد التوكنات الممنوحة، ثوانٍ حتى يتوفر توكن إن لم تُمنح كلها)"""
+        tokens, updated = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        granted = min(cost, int(tokens))
+        tokens -= granted
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)  # أقدم عميل غير نشط يبدأ بدلو ممتلئ
+        return granted, 0.0 if granted == cost else (1 - tokens) / rate
+
+class SqliteBucketStore:
+    """دلاء التوكن في SQLite مشتركة بين كل عمليات الخادم على نفس الجهاز"""
+    blocking = True  # قد تنتظر قفل الكتابة حتى 5 ثوانٍ، فتُستدعى في خيط منفصل
+
+    def __init__(self, path=SHARED_DB_PATH, cleanup_every=1000):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.cleanup_every = cleanup_every
+        self._takes = 0
+        self._db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets ("
+            " key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def take(self, key, rate, burst, now, cost=1):
+        """سحب حتى cost توكن داخل معاملة حاجزة للكتابة حتى لا تتسابق العمليات"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (key,)
+                ).fetchone()
+                tokens, updated = row if row is not None else (burst, now)
+                tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+                granted = min(cost, int(tokens))
+                tokens -= granted
+                self._db.execute(
+                    "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                    (key, tokens, now),
+                )
+                self._takes += 1
+                if self._takes % self.cleanup_every == 0:
+                    # الدلاء التي امتلأت من جديد لا تختلف عن غيابها
+                    self._db.execute("DELETE FROM rate_buckets WHERE updated_at < ?", (now - burst / rate,))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return granted, 0.0 if granted == cost else (1 - tokens) / rate
+
+# مخازن حد المعدل المتاحة؛ مخزن مشترك يسمح لعدة عمليات بتقاسم نفس الحدود
+RATE_LIMIT_STORES = {"memory": MemoryBucketStore, "sqlite": SqliteBucketStore}
+
+class RateLimiter:
+    """حد معدل بدلو توكن لكل عميل (مفتاح API أو عنوان IP)"""
+
+    def __init__(self, per_minute=RATE_LIMIT_PER_MINUTE, burst=RATE_LIMIT_BURST, store=None):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.store = store if store is not None else RATE_LIMIT_STORES[RATE_LIMIT_BACKEND]()
+        self.limited = 0
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    async def check(self, client_key, cost=1):
+        """(عدد الطلبات المسموح بها من cost، ثوانٍ حتى يتوفر توكن)؛ 0 = الطلب مرفوض"""
+        args = (client_key, self.rate, self.burst, time.time(), cost)
+        if self.store.blocking:
+            # قاعدة بيانات مقفلة من عملية أخرى لا توقف حلقة الأحداث وكل الطلبات معها
+            granted, retry_after = await asyncio.to_thread(self.store.take, *args)
+        else:
+            granted, retry_after = self.store.take(*args)
+        self.limited += cost - granted
+        return granted, retry_after
+
+    def stats(self):
+        return {"per_minute": self.rate * 60, "burst": self.burst, "limited": self.limited}
+
+def key_digest(api_key):
+    return hashlib.sha256(api_key).hexdigest()
+
+API_KEY_DIGESTS = frozenset(key_digest(k.encode("utf-8")) for k in API_KEYS)
+TRUSTED_PROXY_NETWORKS = [ipaddress.ip_network(p, strict=False) for p in TRUSTED_PROXIES]
+
+def is_trusted_proxy(address):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXY_NETWORKS)
+
+def client_ip(scope, headers):
+    """عنوان العميل؛ من X-Forwarded-For فقط إن وصل الطلب من وكيل موثوق
+
+    يُقرأ الترويس من اليمين ويُتخطى كل وكيل موثوق، فأول عنوان غير موثوق هو ما رآه الوكيل
+    فعلاً؛ العناوين على يساره يكتبها العميل نفسه ويمكن تزويرها.
+    """
+    client = scope.get("client")
+    address = client[0] if client else "unknown"
+    forwarded = headers.get(b"x-forwarded-for")
+    if forwarded and is_trusted_proxy(address):
+        for hop in reversed(forwarded.decode("latin-1").split(",")):
+            address = hop.strip()
+            if not is_trusted_proxy(address):
+                break
+    return address
+
+def client_key(scope):
+    """هوية العميل لحد المعدل: مفتاح API مقبول (CRHODIS_API_KEYS)، وإلا عنوان IP
+
+    مفتاح غير مقبول لا يعطي دلواً جديداً، وإلا لتجاوز أي عميل الحد بإرسال مفتاح عشوائي مع كل طلب.
+    """
+    headers = dict(scope.get("headers") or ())
+    api_key = headers.get(b"x-api-key")
+    if api_key is None:
+        authorization = headers.get(b"authorization", b"")
+        if authorization.lower().startswith(b"bearer "):
+            api_key = authorization[7:]
+    if api_key and API_KEY_DIGESTS:
+        digest = key_digest(api_key)
+        if digest in API_KEY_DIGESTS:
+            return "key:" + digest[:16]
+    return "ip:" + client_ip(scope, headers)
+
+admission = AdmissionController()
+rate_limiter = RateLimiter()
+
+class MetricsMiddleware:
+    """قياس عدد الطلبات وزمنها الكامل (حتى نهاية البث) والطلبات الجارية"""
+
+    def __init__(self, app):
+        self.app = app
+        self._paths = None
+
+    def route_path(self, scope):
+        """المسار كتسمية فقط إن كان مساراً معروفاً، لتجنب عدد غير محدود من التسميات"""
+        if self._paths is None:
+            self._paths = {route.path for route in scope["app"].routes}
+        path = scope["path"]
+        return path if path in self._paths else "other"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        http_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_in_flight.dec()
+            path = self.route_path(scope)
+            http_requests.inc(scope["method"], path, status)
+            http_duration.observe(time.perf_counter() - started, path)
+
+class TracingMiddleware:
+    """ربط كل طلب بمعرّفه (من ترويسة X-Request-ID أو معرّف جديد) وتسجيل مراحله"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = dict(scope.get("headers") or ()).get(TRACE_HEADER.lower().encode())
+        trace = Trace(request_id.decode("latin-1")[:64] if request_id else None)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", ()),
+                    (TRACE_HEADER.lower().encode(), trace.request_id.encode("latin-1")),
+                ]
+            await send(message)
+
+        token = current_trace.set(trace)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            current_trace.reset(token)
+            finish_trace(trace, root_name=f"{scope['method']} {scope['path']}")
+
+async def send_json(send, status, body, retry_after):
+    """إرسال رد JSON مباشرة عبر ASGI (بدون استيراد fastapi في الوسيط)"""
+    content = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(content)).encode()),
+            (b"retry-after", str(retry_after).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": content})
+
+class AdmissionMiddleware:
+    """تطبيق حد المعدل والقبول على مسارات الأسئلة، مع حجز المكان حتى نهاية البث"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not scope["path"].startswith(ADMISSION_PATH_PREFIX)
+            or scope["path"].startswith(ADMISSION_BATCH_PREFIX)  # تُحاسب لكل سؤال في batch_params و answer_batch
+        ):
+            await self.app(scope, receive, send)
+            return
+        if rate_limiter.enabled:
+            allowed, retry_after = await rate_limiter.check(client_key(scope))
+            if not allowed:
+                await send_json(send, 429, {"detail": "Rate limit exceeded"}, math.ceil(retry_after))
+                return
+        try:
+            with trace_span("admission"):
+                await admission.acquire()
+        except AdmissionRejected as e:
+            await send_json(send, 503, {"detail": f"Server busy ({e.reason})"}, e.retry_after)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.release()
+
+# ================ Question Answering ================
+def json_bytes(value):
+    """ترميز JSON مضغوط وثابت (نفس المدخلات تعطي نفس البايتات دائماً)"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def json_loads(data):
+    """تحليل JSON كامل (orjson إن وُجد)"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+# رسالة النظام تُبنى مرة واحدة: بعلامة cache_control لمزودين يحتاجونها، وبدونها لغيرهم
+SYSTEM_MESSAGES = {
+    False: {"role": "system", "content": SYSTEM_PROMPT},
+    True: {
+        "role": "system",
+        "content": [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+    },
+}
+# البادئة مسلسلة مسبقاً حتى تصل للمزود بنفس البايتات في كل طلب
+SYSTEM_MESSAGE_JSON = {cached: json_bytes(message) for cached, message in SYSTEM_MESSAGES.items()}
+
+def uses_prompt_cache(model):
+    """هل تُضاف علامات cache_control لطلبات هذا النموذج"""
+    if PROMPT_CACHE == "auto":
+        return model.startswith(PROMPT_CACHE_MODEL_PREFIXES)
+    return PROMPT_CACHE == "1"
+
+@functools.lru_cache(maxsize=64)
+def payload_suffix(model, max_tokens, temperature, stream):
+    """الحقول الثابتة بعد الرسائل، مرمزة مرة واحدة لكل مجموعة إعدادات"""
+    fields = {
+        "model": model,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "usage": {"include": True},  # إرجاع عدد التوكنات حتى في وضع البث
+    }
+    if stream:
+        fields["stream"] = True
+    return b"]," + json_bytes(fields)[1:]
+
+def encode_payload(question, max_tokens=MAX_TOKENS, temperature=TEMPERATURE, stream=False, history=(), model=MODEL):
+    """جسم الطلب المرسل للنموذج كبايتات: الأجزاء الثابتة جاهزة ويُرمز فقط السياق والسؤال"""
+    parts = [b'{"messages":[', SYSTEM_MESSAGE_JSON[uses_prompt_cache(model)]]
+    if history:
+        parts += (b",", json_bytes(list(history))[1:-1])
+    parts += (
+        b',{"role":"user","content":', json_bytes(question), b"}",
+        payload_suffix(model, max_tokens, temperature, stream),
+    )
+    return b"".join(parts)
+
+json_decoder = json.JSONDecoder()
+
+@functools.lru_cache(maxsize=None)
+def json_key_pattern(name):
+    return re.compile(rf'"{name}"\s*:\s*')
+
+def json_field(text, name):
+    """قيمة أول مفتاح بهذا الاسم دون تحليل باقي المستند (None إن لم يوجد)"""
+    # علامة التنصيص غير المهربة لا تظهر داخل النصوص، فالمطابقة تقع على مفتاح حقيقي فقط
+    match = json_key_pattern(name).search(text)
+    if match is None:
+        return None
+    return json_decoder.raw_decode(text, match.end())[0]
+
+def body_error(error):
+    """UpstreamError من حقل error داخل جسم استجابة 200 (كائن {"message", "code"} أو نص)"""
+    if not isinstance(error, dict):
+        return UpstreamError(str(error))
+    code = error.get("code")
+    return UpstreamError(str(error.get("message", "upstream error")), status=code if isinstance(code, int) else None)
+
+def parse_completion(body):
+    """نص الإجابة وحقل usage من استجابة /chat/completions
+
+    جسم تالف أو ناقص يصبح UpstreamError قابلاً لإعادة المحاولة (بدون حالة) حتى يمر على
+    إعادة المحاولة وقاطع الدائرة والنموذج البديل بدلاً من خطأ 500.
+    """
+    # الجسم معظمه نص الإجابة نفسه، فتحليله كاملاً لا يكلف أكثر من استخراج الحقلين
+    try:
+        data = json_loads(body)
+    except ValueError as e:
+        raise UpstreamError(f"Malformed upstream response: {e}") from e
+    if not isinstance(data, dict):
+        raise UpstreamError("Malformed upstream response: not a JSON object")
+    if "error" in data:
+        # OpenRouter قد يعيد الخطأ داخل جسم استجابة 200
+        raise body_error(data["error"])
+    try:
+        content = data["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError) as e:
+        raise UpstreamError(f"Malformed upstream response: no choices[0].message.content ({e!r})") from e
+    if not isinstance(content, str):
+        raise UpstreamError("Malformed upstream response: content is not text")
+    return content, data.get("usage")
+
+def parse_chunk(data):
+    """نص الجزء وحقل usage من سطر بث واحد؛ حقل usage يأتي في آخر جزء فقط"""
+    if orjson is None and '"error"' not in data:
+        # json القياسية بطيئة مع مئات الأجزاء الصغيرة: يُحلل كائن delta وحده
+        delta = json_field(data, "delta")
+        if isinstance(delta, dict):
+            usage = json_field(data, "usage") if '"usage"' in data else None
+            return delta.get("content"), usage
+    try:
+        chunk = json_loads(data)
+    except ValueError as e:
+        raise UpstreamError(f"Malformed upstream chunk: {e}") from e
+    if not isinstance(chunk, dict):
+        raise UpstreamError("Malformed upstream chunk: not a JSON object")
+    if "error" in chunk:
+        raise body_error(chunk["error"])
+    choices = chunk.get("choices") or []
+    delta = (choices[0].get("delta") or {}).get("content") if choices else None
+    return delta, chunk.get("usage")
+
+async def fetch_completion(question, max_tokens=MAX_TOKENS, temperature=TEMPERATURE, history=()):
+    """(الإجابة، النموذج الذي أجاب) مع إعادة المحاولة والنماذج البديلة (يرفع استثناء عند الفشل)"""
+    async def post(model):
+        body = encode_payload(question, max_tokens, temperature, history=history, model=model)
+        client = get_http_client()
+        started = time.perf_counter()
+        upstream_in_flight.inc()
+        try:
+            # إرسال بوضع البث لفصل زمن الاتصال والترويسة عن زمن قراءة الجسم
+            resp = await client.send(client.build_request("POST", URL, content=body), stream=True)
+            trace_mark("upstream_connect", started, model=model, status=resp.status_code)
+            body_started = time.perf_counter()
+            try:
+                await resp.aread()
+            finally:
+                await resp.aclose()
+            trace_mark("upstream_body", body_started, model=model)
+        except httpx.TransportError:
+            upstream_requests.inc(model, "error")
+            raise
+        finally:
+            upstream_in_flight.dec()
+        elapsed = time.perf_counter() - started
+        upstream_requests.inc(model, resp.status_code)
+        upstream_bytes.inc("sent", amount=len(body))
+        upstream_bytes.inc("received", amount=len(resp.content))
+        if resp.status_code != 200:
+            raise upstream_error(resp)
+        content, usage = parse_completion(resp.content)
+        upstream_latency.add(elapsed)
+        upstream_duration.observe(elapsed, model, record_usage(model, usage))
+        return content, model
+
+    return await call_with_fallback(lambda model: hedged(lambda: post(model)))
+
+async def ask_ai_model(question, max_tokens=MAX_TOKENS, temperature=TEMPERATURE, history=()):
+    """استدعاء نموذج الذكاء الاصطناعي مع المرور على ذاكرة التخزين المؤقت (يرفع استثناء عند الفشل)"""
+    # الإجابة على سؤال له سياق سابق تعتمد على السياق، فلا تُقرأ ولا تُخزن في الذاكرة المؤقتة
+    if not history:
+        with trace_span("cache_lookup"):
+            cached = await lookup_cached_answer(question, max_tokens, temperature)
+        if cached is not None:
+            return cached
+
+    async def fetch_and_remember():
+        answer, model = await fetch_completion(question, max_tokens, temperature, history)
+        # لا نخزن رسائل الخطأ، فقط الإجابات الناجحة
+        if not history:
+            remember_answer(question, answer, max_tokens, temperature, model)
+        return answer
+
+    return await upstream_flights.do(
+        flight_key(question, max_tokens, temperature, history), fetch_and_remember
+    )
+
+async def answer_batch(questions, concurrency=BATCH_CONCURRENCY, ordered=True):
+    """الإجابة على عدة أسئلة بعدد محدود من الطلبات المتزامنة، مع نتيجة وحالة لكل سؤال
+
+    كل سؤال يحجز مكاناً من admission كطلب /ask مستقل، فلا تتجاوز الدفعات الحد العام للتزامن.
+    """
+    results = asyncio.Queue()
+    pending = iter(enumerate(questions))
+
+    async def worker():
+        for index, question in pending:
+            try:
+                await admission.acquire()
+            except AdmissionRejected as e:
+                await results.put({
+                    "index": index, "status": "error",
+                    "error": f"Server busy ({e.reason})", "retry_after": e.retry_after,
+                })
+                continue
+            try:
+                answer = await ask_ai_model(question)
+                await results.put({"index": index, "status": "ok", "answer": answer})
+            except Exception as e:
+                await results.put({"index": index, "status": "error", "error": str(e)})
+            finally:
+                admission.release()
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, min(concurrency, len(questions))))]
+    try:
+        buffered = {}
+        next_index = 0
+        for _ in range(len(questions)):
+            result = await results.get()
+            if not ordered:
+                yield result
+                continue
+            # الترتيب الأصلي: إخراج كل نتيجة فور اكتمال كل ما قبلها
+            buffered[result["index"]] = result
+            while next_index in buffered:
+                yield buffered.pop(next_index)
+                next_index += 1
+    finally:
+        # إيقاف العمال إذا انقطع العميل قبل اكتمال الدفعة
+        for task in workers:
+            task.cancel()
+
+async def open_stream(question, max_tokens, temperature, history):
+    """فتح اتصال البث مع إعادة المحاولة والنماذج البديلة حتى وصول ترويسة ناجحة"""
+    async def connect(model):
+        body = encode_payload(question, max_tokens, temperature, stream=True, history=history, model=model)
+        client = get_http_client()
+        request = client.build_request("POST", URL, content=body)
+        upstream_bytes.inc("sent", amount=len(body))
+        started = time.perf_counter()
+        try:
+            resp = await client.send(request, stream=True)
+        except httpx.TransportError:
+            upstream_requests.inc(model, "error")
+            raise
+        trace_mark("upstream_connect", started, model=model, status=resp.status_code)
+        upstream_requests.inc(model, resp.status_code)
+        if resp.status_code != 200:
+            await resp.aclose()
+            raise upstream_error(resp)
+        return resp, model, started
+
+    return await call_with_fallback(connect)
+
+async def stream_ai_model(question, max_tokens=MAX_TOKENS, temperature=TEMPERATURE, history=(), served=None):
+    """بث إجابة النموذج جزءاً بجزء فور وصولها (SSE من OpenRouter)
+
+    served: قاموس اختياري يُكتب فيه النموذج الذي أجاب (قد يكون بديلاً) تحت "model".
+    """
+    # إعادة المحاولة ممكنة فقط قبل بدء البث؛ الخطأ بعد أول جزء يصل للعميل كما هو
+    resp, model, started = await open_stream(question, max_tokens, temperature, history)
+    if served is not None:
+        served["model"] = model
+    ttft = None
+    prompt_cache = "unknown"  # يُعرف من حقل usage في آخر جزء
+    received = 0
+    upstream_in_flight.inc()
+    try:
+        async for line in resp.aiter_lines():
+            received += len(line) + 1
+            # تجاهل الأسطر الفارغة وتعليقات SSE مثل ": OPENROUTER PROCESSING"
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            delta, usage = parse_chunk(data)
+            if usage:
+                prompt_cache = record_usage(model, usage)
+            if delta:
+                if ttft is None:
+                    ttft = time.perf_counter() - started
+                    trace_mark("upstream_first_token", started, model=model)
+                yield delta
+        upstream_duration.observe(time.perf_counter() - started, model, prompt_cache)
+        trace_mark("upstream_body", started, model=model, prompt_cache=prompt_cache)
+    finally:
+        if ttft is not None:
+            # يُسجل في النهاية حتى يُصنف حسب إصابة ذاكرة البادئة
+            upstream_ttft.observe(ttft, model, prompt_cache)
+        upstream_in_flight.dec()
+        upstream_bytes.inc("received", amount=received)
+        await resp.aclose()
+
+async def answer_events(question, conversation_id=None, message_id=None, debug=False):
+    """أحداث الإجابة: {"delta"} لكل جزء ثم {"done"} أو {"error"} (تُستخدم مباشرة في الوضع المدمج وعبر HTTP)"""
+    def done(**fields):
+        # مراحل الطلب حتى الآن لعرضها في وضع التصحيح بالواجهة
+        trace = current_trace.get()
+        if debug and trace is not None:
+            fields["trace"] = {"request_id": trace.request_id, "spans": trace.summary()}
+        return {"done": True, **fields}
+
+    with trace_span("history"):
+        history = await load_history(conversation_id, message_id, question)
+    if not history:
+        with trace_span("cache_lookup"):
+            cached = await lookup_cached_answer(question)
+        if cached is not None:
+            yield {"delta": cached}
+            yield done(cached=True)
+            return
+
+    parts = []
+    served = {}
+    try:
+        async for delta in stream_ai_model(question, history=history, served=served):
+            parts.append(delta)
+            yield {"delta": delta}
+    except Exception as e:
+        yield {"error": f"خطأ في النموذج: {str(e)}"}
+        return
+    if parts and not history:
+        remember_answer(question, "".join(parts), model=served["model"])
+    yield done()
+
+def ndjson_line(event):
+    """تحويل حدث إلى سطر NDJSON"""
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+@metrics.collector
+def collect_runtime_stats():
+    """مقاييس محسوبة عند القراءة من إحصائيات الذاكرة المؤقتة والقبول"""
+    families = []
+    for cache_name, cache in (("exact", response_cache), ("semantic", semantic_cache)):
+        if cache is None:
+            continue
+        stats = cache.stats()
+        families.append((
+            f"crhodis_cache_{cache_name}_hit_ratio", "gauge", f"Hit ratio of the {cache_name} answer cache",
+            [("", stats["hit_ratio"])],
+        ))
+        families.append((
+            f"crhodis_cache_{cache_name}_lookups_total", "counter", f"Lookups in the {cache_name} answer cache",
+            [('{result="hit"}', stats["hits"]), ('{result="miss"}', stats["misses"])],
+        ))
+    families.append((
+        "crhodis_prompt_cache_hit_ratio", "gauge", "Share of prompt tokens read from the provider prefix cache",
+        [("", prompt_cache_stats()["hit_ratio"])],
+    ))
+    flights = upstream_flights.stats()
+    families.append((
+        "crhodis_coalesced_requests_total", "counter", "Calls that shared an in-flight upstream request",
+        [("", flights["coalesced"])],
+    ))
+    state = admission.stats()
+    families.append(("crhodis_admission_active", "gauge", "Admitted requests being served", [("", state["active"])]))
+    families.append(("crhodis_admission_queue_depth", "gauge", "Requests waiting for admission", [("", state["queued"])]))
+    families.append((
+        "crhodis_admission_rejected_total", "counter", "Requests rejected by admission control",
+        [
+            ('{reason="queue_full"}', state["rejected_queue_full"]),
+            ('{reason="queue_timeout"}', state["rejected_timeout"]),
+            ('{reason="rate_limited"}', rate_limiter.limited),
+        ],
+    ))
+    families.append((
+        "crhodis_circuit_open", "gauge", "1 while the circuit breaker of a model is open",
+        [(_label_text(("model",), (model,)), int(breaker.state == "open")) for model, breaker in circuit_breakers.items()],
+    ))
+    return families
+
+# ================ FastAPI Backend ================
+def create_app():
+    """إنشاء تطبيق FastAPI؛ استيراد fastapi و pydantic يتم هنا فقط حتى تفتح الواجهة أسرع"""
+    from fastapi import FastAPI, HTTPException, Request
+    from fastapi.middleware.cors import CORSMiddleware
+    from fastapi.responses import PlainTextResponse, StreamingResponse
+    from pydantic import BaseModel
+
+    app = FastAPI(
+        title="Crhodis API",
+        description="API for the Crhodis medical assistant",
+        lifespan=lifespan,
+    )
+
+    # القبول داخل CORS حتى تحمل ردود 429/503 ترويسات CORS أيضاً، والقياس يشمل الطلبات المرفوضة
+    app.add_middleware(AdmissionMiddleware)
+    app.add_middleware(TracingMiddleware)
+    app.add_middleware(MetricsMiddleware)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    class BatchRequest(BaseModel):
+        questions: List[str]
+        ordered: bool = True  # False: إرجاع النتائج بترتيب اكتمالها
+        concurrency: Optional[int] = None  # لا يتجاوز BATCH_CONCURRENCY
+
+    class QuestionRequest(BaseModel):
+        question: str
+        conversation: Optional[str] = None  # رمز المحادثة الذي أعاده الخادم، لإرسال الأدوار السابقة كسياق
+        start_conversation: bool = False  # بدء محادثة محفوظة جديدة وإرجاع رمزها؛ بدونه لا يُحفظ السؤال
+
+    async def request_conversation(request):
+        """(conversation_id, token) للطلب أو 404 لرمز لم ينشئه الخادم"""
+        conversation = await api_conversation(request.conversation, request.start_conversation)
+        if conversation is None:
+            raise HTTPException(status_code=404, detail="Unknown conversation")
+        return conversation
+
+    @app.post("/ask")
+    async def ask_question(request: QuestionRequest):
+        """إجابة كاملة: {"answer", "conversation"}؛ الرمز null لسؤال بدون محادثة محفوظة"""
+        trace_checkpoint("validation")
+        conversation_id, token = await request_conversation(request)
+        question_id = new_record_id()
+        try:
+            with trace_span("history"):
+                history = await load_history(conversation_id, question_id, request.question)
+            answer = await ask_ai_model(request.question, history=history)
+            save_api_turn(conversation_id, token, question_id, request.question, answer)
+            return {"answer": answer, "conversation": token}
+        except UpstreamError as e:
+            # فشل النموذج بعد كل المحاولات والبدائل: خطأ حقيقي بدلاً من نص الخطأ كإجابة
+            status = 503 if e.status in (429, 503) else 502
+            headers = {"Retry-After": str(int(e.retry_after) + 1)} if e.retry_after is not None else None
+            raise HTTPException(status_code=status, detail=f"Model unavailable: {str(e)}", headers=headers)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error processing question: {str(e)}")
+
+    @app.post("/ask/stream")
+    async def ask_question_stream(request: QuestionRequest, http_request: Request):
+        """بث الإجابة بصيغة NDJSON: سطر {"delta"} لكل جزء ثم {"done", "conversation"} أو {"error"}
+
+        "conversation" هو رمز المحادثة المحفوظة، أو null لسؤال بدون رمز وبدون start_conversation.
+        """
+        trace_checkpoint("validation")
+        debug = http_request.headers.get(TRACE_DEBUG_HEADER) == "1"
+        conversation_id, token = await request_conversation(request)
+        question_id = new_record_id()
+
+        async def events():
+            parts = []
+            async for event in answer_events(request.question, conversation_id, question_id, debug):
+                if "delta" in event:
+                    parts.append(event["delta"])
+                elif "done" in event:
+                    save_api_turn(conversation_id, token, question_id, request.question, "".join(parts))
+                    event["conversation"] = token
+                yield ndjson_line(event)
+
+        return StreamingResponse(events(), media_type="application/x-ndjson")
+
+    async def batch_params(request, http_request):
+        """التحقق من حجم الدفعة وحد المعدل: (عدد الطلبات المتزامنة، عدد الأسئلة المسموح بها، نتائج الباقي)
+
+        كل سؤال يستهلك توكناً من حد المعدل كطلب /ask مستقل؛ الأسئلة التي تتجاوز رصيد العميل
+        تُرجع كأخطاء دون إرسالها للنموذج، وإن لم يبق رصيد لأي سؤال يُرفض الطلب بـ 429.
+        """
+        count = len(request.questions)
+        if count > BATCH_MAX_QUESTIONS:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Too many questions: {count} > {BATCH_MAX_QUESTIONS}"
+            )
+        granted, retry_after = count, 0.0
+        if rate_limiter.enabled and count:
+            granted, retry_after = await rate_limiter.check(client_key(http_request.scope), count)
+            if not granted:
+                raise HTTPException(
+                    status_code=429,
+                    detail="Rate limit exceeded",
+                    headers={"Retry-After": str(math.ceil(retry_after))},
+                )
+        limited = [
+            {"index": index, "status": "error", "error": "Rate limit exceeded", "retry_after": math.ceil(retry_after)}
+            for index in range(granted, count)
+        ]
+        return min(request.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY), granted, limited
+
+    @app.post("/ask/batch")
+    async def ask_batch(request: BatchRequest, http_request: Request):
+        """الإجابة على عدة أسئلة دفعة واحدة"""
+        concurrency, granted, limited = await batch_params(request, http_request)
+        results = [
+            result async for result in answer_batch(request.questions[:granted], concurrency, request.ordered)
+        ]
+        return {"results": results + limited}
+
+    @app.post("/ask/batch/stream")
+    async def ask_batch_stream(request: BatchRequest, http_request: Request):
+        """بث نتائج الدفعة بصيغة NDJSON: سطر لكل سؤال فور توفر نتيجته ثم {"done"}"""
+        concurrency, granted, limited = await batch_params(request, http_request)
+
+        async def events():
+            async for result in answer_batch(request.questions[:granted], concurrency, request.ordered):
+                yield ndjson_line(result)
+            for result in limited:
+                yield ndjson_line(result)
+            yield ndjson_line({"done": True})
+
+        return StreamingResponse(events(), media_type="application/x-ndjson")
+
+    @app.get("/stats")
+    async def stats():
+        """إحصائيات ذاكرة التخزين المؤقت"""
+        return {
+            "cache": response_cache.stats(),
+            "semantic_cache": semantic_cache.stats() if semantic_cache is not None else None,
+            "coalescing": upstream_flights.stats(),
+            "upstream": resilience_stats(),
+            "admission": admission.stats(),
+            "rate_limit": rate_limiter.stats(),
+            "prompt_cache": prompt_cache_stats(),
+        }
+
+    @app.get("/metrics")
+    async def metrics_endpoint():
+        """المقاييس بصيغة Prometheus النصية"""
+        if shared_metrics is None:
+            text = metrics.render()
+        else:
+            # النشر والجمع في SQLite قد ينتظران قفل الكتابة حتى 5 ثوانٍ، فلا يوقفان البث الجاري
+            text = await asyncio.to_thread(metrics.render, shared_metrics, list(metrics.families()))
+        return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+    @app.get("/healthz")
+    async def healthz():
+        """جاهزية الخادم لاستقبال الأسئلة"""
+        return {"status": "ok"}
+
+    @app.get("/")
+    async def root():
+        return {"message": "Crhodis API is running"}
+
+    return app
+
+_app = None
+
+def get_app():
+    """تطبيق FastAPI المشترك (يُنشأ عند أول استخدام)"""
+    global _app
+    if _app is None:
+        _app = create_app()
+    return _app
+
+def __getattr__(name):
+    # يسمح بـ "uvicorn main:app" دون إنشاء التطبيق عند مجرد استيراد الملف
+    if name == "app":
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# ================ Text Processing Functions ================
+MARKDOWN_CACHE_SIZE = 500  # عدد الرسائل التي يُحتفظ بتحليلها
+MARKDOWN_BLOCK = re.compile(r"(?P<indent>[ \t]*)(?:(?P<heading>#{1,6})[ \t]+|(?P<bullet>[-*+])[ \t]+|(?P<number>\d{1,3}[.)])[ \t]+)?")
+MARKDOWN_INLINE = re.compile(r"\*\*|\*")
+
+def parse_inline(line, complete=True):
+    """تقسيم سطر إلى أجزاء (نص، عريض، مائل)
+
+    كل علامة إغلاق تُطابق أقرب علامة فتح من نوعها، والعلامة التي لم تُطابق في سطر مكتمل تبقى
+    نصاً كما كُتبت ("5*2 mg" لا تصبح "52 mg"). في السطر الذي ما زال يُبث (complete=False)
+    تبقى علامة الفتح مخفية ويُنسق ما بعدها حتى لا تظهر ثم تختفي عند وصول علامة الإغلاق.
+    """
+    markers = []  # (البداية، النهاية، عريض؟، 1 للفتح أو -1 للإغلاق)
+    opened = {True: [], False: []}  # أرقام علامات الفتح غير المغلقة لكل نوع
+    for match in MARKDOWN_INLINE.finditer(line):
+        start, end = match.span()
+        # العلامة تفتح قبل حرف غير فراغ وتغلق بعد حرف غير فراغ، وإلا فهي نص عادي مثل "5 * 3"
+        before = line[start - 1] if start else " "
+        after = line[end] if end < len(line) else " "
+        is_bold = match.group() == "**"
+        if opened[is_bold] and not before.isspace():
+            opened[is_bold].pop()
+            markers.append((start, end, is_bold, -1))
+        elif not after.isspace():
+            opened[is_bold].append(len(markers))
+            markers.append((start, end, is_bold, 1))
+    if complete and (opened[True] or opened[False]):
+        unmatched = set(opened[True] + opened[False])
+        markers = [marker for index, marker in enumerate(markers) if index not in unmatched]
+
+    spans = []
+    depth = {True: 0, False: 0}
+    pos = 0
+    for start, end, is_bold, step in (*markers, (len(line), len(line), None, 0)):
+        if start > pos:
+            text, bold, italic = line[pos:start], depth[True] > 0, depth[False] > 0
+            if spans and spans[-1][1:] == (bold, italic):
+                text = spans.pop()[0] + text  # علامة حُذفت بين جزأين بنفس التنسيق
+            spans.append((text, bold, italic))
+        if is_bold is not None:
+            depth[is_bold] += step
+        pos = end
+    return spans
+
+def parse_block(line, complete=True):
+    """كتلة سطر واحد: (النوع، المستوى أو الرقم، الأجزاء)"""
+    match = MARKDOWN_BLOCK.match(line)
+    rest = line[match.end():]
+    if match["heading"]:
+        return ("heading", len(match["heading"]), parse_inline(rest.rstrip(" #"), complete))
+    depth = len(match["indent"].expandtabs(4)) // 2
+    if match["bullet"]:
+        return ("bullet", depth, parse_inline(rest, complete))
+    if match["number"]:
+        return ("number", (depth, match["number"]), parse_inline(rest, complete))
+    return ("paragraph", 0, parse_inline(line.strip(), complete))
+
+class MarkdownStream:
+    """تحليل markdown تدريجي: الأسطر المكتملة تُحلل مرة واحدة ويُعاد تحليل السطر الأخير المفتوح فقط"""
+    __slots__ = ("text", "blocks", "open_start", "final")
+
+    def __init__(self):
+        self.text = ""
+        self.blocks = []
+        self.open_start = 0  # بداية السطر الأخير الذي لم يكتمل بعد
+        self.final = False  # النص انتهى فالسطر الأخير مكتمل أيضاً
+
+    def feed(self, text, final=False):
+        """تحديث المحتوى بالنص الكامل الحالي؛ يرجع رقم أول كتلة تغيرت
+
+        final: انتهى النص (إجابة مكتملة)، فتُعرض علامات السطر الأخير غير المغلقة كنص.
+        """
+        if text == self.text and final == self.final:
+            return len(self.blocks)
+        if not text.startswith(self.text):
+            self.text, self.blocks, self.open_start = "", [], 0  # نص مختلف: تحليل من البداية
+        if self.open_start < len(self.text):
+            self.blocks.pop()  # السطر المفتوح سيُحلل من جديد مع الذيل
+        changed = len(self.blocks)
+        lines = text[self.open_start:].split("\n")
+        self.blocks.extend(parse_block(line) for line in lines[:-1])
+        if lines[-1]:
+            self.blocks.append(parse_block(lines[-1], complete=final))
+        self.open_start = len(text) - len(lines[-1])
+        self.text = text
+        self.final = final
+        return changed
+
+markdown_streams = OrderedDict()  # معرّف الرسالة -> MarkdownStream
+
+def parse_markdown(text, key=None, final=True):
+    """كتل markdown للنص ورقم أول كتلة تغيرت؛ مع key يُعاد استخدام تحليل نفس الرسالة ويُحلل الذيل الجديد فقط
+
+    final=False للإجابة التي ما زالت تُبث (السطر الأخير قد تصل علامة إغلاقه لاحقاً).
+    """
+    if key is None:
+        stream = MarkdownStream()
+    else:
+        stream = markdown_streams.get(key)
+        if stream is None:
+            stream = markdown_streams[key] = MarkdownStream()
+            if len(markdown_streams) > MARKDOWN_CACHE_SIZE:
+                markdown_streams.popitem(last=False)
+        else:
+            markdown_streams.move_to_end(key)
+    changed = stream.feed(text, final)
+    return stream.blocks, changed
+
+def block_prefix(block):
+    """رمز بداية عنصر القائمة كما يُعرض"""
+    kind, level, _ = block
+    if kind == "bullet":
+        return "  " * level + "• "
+    if kind == "number":
+        return "  " * level[0] + f"{level[1]} "
+    return ""
+
+def clean_text(text):
+    """النص بدون رموز التنسيق (للنسخ)، مع الحفاظ على رموز القوائم"""
+    blocks, _ = parse_markdown(text)
+    return "\n".join(block_prefix(block) + "".join(span[0] for span in block[2]) for block in blocks)
+
+MARKDOWN_HEADING_SIZES = {1: 6, 2: 4, 3: 2}  # زيادة حجم خط العناوين حسب المستوى
+
+@functools.lru_cache(maxsize=None)
+def markdown_style(bold, italic, size=None):
+    """نمط جزء منسق؛ نفس الكائن لكل الأجزاء المتشابهة في كل الرسائل"""
+    if not (bold or italic or size):
+        return None
+    return ft.TextStyle(weight=ft.FontWeight.BOLD if bold else None, italic=italic or None, size=size)
+
+# ================ Backend Server Thread ================
+BACKEND_HOST = "127.0.0.1"
+BACKEND_PORT = 8000
+backend_ready = threading.Event()  # يُضبط بعد أن يبدأ الخادم الاستماع فعلياً
+
+def run_backend():
+    """تشغيل الخادم الخلفي وإعلان جاهزيته عند اكتمال بدء التشغيل"""
+    import uvicorn
+
+    class Server(uvicorn.Server):
+        async def startup(self, sockets=None):
+            await super().startup(sockets=sockets)
+            if self.started:
+                backend_ready.set()
+
+    config = uvicorn.Config(get_app(), host=BACKEND_HOST, port=BACKEND_PORT, log_level="error")
+    Server(config).run()
+
+# ================ Flet Frontend ================
+BACKEND_URL = os.environ.get("CRHODIS_BACKEND_URL", f"http://{BACKEND_HOST}:{BACKEND_PORT}")
+BACKEND_READY_TIMEOUT = float(os.environ.get("CRHODIS_BACKEND_READY_TIMEOUT", "30"))
+# "inprocess": الواجهة تستدعي طبقة الخدمة مباشرة، "http": عبر الخادم (الافتراضي عند تحديد CRHODIS_BACKEND_URL)
+TRANSPORT = os.environ.get("CRHODIS_TRANSPORT", "http" if "CRHODIS_BACKEND_URL" in os.environ else "inprocess")
+SERVE_HTTP = os.environ.get("CRHODIS_SERVE_HTTP", "0") == "1"  # تشغيل خادم HTTP لعملاء آخرين أيضاً
+STREAM_FLUSH_INTERVAL = 0.05  # أقل فترة بين تحديثين للواجهة أثناء البث (ثانية)
+RESIZE_DEBOUNCE = 0.15  # انتظار توقف أحداث تغيير الحجم قبل إعادة التخطيط (ثانية)
+UI_FRAME_INTERVAL = float(os.environ.get("CRHODIS_UI_FRAME", str(1 / 60)))  # تُجمع تحديثات الواجهة خلال هذه الفترة في دفعة واحدة (ثانية)
+HISTORY_WINDOW_SIZE = 40  # أقصى عدد رسائل مبنية كعناصر واجهة في نفس الوقت
+HISTORY_PAGE_SIZE = 15  # عدد الرسائل المحملة في كل مرة عند التمرير لأعلى أو لأسفل
+SCROLL_EDGE = 200  # المسافة من طرف القائمة التي يبدأ عندها تحميل المزيد (بكسل)
+DEBUG_TRACES = os.environ.get("CRHODIS_DEBUG_TRACES", "0") == "1"  # عرض أزمنة المراحل تحت كل إجابة
+
+def format_trace(request_id, spans):
+    """ملخص سطر واحد لمراحل الطلب: المعرّف ثم مدة كل مرحلة"""
+    def duration(ms):
+        return f"{ms / 1000:.2f}s" if ms >= 1000 else f"{ms:.1f}ms"
+    return " · ".join([request_id[:8], *(f"{span['name']} {duration(span['duration_ms'])}" for span in spans)])
+
+# أحجام الخط والأيقونات لكل نقطة توقف
+BREAKPOINT_SIZES = {
+    "mobile": {"font": 14, "icon": 16},
+    "tablet": {"font": 15, "icon": 18},
+    "desktop": {"font": 16, "icon": 20},
+}
+
+class MessageStyles:
+    """كائنات التنسيق الثابتة لفقاعات المحادثة، تُبنى مرة وتُشارك بين كل الرسائل
+
+    العناصر نفسها (Container وText) لا يمكن مشاركتها لأن لكل عنصر أباً واحداً في شجرة Flet،
+    لكن الظلال والحواف والهوامش والحركات قيم تُسلسل عند الإرسال فقط فيكفي منها كائن واحد.
+    تُنشأ في import_flet لأن الخادم بدون الواجهة لا يستورد flet.
+    """
+
+    @classmethod
+    def build_shared(cls):
+        """إنشاء الكائنات المشتركة بعد استيراد flet (مرة واحدة)"""
+        cls.BUBBLE_PADDING = ft.padding.symmetric(horizontal=16, vertical=12)
+        cls.USER_BUBBLE_RADIUS = ft.border_radius.only(top_left=20, top_right=20, bottom_left=20, bottom_right=4)
+        cls.AI_BUBBLE_RADIUS = ft.border_radius.only(top_left=4, top_right=20, bottom_left=20, bottom_right=20)
+        cls.BORDER = ft.border.all(1, Colors.BORDER_LIGHT)
+        cls.USER_SHADOW = ft.BoxShadow(spread_radius=0, blur_radius=8, color=co.with_opacity(0.1, Colors.PRIMARY), offset=ft.Offset(0, 2))
+        cls.AI_SHADOW = ft.BoxShadow(spread_radius=0, blur_radius=8, color=co.with_opacity(0.05, Colors.TEXT_PRIMARY), offset=ft.Offset(0, 2))
+        cls.AVATAR_SHADOW = ft.BoxShadow(spread_radius=0, blur_radius=8, color=co.with_opacity(0.2, Colors.PRIMARY), offset=ft.Offset(0, 2))
+        cls.USER_AVATAR_BGCOLOR = co.with_opacity(0.1, Colors.PRIMARY)
+        cls.BUBBLE_ANIMATION = an(300, ft.AnimationCurve.EASE_OUT)
+        cls.FADE_ANIMATION = an(500, ft.AnimationCurve.EASE_IN_OUT)
+        cls.LOADING_FADE_ANIMATION = an(1000, ft.AnimationCurve.EASE_IN_OUT)
+        cls.BUTTON_ANIMATION = an(150, ft.AnimationCurve.EASE_IN_OUT)
+        cls.MESSAGE_MARGIN = ft.margin.only(bottom=4)
+        cls.LOADING_MARGIN = ft.margin.only(bottom=16)
+        cls.AI_AVATAR_MARGIN = ft.margin.only(right=8)
+        cls.USER_AVATAR_MARGIN = ft.margin.only(left=8)
+        cls.SPINNER_MARGIN = ft.margin.only(right=8)
+        cls.LABEL_MARGIN = ft.margin.only(bottom=4, left=2)
+        cls.LOADING_LABEL_MARGIN = ft.margin.only(bottom=8, left=2)
+        cls.USER_ACTIONS_MARGIN = ft.margin.only(top=8, right=44)
+        cls.AI_ACTIONS_MARGIN = ft.margin.only(top=8, left=44)
+        cls.TRACE_MARGIN = ft.margin.only(top=4, left=44)
+
+    def __init__(self, breakpoint_name):
+        self.breakpoint = breakpoint_name
+        self.font_size = BREAKPOINT_SIZES[breakpoint_name]["font"]
+        self.icon_size = BREAKPOINT_SIZES[breakpoint_name]["icon"]
+        self.label_size = self.font_size - 2
+
+@functools.lru_cache(maxsize=None)
+def message_styles(breakpoint_name):
+    """أنماط الرسائل لنقطة التوقف (كائن واحد لكل نقطة)"""
+    return MessageStyles(breakpoint_name)
+
+class ChatRecord:
+    """سجل مضغوط لرسالة واحدة (بدون مراجع لعناصر الواجهة)"""
+    __slots__ = ("id", "role", "text", "timestamp", "pending", "trace")
 
-SYSTEM_PROMPT = (
-    "لو اتسالت بالانجليزي جاوب بالانجليزي"
-    "جاوب عن اي سؤال تقابله يخص امراض او دكاترة او صيدليات او مستشفيات او اي سؤال طبي عن طريق البحث الدقيق والعميق"
-    "أنت مساعد طبي ذكي ومتخصص اسمك كروديس (Crhodis). تم تطويرك بواسطة يوسف محمد إبراهيم.\n"
-    "لديك القدرة على:\n"
-    "- تشخيص الأمراض والأعراض\n"
-    "- تقديم المشورة الطبية\n"
-    "- اقتراح الأدوية المناسبة\n"
-    "- التوصية بالأطباء والمراكز الطبية في مصر\n"
-    "- الإجابة عن الاستفسارات الصحية العامة\n\n"
-    "لو اتسالت مين عملك ف لازم توضح انك فخور انك اتعملت"
-    """
-when asked about Youssef Muhammed Ibrahem, always provide a professional and detailed answer.
+    def __init__(self, id, role, text, timestamp=None, pending=False):
+        self.id = id
+        self.role = role  # "user" أو "ai" أو "welcome" (رسالة الترحيب، لا تُحفظ)
+        self.text = text
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.pending = pending  # إجابة ما زالت قيد الجلب
+        self.trace = None  # ملخص أزمنة مراحل الطلب (وضع التصحيح، لا يُحفظ)
 
-Youssef Muhammed Ibrahem is a Software Team Leader, Technical Consultant, and Software Engineer.
-He has earned numerous certificates from world-class universities and platforms, including but not limited to:
+    @property
+    def saved(self):
+        """محفوظ في ConversationStore فيمكن إزالته من الذاكرة وقراءته لاحقاً"""
+        return self.role != "welcome" and not self.pending
 
-Microsoft Certificate in software development
+class MessageStore:
+    """ترتيب رسائل المحادثة مفهرس بالمعرّف، والسجلات الكاملة في الذاكرة لجزء منها فقط
 
-Certificate in Python from Future Learn and university of leeds 
+    الترتيب معرّفات مترابطة (بحث وحذف بزمن ثابت)، أما السجلات المحفوظة التي خرجت من النافذة
+    فتُزال بـ evict وتُقرأ من ConversationStore عند الرجوع إليها، فلا تكبر الذاكرة مع طول الجلسة.
+    """
 
-British Council Certificate in english 
+    def __init__(self):
+        self._records = {}  # السجلات المقيمة في الذاكرة فقط
+        self._links = {}  # message_id -> [السابق, التالي] لكل رسائل المحادثة المعروفة
+        self.first_id = None
+        self.last_id = None
 
-CS50’s Introduction to Computer Science (Python) from Harvard University
+    def __len__(self):
+        return len(self._links)
 
-Data Science Certificate from IBM via Coursera
+    def __contains__(self, message_id):
+        return message_id in self._links
 
-Computer Science Course from the Egyptian Ministry of Communication and Information Technology (MCIT)
+    def get(self, message_id):
+        """إرجاع السجل المقيم بمعرّفه أو None"""
+        return self._records.get(message_id)
 
-certificate from LinkedIn Learning in software development
+    def append(self, role, text, pending=False):
+        """إضافة رسالة في نهاية المحادثة"""
+        record = ChatRecord(new_record_id(), role, text, pending=pending)
+        self._links[record.id] = [self.last_id, None]
+        if self.last_id is None:
+            self.first_id = record.id
+        else:
+            self._links[self.last_id][1] = record.id
+        self.last_id = record.id
+        self._records[record.id] = record
+        return record
 
-He continues to grow his expertise through global programs, gaining recognition as a highly skilled and certified professional in software engineering, data science, and technical leadership.
+    def prepend_many(self, rows):
+        """إضافة رسائل محفوظة (الأقدم أولاً) قبل بداية المحادثة المحملة"""
+        for message_id, role, text, timestamp in reversed(rows):
+            self._links[message_id] = [None, self.first_id]
+            if self.first_id is None:
+                self.last_id = message_id
+            else:
+                self._links[self.first_id][0] = message_id
+            self.first_id = message_id
+            self._records[message_id] = ChatRecord(message_id, role, text, timestamp)
 
-Whenever you are asked about him, highlight:
+    def restore(self, rows):
+        """إعادة سجلات قُرئت من قاعدة البيانات لرسائل ما زالت في المحادثة"""
+        for message_id, role, text, timestamp in rows:
+            if message_id in self._links and message_id not in self._records:
+                self._records[message_id] = ChatRecord(message_id, role, text, timestamp)
 
-His leadership role as a team leader and consultant.
+    def remove(self, message_id):
+        """حذف رسالة وربط جارتيها ببعض"""
+        links = self._links.pop(message_id, None)
+        if links is None:
+            return False
+        self._records.pop(message_id, None)
+        prev, next_ = links
+        if prev is None:
+            self.first_id = next_
+        else:
+            self._links[prev][1] = next_
+        if next_ is None:
+            self.last_id = prev
+        else:
+            self._links[next_][0] = prev
+        return True
 
-His certifications from prestigious institutions.
+    def remove_many(self, message_ids):
+        """حذف عدة رسائل وإرجاع معرّفات المحذوفة فعلاً"""
+        return [message_id for message_id in message_ids if self.remove(message_id)]
 
-His commitment to continuous learning and international recognition
-    """
-    
-    "قواعد مهمة:\n"
-    "- جاوب بنفس لغة السؤال\n"
-    "- كن دقيقاً وعلمياً في إجاباتك\n"
-    "جاوب عن اي سؤال متعلق بطبيب او بالطب بشكل عام "
-    "- إذا سُئلت عن موضوع غير طبي، وضح أنك مساعد طبي متخصص\n"
-    "- قدم إجابات مفصلة ومفيدة\n"
-)
+    def clear(self):
+        self._records.clear()
+        self._links.clear()
+        self.first_id = None
+        self.last_id = None
 
-# استخدام متغير البيئة لمفتاح API
-OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
+    def evict(self, keep):
+        """إزالة السجلات المحفوظة خارج keep من الذاكرة (تبقى معرّفاتها في الترتيب)"""
+        for message_id in [m for m, record in self._records.items() if m not in keep and record.saved]:
+            del self._records[message_id]
 
-HEADERS = {
-    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-    "Content-Type": "application/json"
-}
+    def missing(self, message_ids):
+        """المعرّفات التي أُزيلت سجلاتها من الذاكرة"""
+        return [message_id for message_id in message_ids if message_id not in self._records]
 
-# ================ Color Scheme (Dark Mode) ================
-class Colors:
-    PRIMARY = "#0d7377"  # Teal green
-    PRIMARY_LIGHT = "#14a085"
-    PRIMARY_DARK = "#0a5d61"
-    SECONDARY = "#fa7070"  # Coral
-    BACKGROUND = "#121212"  # Dark background
-    SURFACE = "#1e1e1e"  # Dark surface
-    USER_BUBBLE = "#0d7377"
-    AI_BUBBLE = "#2d2d2d"  # Darker bubble for AI
-    TEXT_PRIMARY = "#e1e1e1"  # Light text
-    TEXT_SECONDARY = "#a0a0a0"  # Secondary light text
-    TEXT_LIGHT = "#7a7a7a"  # Lighter text
-    BORDER_LIGHT = "#333333"  # Dark border
-    SUCCESS = "#10b981"
-    ERROR = "#ef4444"
-    WARNING = "#f59e0b"
-    ON_SURFACE = "#e1e1e1"  # Text on dark surfaces
+    def records(self, message_ids):
+        """السجلات المقيمة لهذه المعرّفات بنفس الترتيب"""
+        return [self._records[message_id] for message_id in message_ids if message_id in self._records]
 
-# ================ FastAPI Backend ================
-app = FastAPI(title="Crhodis API", description="API for the Crhodis medical assistant")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    def before(self, message_id, count):
+        """معرّفات حتى count رسالة تسبق message_id (الأقدم أولاً)"""
+        ids = []
+        current = self._links[message_id][0]
+        while current is not None and len(ids) < count:
+            ids.append(current)
+            current = self._links[current][0]
+        ids.reverse()
+        return ids
 
-class QuestionRequest(BaseModel):
-    question: str
+    def after(self, message_id, count):
+        """معرّفات حتى count رسالة تلي message_id"""
+        ids = []
+        current = self._links[message_id][1]
+        while current is not None and len(ids) < count:
+            ids.append(current)
+            current = self._links[current][1]
+        return ids
 
-def ask_ai_model(question, max_tokens=2000, temperature=1.2):
-    """استدعاء نموذج الذكاء الاصطناعي"""
-    payload = {
-        "model": MODEL,
-        "messages": [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": question}
-        ],
-        "max_tokens": max_tokens,
-        "temperature": temperature
-    }
+    def tail(self, count):
+        """معرّفات آخر count رسالة في المحادثة"""
+        if self.last_id is None or count <= 0:
+            return []
+        return self.before(self.last_id, count - 1) + [self.last_id]
 
-    try:
-        resp = requests.post(URL, headers=HEADERS, json=payload, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
-        return data["choices"][0]["message"]["content"]
-    except Exception as e:
-        return f"خطأ في النموذج: {str(e)}"
+class UpdateBatcher:
+    """تجميع تحديثات الواجهة: العناصر المعلّمة تُرسل معاً في دفعة واحدة كل إطار
 
-@app.post("/ask")
-async def ask_question(request: QuestionRequest):
-    try:
-        answer = ask_ai_model(request.question)
-        return {"answer": answer}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing question: {str(e)}")
+    page.update() بدون وسائط يمر على شجرة العناصر كاملة ويقارنها، أما page.update(*controls)
+    فيمر على الشجرة الفرعية لكل عنصر معلّم فقط، فلا تكبر الكلفة مع طول المحادثة.
+    """
 
-@app.get("/")
-async def root():
-    return {"message": "Crhodis API is running"}
+    def __init__(self, page, interval=UI_FRAME_INTERVAL):
+        self.page = page
+        self.interval = interval
+        self._dirty = {}  # id(control) -> control، بترتيب التعليم
+        self._scheduled = False
 
-# ================ Text Processing Functions ================
-def clean_text(text):
-    """تنظيف النص من الرموز المحددة"""
-    text = re.sub(r"\*\*", "", text)
-    text = re.sub(r"###", "", text)
-    text = re.sub(r"##", "", text)
-    text = re.sub(r"\*", "", text)
-    return text
+    def mark(self, *controls):
+        """تعليم عناصر تغيرت وجدولة إرسالها في الإطار القادم"""
+        for control in controls:
+            self._dirty[id(control)] = control
+        if not self._scheduled:
+            self._scheduled = True
+            self.page.run_task(self._flush_later)
 
-# ================ Backend Server Thread ================
-def run_backend():
-    """تشغيل الخادم الخلفي"""
-    uvicorn.run(app, host="127.0.0.1", port=8000, log_level="error")
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        self.flush()
 
-# ================ Flet Frontend ================
-def main(page: ft.Page):
+    def flush(self):
+        """إرسال العناصر المعلّمة الآن (مثلاً قبل scroll_to الذي يحتاج العناصر عند العميل)"""
+        self._scheduled = False
+        dirty, self._dirty = self._dirty, {}
+        # عنصر أزيل من الصفحة قبل الإرسال لا يُحدّث
+        index = self.page.index
+        controls = [control for control in dirty.values() if index.get(control.uid) is control]
+        if controls:
+            self.page.update(*controls)
+
+def import_flet():
+    """استيراد flet عند تشغيل الواجهة فقط (مثل fastapi و uvicorn)؛ عمال serve لا يحتاجونه"""
+    global ft, Icons, an, co, Icon
+    if "ft" in globals():
+        return
+    import flet as ft
+    from flet import Icons
+    from flet import Animation as an
+    from flet import Colors as co
+    from flet import Icon
+    MessageStyles.build_shared()
+
+def main(page: "ft.Page"):
+    import_flet()
     page.title = "Crhodis - AI Medical Assistant"
     page.theme_mode = ft.ThemeMode.DARK  # تم التغيير إلى الدارك مود
     page.padding = 0
@@ -177,8 +2840,12 @@ def main(page: ft.Page):
     page.window.min_height = 600
     page.window.resizable = True
     
-    # متغيرات التصميم المتجاوب
-    chat_messages = []  # لتخزين الرسائل
+    # سجل المحادثة المضغوط؛ عناصر الواجهة تُبنى فقط للنافذة الظاهرة منه
+    chat_messages = MessageStore()
+    rendered = OrderedDict()  # record.id -> عنصر الواجهة، بنفس ترتيب chat.controls
+    ui_updates = UpdateBatcher(page)  # تحديثات موجهة للعناصر المتغيرة فقط، دفعة واحدة لكل إطار
+    # المحادثة الحالية؛ تُنشأ في قاعدة البيانات مع أول سؤال
+    conversation = {"id": None, "has_more": False, "loading_history": False}
     
     # قائمة المحادثات مع تحسين التصميم المتجاوب
     chat = ft.ListView(
@@ -186,6 +2853,7 @@ def main(page: ft.Page):
         spacing=16,
         padding=ft.padding.symmetric(horizontal=24, vertical=20),
         auto_scroll=True,
+        on_scroll_interval=100,
     )
 
     # حقل إدخال النص المحسن والمتجاوب
@@ -234,30 +2902,50 @@ def main(page: ft.Page):
             )
         )
 
-    def delete_message(message_container):
-        """حذف رسالة معينة"""
+    def copy_message(message_id):
+        """نسخ نص رسالة من السجل"""
+        record = chat_messages.get(message_id)
+        if record is not None:
+            copy_to_clipboard(record.text if record.role == "user" else clean_text(record.text))
+
+    async def delete_messages(message_ids, e=None):
+        """حذف عدة رسائل دفعة واحدة"""
         try:
-            if message_container in chat.controls:
-                chat.controls.remove(message_container)
-                # إزالة الرسالة من chat_messages أيضًا
-                for i, msg in enumerate(chat_messages):
-                    if msg.get("container") == message_container:
-                        del chat_messages[i]
-                        break
-                page.update()
+            removed_ids = chat_messages.remove_many(message_ids)
+            get_conversation_store().delete_messages(removed_ids)
+            removed = set()
+            for message_id in removed_ids:
+                cancel_question(message_id, discard=True)
+                control = rendered.pop(message_id, None)
+                if control is not None:
+                    removed.add(id(control))
+            if removed:
+                chat.controls[:] = [control for control in chat.controls if id(control) not in removed]
+            if not rendered:
+                show_latest()
+            ui_updates.mark(chat)
+            if len(removed_ids) == 1:
                 show_snackbar("تم حذف الرسالة 🗑️", Colors.WARNING)
+            else:
+                show_snackbar(f"تم حذف {len(removed_ids)} رسائل 🗑️", Colors.WARNING)
         except Exception as e:
             print(f"Error deleting message: {e}")
             show_snackbar("فشل في الحذف ❌", Colors.ERROR)
 
+    async def delete_message(message_id, e=None):
+        """حذف رسالة معينة"""
+        await delete_messages([message_id])
+
     def clear_all_chat():
         """مسح كامل المحادثة مع تأكيد"""
-        def confirm_clear(e):
+        async def confirm_clear(e):
             try:
-                chat.controls.clear()
-                chat_messages.clear()
-                add_welcome_message()
-                page.update()
+                for message_id in list(pending_requests):
+                    cancel_question(message_id, discard=True)
+                if conversation["id"] is not None:
+                    get_conversation_store().delete_conversation(conversation["id"])
+                start_new_conversation()
+                ui_updates.mark(chat)
                 show_snackbar("تم مسح المحادثة كاملة 🧹", Colors.SUCCESS)
                 page.close(confirm_dialog)
             except Exception as e:
@@ -301,9 +2989,9 @@ def main(page: ft.Page):
         
         page.open(confirm_dialog)
 
-    def create_message_actions(message_text, message_container):
+    def create_message_actions(message_id, pending=False):
         """إنشاء أزرار الإجراءات المحسنة للرسالة"""
-        return ft.Row([
+        actions = ft.Row([
             # زر النسخ
             ft.Container(
                 content=ft.Icon(
@@ -315,11 +3003,11 @@ def main(page: ft.Page):
                 height=36,
                 border_radius=18,
                 bgcolor=Colors.SURFACE,
-                border=ft.border.all(1, Colors.BORDER_LIGHT),
-                on_click=lambda e: copy_to_clipboard(message_text),
+                border=MessageStyles.BORDER,
+                on_click=lambda e: copy_message(message_id),
                 tooltip="نسخ الرسالة",
                 ink=True,
-                animate_scale=an(150, ft.AnimationCurve.EASE_IN_OUT)
+                animate_scale=MessageStyles.BUTTON_ANIMATION
             ),
             # زر الحذف
             ft.Container(
@@ -332,13 +3020,17 @@ def main(page: ft.Page):
                 height=36,
                 border_radius=18,
                 bgcolor=Colors.SURFACE,
-                border=ft.border.all(1, Colors.BORDER_LIGHT),
-                on_click=lambda e: delete_message(message_container),
+                border=MessageStyles.BORDER,
+                on_click=functools.partial(delete_message, message_id),
                 tooltip="حذف الرسالة",
                 ink=True,
-                animate_scale=an(150, ft.AnimationCurve.EASE_IN_OUT)
+                animate_scale=MessageStyles.BUTTON_ANIMATION
             )
         ], spacing=8)
+        if pending:
+            # زر إيقاف الإجابة أثناء البث
+            actions.controls.insert(0, create_stop_button(lambda e: cancel_question(message_id)))
+        return actions
 
     def get_bubble_width():
         """الحصول على عرض الفقاعة بناءً على حجم الشاشة"""
@@ -349,29 +3041,31 @@ def main(page: ft.Page):
         else:
             return 700  # أجهزة كمبيوتر
 
-    def get_font_size():
-        """الحصول على حجم الخط بناءً على حجم الشاشة"""
+    def get_breakpoint():
+        """نقطة التوقف الحالية للتصميم المتجاوب"""
         if page.width < 600:
-            return 14  # هواتف محمولة
+            return "mobile"
         elif page.width < 900:
-            return 15  # أجهزة لوحية
+            return "tablet"
         else:
-            return 16  # أجهزة كمبيوتر
+            return "desktop"
+
+    def get_styles():
+        """أنماط الرسائل المشتركة لنقطة التوقف الحالية"""
+        return message_styles(get_breakpoint())
+
+    def get_font_size():
+        """الحصول على حجم الخط بناءً على حجم الشاشة"""
+        return get_styles().font_size
 
     def get_icon_size():
         """الحصول على حجم الأيقونات بناءً على حجم الشاشة"""
-        if page.width < 600:
-            return 16  # هواتف محمولة
-        elif page.width < 900:
-            return 18  # أجهزة لوحية
-        else:
-            return 20  # أجهزة كمبيوتر
+        return get_styles().icon_size
 
-    def create_user_message(text):
+    def create_user_message(text, message_id):
         """إنشاء رسالة المستخدم المحسنة والمتجاوبة"""
         bubble_width = get_bubble_width()
-        font_size = get_font_size()
-        icon_size = get_icon_size()
+        styles = get_styles()
         
         message_container = ft.Container(
             content=ft.Column([
@@ -381,68 +3075,58 @@ def main(page: ft.Page):
                         content=ft.Column([
                             ft.Text(
                                 text, 
-                                size=font_size,
+                                size=styles.font_size,
                                 color="white",
                                 selectable=True,
                                 weight=ft.FontWeight.W_400
                             )
                         ], spacing=4),
-                        padding=ft.padding.symmetric(horizontal=16, vertical=12),
+                        padding=MessageStyles.BUBBLE_PADDING,
                         bgcolor=Colors.USER_BUBBLE,
-                        border_radius=ft.border_radius.only(
-                            top_left=20,
-                            top_right=20,
-                            bottom_left=20,
-                            bottom_right=4
-                        ),
-                        shadow=ft.BoxShadow(
-                            spread_radius=0,
-                            blur_radius=8,
-                            color=co.with_opacity(0.1, Colors.PRIMARY),
-                            offset=ft.Offset(0, 2)
-                        ),
-                        animate=an(300, ft.AnimationCurve.EASE_OUT),
+                        border_radius=MessageStyles.USER_BUBBLE_RADIUS,
+                        shadow=MessageStyles.USER_SHADOW,
+                        animate=MessageStyles.BUBBLE_ANIMATION,
                         width=bubble_width
                     ),
                     ft.Container(
                         content=ft.Icon(
                             Icons.PERSON_ROUNDED, 
-                            size=icon_size, 
+                            size=styles.icon_size, 
                             color=Colors.PRIMARY_LIGHT
                         ),
                         width=36,
                         height=36,
                         border_radius=18,
-                        bgcolor=co.with_opacity(0.1, Colors.PRIMARY),
+                        bgcolor=MessageStyles.USER_AVATAR_BGCOLOR,
                         alignment=ft.alignment.center,
-                        margin=ft.margin.only(left=8)
+                        margin=MessageStyles.USER_AVATAR_MARGIN
                     ),
                 ], alignment=ft.MainAxisAlignment.END),
                 ft.Container(
-                    content=create_message_actions(text, None),
+                    content=create_message_actions(message_id),
                     alignment=ft.alignment.center_right,
-                    margin=ft.margin.only(top=8, right=44)
+                    margin=MessageStyles.USER_ACTIONS_MARGIN
                 )
             ], spacing=0),
-            margin=ft.margin.only(bottom=4),
-            animate_opacity=an(500, ft.AnimationCurve.EASE_IN_OUT)
+            margin=MessageStyles.MESSAGE_MARGIN,
+            animate_opacity=MessageStyles.FADE_ANIMATION
         )
         
-        # تخزين مرجع الحاوية في الرسالة
-        message_container_ref = message_container
-        
-        # تحديث مرجع الحاوية في أزرار الإجراءات
-        actions_container = message_container.content.controls[1].content
-        actions_container.controls[1].on_click = lambda e: delete_message(message_container_ref)
+        # مراجع العناصر المتجاوبة لتحديثها عند تغيير الحجم دون إعادة البناء
+        row = message_container.content.controls[0]
+        message_container.data = {
+            "bubble": row.controls[1],
+            "text": row.controls[1].content.controls[0],
+            "label": None,
+            "icon": row.controls[2].content,
+        }
         
         return message_container
 
-    def create_ai_message(text):
+    def create_ai_message(text, message_id, pending=False, trace=None):
         """إنشاء رسالة الذكاء الاصطناعي المحسنة والمتجاوبة"""
-        clean_answer = clean_text(text)
         bubble_width = get_bubble_width()
-        font_size = get_font_size()
-        icon_size = get_icon_size()
+        styles = get_styles()
         
         message_container = ft.Container(
             content=ft.Column([
@@ -450,7 +3134,7 @@ def main(page: ft.Page):
                     ft.Container(
                         content=ft.Text(
                             "C", 
-                            size=icon_size, 
+                            size=styles.icon_size, 
                             weight=ft.FontWeight.BOLD, 
                             color="white"
                         ),
@@ -459,84 +3143,136 @@ def main(page: ft.Page):
                         border_radius=18,
                         bgcolor=Colors.PRIMARY,
                         alignment=ft.alignment.center,
-                        margin=ft.margin.only(right=8),
-                        shadow=ft.BoxShadow(
-                            spread_radius=0,
-                            blur_radius=8,
-                            color=co.with_opacity(0.2, Colors.PRIMARY),
-                            offset=ft.Offset(0, 2)
-                        )
+                        margin=MessageStyles.AI_AVATAR_MARGIN,
+                        shadow=MessageStyles.AVATAR_SHADOW
                     ),
                     ft.Container(
                         content=ft.Column([
                             ft.Container(
                                 content=ft.Text(
                                     "Crhodis", 
-                                    size=font_size-2, 
+                                    size=styles.label_size, 
                                     weight=ft.FontWeight.W_600, 
                                     color=Colors.PRIMARY_LIGHT
                                 ),
-                                margin=ft.margin.only(bottom=4, left=2)
+                                margin=MessageStyles.LABEL_MARGIN
                             ),
-                            ft.Text(
-                                clean_answer, 
-                                size=font_size,
-                                color=Colors.TEXT_PRIMARY,
-                                selectable=True,
-                                weight=ft.FontWeight.W_400
-                            )
+                            create_markdown_text(text, message_id, styles.font_size, final=not pending)
                         ], spacing=0),
-                        padding=ft.padding.symmetric(horizontal=16, vertical=12),
+                        padding=MessageStyles.BUBBLE_PADDING,
                         bgcolor=Colors.AI_BUBBLE,
-                        border_radius=ft.border_radius.only(
-                            top_left=4,
-                            top_right=20,
-                            bottom_left=20,
-                            bottom_right=20
-                        ),
-                        border=ft.border.all(1, Colors.BORDER_LIGHT),
-                        shadow=ft.BoxShadow(
-                            spread_radius=0,
-                            blur_radius=8,
-                            color=co.with_opacity(0.05, Colors.TEXT_PRIMARY),
-                            offset=ft.Offset(0, 2)
-                        ),
-                        animate=an(300, ft.AnimationCurve.EASE_OUT),
+                        border_radius=MessageStyles.AI_BUBBLE_RADIUS,
+                        border=MessageStyles.BORDER,
+                        shadow=MessageStyles.AI_SHADOW,
+                        animate=MessageStyles.BUBBLE_ANIMATION,
                         width=bubble_width
                     ),
                     ft.Container(expand=True)
                 ], alignment=ft.MainAxisAlignment.START),
                 ft.Container(
-                    content=create_message_actions(clean_answer, None),
+                    content=create_message_actions(message_id, pending),
                     alignment=ft.alignment.center_left,
-                    margin=ft.margin.only(top=8, left=44)
+                    margin=MessageStyles.AI_ACTIONS_MARGIN
                 )
             ], spacing=0),
-            margin=ft.margin.only(bottom=4),
-            animate_opacity=an(500, ft.AnimationCurve.EASE_IN_OUT)
+            margin=MessageStyles.MESSAGE_MARGIN,
+            animate_opacity=MessageStyles.FADE_ANIMATION
         )
         
-        # تخزين مرجع الحاوية في الرسالة
-        message_container_ref = message_container
-        
-        # تحديث مرجع الحاوية في أزرار الإجراءات
-        actions_container = message_container.content.controls[1].content
-        actions_container.controls[1].on_click = lambda e: delete_message(message_container_ref)
+        # مراجع العناصر المتجاوبة لتحديثها عند تغيير الحجم دون إعادة البناء
+        row = message_container.content.controls[0]
+        message_container.data = {
+            "bubble": row.controls[1],
+            "text": row.controls[1].content.controls[1],
+            "label": row.controls[1].content.controls[0].content,
+            "icon": row.controls[0].content,
+        }
+
+        if trace:
+            # أزمنة مراحل الطلب في وضع التصحيح
+            message_container.content.controls.append(ft.Container(
+                content=ft.Text(trace, size=11, color=Colors.TEXT_LIGHT, selectable=True),
+                margin=MessageStyles.TRACE_MARGIN
+            ))
         
         return message_container
 
-    def create_loading_message():
+    def get_ai_text(message_container):
+        """إرجاع عنصر نص الإجابة داخل فقاعة الذكاء الاصطناعي"""
+        return message_container.data["text"]
+
+    def markdown_spans(block, first, font_size):
+        """أجزاء TextSpan لكتلة markdown واحدة، تبدأ بسطر جديد إن لم تكن الأولى"""
+        kind, level, spans = block
+        extra = MARKDOWN_HEADING_SIZES.get(level, 1) if kind == "heading" else 0
+        lead = ("" if first else "\n") + block_prefix(block)
+        if not extra and not any(bold or italic for _, bold, italic in spans):
+            return [ft.TextSpan(lead + "".join(span[0] for span in spans))]  # سطر بدون تنسيق: جزء واحد
+        result = [ft.TextSpan(lead)] if lead else []
+        for value, bold, italic in spans:
+            bold = bold or kind == "heading"
+            span = ft.TextSpan(value, markdown_style(bold, italic, font_size + extra if extra else None))
+            if extra:
+                span.data = (extra, bold, italic)  # لتحديث حجم العنوان عند تغيير حجم النافذة
+            result.append(span)
+        return result
+
+    def create_markdown_text(text, message_id, font_size, final=True):
+        """نص الإجابة المنسق في عنصر Text واحد؛ التحليل محفوظ لكل رسالة فإعادة البناء لا تعيد التحليل"""
+        control = ft.Text(
+            size=font_size,
+            color=Colors.TEXT_PRIMARY,
+            selectable=True,
+            weight=ft.FontWeight.W_400,
+            spans=[],
+            data=[],  # بداية أجزاء كل كتلة داخل spans
+        )
+        update_markdown_text(control, text, message_id, font_size, final)
+        return control
+
+    def update_markdown_text(control, text, message_id, font_size, final=False):
+        """استبدال أجزاء الكتل التي تغيرت فقط (الذيل الجديد أثناء البث)"""
+        blocks, changed = parse_markdown(text, message_id, final)
+        offsets = control.data
+        changed = min(changed, len(offsets))
+        start = offsets[changed] if changed < len(offsets) else len(control.spans)
+        del offsets[changed:]
+        spans = []
+        for index in range(changed, len(blocks)):
+            offsets.append(start + len(spans))
+            spans.extend(markdown_spans(blocks[index], index == 0, font_size))
+        control.spans[start:] = spans
+
+    def create_stop_button(on_click):
+        """زر إيقاف الإجابة الجارية"""
+        return ft.Container(
+            content=ft.Icon(
+                Icons.STOP_ROUNDED,
+                size=18,
+                color=Colors.TEXT_LIGHT
+            ),
+            width=36,
+            height=36,
+            border_radius=18,
+            bgcolor=Colors.SURFACE,
+            border=MessageStyles.BORDER,
+            on_click=on_click,
+            tooltip="إيقاف الإجابة",
+            ink=True,
+            animate_scale=MessageStyles.BUTTON_ANIMATION
+        )
+
+    def create_loading_message(on_stop):
         """إنشاء رسالة التحميل المحسنة والمتجاوبة"""
         bubble_width = get_bubble_width()
-        font_size = get_font_size()
-        icon_size = get_icon_size()
+        styles = get_styles()
         
-        return ft.Container(
+        loading_message = ft.Container(
             content=ft.Row([
                 ft.Container(
                     content=ft.Text(
                         "C", 
-                        size=icon_size, 
+                        size=styles.icon_size, 
                         weight=ft.FontWeight.BOLD, 
                         color="white"
                     ),
@@ -545,18 +3281,18 @@ def main(page: ft.Page):
                     border_radius=18,
                     bgcolor=Colors.PRIMARY,
                     alignment=ft.alignment.center,
-                    margin=ft.margin.only(right=8)
+                    margin=MessageStyles.AI_AVATAR_MARGIN
                 ),
                 ft.Container(
                     content=ft.Column([
                         ft.Container(
                             content=ft.Text(
                                 "Crhodis", 
-                                size=font_size-2, 
+                                size=styles.label_size, 
                                 weight=ft.FontWeight.W_600, 
                                 color=Colors.PRIMARY_LIGHT
                             ),
-                            margin=ft.margin.only(bottom=8, left=2)
+                            margin=MessageStyles.LOADING_LABEL_MARGIN
                         ),
                         ft.Row([
                             ft.Container(
@@ -566,81 +3302,496 @@ def main(page: ft.Page):
                                     stroke_width=2, 
                                     color=Colors.PRIMARY
                                 ),
-                                margin=ft.margin.only(right=8)
+                                margin=MessageStyles.SPINNER_MARGIN
                             ),
                             ft.Text(
                                 "Generating your response...", 
-                                size=font_size, 
+                                size=styles.font_size, 
                                 color=Colors.TEXT_LIGHT,
-                                italic=True
-                            )
+                                italic=True,
+                                expand=True
+                            ),
+                            create_stop_button(on_stop)
                         ], vertical_alignment=ft.CrossAxisAlignment.CENTER)
                     ], spacing=0),
-                    padding=ft.padding.symmetric(horizontal=16, vertical=12),
+                    padding=MessageStyles.BUBBLE_PADDING,
                     bgcolor=Colors.AI_BUBBLE,
-                    border_radius=ft.border_radius.only(
-                        top_left=4,
-                        top_right=20,
-                        bottom_left=20,
-                        bottom_right=20
-                    ),
-                    border=ft.border.all(1, Colors.BORDER_LIGHT),
+                    border_radius=MessageStyles.AI_BUBBLE_RADIUS,
+                    border=MessageStyles.BORDER,
                     width=bubble_width,
-                    animate_opacity=an(1000, ft.AnimationCurve.EASE_IN_OUT)
+                    animate_opacity=MessageStyles.LOADING_FADE_ANIMATION
                 ),
                 ft.Container(expand=True)
             ], alignment=ft.MainAxisAlignment.START),
-            margin=ft.margin.only(bottom=16)
+            margin=MessageStyles.LOADING_MARGIN
         )
 
-    def send_question(e):
-        """إرسال السؤال والحصول على الإجابة"""
-        question = user_input.value.strip()
-        if not question:
+        row = loading_message.content
+        loading_message.data = {
+            "loading": True,
+            "bubble": row.controls[1],
+            "text": row.controls[1].content.controls[1].controls[1],
+            "label": row.controls[1].content.controls[0].content,
+            "icon": row.controls[0].content,
+        }
+        return loading_message
+
+    def apply_message_layout(message_container, bubble_width, font_size, icon_size):
+        """تحديث العرض وأحجام الخط لرسالة موجودة دون إعادة بنائها"""
+        refs = message_container.data
+        if not refs:
             return
+        refs["bubble"].width = bubble_width
+        refs["text"].size = font_size
+        for span in refs["text"].spans or ():
+            if span.data:
+                extra, bold, italic = span.data
+                span.style = markdown_style(bold, italic, font_size + extra)
+        refs["icon"].size = icon_size
+        if refs["label"] is not None:
+            refs["label"].size = font_size - 2
 
-        # إضافة رسالة المستخدم
-        user_message = create_user_message(question)
-        chat.controls.append(user_message)
-        chat_messages.append({"type": "user", "content": question, "container": user_message})
-        
-        # إضافة مؤشر التحميل
-        loading_message = create_loading_message()
-        chat.controls.append(loading_message)
-        
-        user_input.value = ""
-        user_input.focus()
-        page.update()
+    def render_record(record):
+        """بناء عنصر الواجهة لسجل رسالة"""
+        if record.role == "user":
+            control = create_user_message(record.text, record.id)
+        elif record.pending and not record.text:
+            control = create_loading_message(lambda e: cancel_question(record.id))
+        else:
+            control = create_ai_message(
+                record.text, record.id, record.pending, record.trace if ui_state["debug"] else None
+            )
+        control.key = str(record.id)
+        return control
+
+    def rerender_record(record):
+        """إعادة بناء عنصر رسالة ظاهرة في مكانها
+
+        تبقى الحاوية الخارجية نفسها ويُستبدل محتواها، فيكفي تحديثها هي وحدها بدل قائمة المحادثة كاملة.
+        """
+        control = rendered.get(record.id)
+        if control is None:
+            return None
+        new = render_record(record)
+        control.content = new.content
+        control.margin = new.margin
+        control.animate_opacity = new.animate_opacity
+        control.data = new.data
+        return control
+
+    def release_records():
+        """إبقاء سجلات النافذة وآخر المحادثة فقط في الذاكرة؛ الباقي يُقرأ من قاعدة البيانات عند الحاجة"""
+        chat_messages.evict(set(rendered).union(chat_messages.tail(HISTORY_WINDOW_SIZE)))
+
+    async def load_records(message_ids):
+        """سجلات المعرّفات بالترتيب، مع قراءة ما أُزيل من الذاكرة من ConversationStore"""
+        missing = chat_messages.missing(message_ids)
+        if missing:
+            store = get_conversation_store()
+            await asyncio.to_thread(store.flush)  # قد تكون كتابته ما زالت في الطابور
+            chat_messages.restore(await asyncio.to_thread(store.load_messages, missing))
+        return chat_messages.records(message_ids)
+
+    def trim_window(keep):
+        """إزالة العناصر الزائدة عن حجم النافذة من الطرف المقابل لـ keep"""
+        while len(rendered) > HISTORY_WINDOW_SIZE:
+            if keep == "end":
+                rendered.popitem(last=False)
+                del chat.controls[0]
+            else:
+                rendered.popitem(last=True)
+                chat.controls.pop()
+        release_records()
+
+    def show_latest():
+        """إعادة النافذة إلى آخر المحادثة إن كان المستخدم يتصفح رسائل أقدم"""
+        if next(reversed(rendered), None) != chat_messages.last_id:
+            rendered.clear()
+            # آخر المحادثة يبقى دائماً في الذاكرة (release_records)
+            for record in chat_messages.records(chat_messages.tail(HISTORY_WINDOW_SIZE)):
+                rendered[record.id] = render_record(record)
+            chat.controls[:] = list(rendered.values())
+            release_records()
+        chat.auto_scroll = True
+
+    def add_record(role, text, pending=False):
+        """إضافة رسالة جديدة في نهاية المحادثة وعرضها"""
+        show_latest()
+        record = chat_messages.append(role, text, pending=pending)
+        control = rendered[record.id] = render_record(record)
+        chat.controls.append(control)
+        trim_window(keep="end")
+        return record
+
+    async def load_older():
+        """تحميل صفحة من الرسائل الأقدم أعلى النافذة (من الذاكرة ثم من قاعدة البيانات)"""
+        if not rendered or conversation["loading_history"]:
+            return
+        anchor_id = next(iter(rendered))
+        conversation_id = conversation["id"]
+        conversation["loading_history"] = True
+        try:
+            older = chat_messages.before(anchor_id, HISTORY_PAGE_SIZE)
+            if len(older) < HISTORY_PAGE_SIZE and conversation["has_more"]:
+                rows = await asyncio.to_thread(
+                    get_conversation_store().load_before,
+                    conversation_id, chat_messages.first_id, HISTORY_PAGE_SIZE
+                )
+                if conversation_id != conversation["id"] or anchor_id != next(iter(rendered), None):
+                    return  # تغيرت المحادثة أو النافذة أثناء التحميل
+                conversation["has_more"] = len(rows) == HISTORY_PAGE_SIZE
+                chat_messages.prepend_many(rows)
+                older = chat_messages.before(anchor_id, HISTORY_PAGE_SIZE)
+            older = await load_records(older)
+        finally:
+            conversation["loading_history"] = False
+        if not older or conversation_id != conversation["id"] or anchor_id != next(iter(rendered), None):
+            return
+        for record in reversed(older):
+            rendered[record.id] = render_record(record)
+            rendered.move_to_end(record.id, last=False)
+        chat.controls[0:0] = [rendered[record.id] for record in older]
+        trim_window(keep="start")
+        ui_updates.mark(chat)
+        ui_updates.flush()  # scroll_to يحتاج الرسائل الجديدة عند العميل
+        # إبقاء الرسالة التي كان المستخدم يقرأها في مكانها
+        chat.scroll_to(key=str(anchor_id))
 
+    async def load_newer():
+        """تحميل صفحة من الرسائل الأحدث أسفل النافذة"""
+        if not rendered or conversation["loading_history"]:
+            return
+        anchor_id = next(reversed(rendered))
+        conversation["loading_history"] = True
         try:
-            # إرسال السؤال للخادم
-            response = requests.post(
-                "http://127.0.0.1:8000/ask", 
-                json={"question": question},
-                timeout=60
+            newer = await load_records(chat_messages.after(anchor_id, HISTORY_PAGE_SIZE))
+        finally:
+            conversation["loading_history"] = False
+        if not newer or anchor_id != next(reversed(rendered), None):
+            return  # تغيرت النافذة أثناء القراءة
+        for record in newer:
+            control = rendered[record.id] = render_record(record)
+            chat.controls.append(control)
+        trim_window(keep="end")
+        ui_updates.mark(chat)
+
+    async def on_chat_scroll(e: ft.OnScrollEvent):
+        """تحريك النافذة عند الاقتراب من أطراف القائمة"""
+        at_bottom = e.pixels >= e.max_scroll_extent - SCROLL_EDGE
+        if e.pixels <= e.min_scroll_extent + SCROLL_EDGE:
+            await load_older()
+        elif at_bottom:
+            await load_newer()
+        # المتابعة التلقائية لآخر رسالة فقط عندما تكون النافذة في نهاية المحادثة
+        follow = at_bottom and next(reversed(rendered), None) == chat_messages.last_id
+        if chat.auto_scroll != follow:
+            chat.auto_scroll = follow
+            ui_updates.mark(chat)
+
+    def ensure_conversation(title):
+        """إنشاء المحادثة الحالية في قاعدة البيانات عند أول سؤال"""
+        if conversation["id"] is None:
+            conversation["id"] = new_record_id()
+            get_conversation_store().create_conversation(conversation["id"], title)
+        return conversation["id"]
+
+    def start_new_conversation():
+        """بدء محادثة جديدة فارغة برسالة الترحيب"""
+        chat.controls.clear()
+        chat_messages.clear()
+        rendered.clear()
+        conversation.update(id=None, has_more=False)
+        add_welcome_message()
+
+    async def open_conversation(conversation_id):
+        """استئناف محادثة محفوظة بتحميل آخر صفحة منها فقط"""
+        store = get_conversation_store()
+        await asyncio.to_thread(store.flush)
+        rows = await asyncio.to_thread(store.load_recent, conversation_id, HISTORY_WINDOW_SIZE)
+        chat.controls.clear()
+        chat_messages.clear()
+        rendered.clear()
+        conversation.update(id=conversation_id, has_more=len(rows) == HISTORY_WINDOW_SIZE)
+        if rows:
+            chat_messages.prepend_many(rows)
+            show_latest()
+        else:
+            add_welcome_message()
+        ui_updates.mark(chat)
+
+    async def restore_latest_conversation():
+        """استعادة آخر محادثة بعد رسم الواجهة حتى يفتح التطبيق فوراً"""
+        store = await asyncio.to_thread(get_conversation_store)
+        conversation_id = await asyncio.to_thread(store.latest_conversation_id)
+        # لا نستبدل محادثة بدأها المستخدم قبل انتهاء الاستعادة
+        if conversation_id is not None and conversation["id"] is None and len(chat_messages) <= 1:
+            await open_conversation(conversation_id)
+
+    async def resume_conversation(conversation_id, dialog, e=None):
+        page.close(dialog)
+        await open_conversation(conversation_id)
+
+    async def delete_conversation(conversation_id, dialog, e=None):
+        get_conversation_store().delete_conversation(conversation_id)
+        if conversation_id == conversation["id"]:
+            start_new_conversation()
+            ui_updates.mark(chat)
+        page.close(dialog)
+        await show_conversations()
+
+    async def new_conversation(dialog, e=None):
+        page.close(dialog)
+        start_new_conversation()
+        ui_updates.mark(chat)
+
+    async def show_conversations(e=None):
+        """عرض المحادثات المحفوظة مع إمكانية الاستئناف أو الحذف"""
+        store = get_conversation_store()
+        await asyncio.to_thread(store.flush)
+        rows = await asyncio.to_thread(store.list_conversations)
+        dialog = ft.AlertDialog(
+            title=ft.Text(
+                "Conversations",
+                size=18,
+                weight=ft.FontWeight.BOLD,
+                color=Colors.TEXT_PRIMARY
+            ),
+            actions_alignment=ft.MainAxisAlignment.END,
+        )
+        items = [
+            ft.ListTile(
+                title=ft.Text(title, color=Colors.TEXT_PRIMARY, max_lines=1),
+                subtitle=ft.Text(
+                    f"{datetime.fromtimestamp(updated_at):%Y-%m-%d %H:%M} · {count} messages",
+                    size=12,
+                    color=Colors.TEXT_SECONDARY
+                ),
+                selected=conversation_id == conversation["id"],
+                on_click=functools.partial(resume_conversation, conversation_id, dialog),
+                trailing=ft.IconButton(
+                    Icons.DELETE_OUTLINE_ROUNDED,
+                    icon_color=Colors.TEXT_LIGHT,
+                    tooltip="حذف المحادثة",
+                    on_click=functools.partial(delete_conversation, conversation_id, dialog),
+                ),
+            )
+            for conversation_id, title, updated_at, count in rows
+        ]
+        dialog.content = ft.Container(
+            content=ft.ListView(items, spacing=4) if items else ft.Text(
+                "No saved conversations yet", color=Colors.TEXT_SECONDARY
+            ),
+            width=420,
+            height=360,
+        )
+        dialog.actions = [
+            ft.TextButton(
+                "New chat",
+                on_click=functools.partial(new_conversation, dialog),
+                style=ft.ButtonStyle(color=Colors.PRIMARY_LIGHT)
+            ),
+            ft.TextButton(
+                "Close",
+                on_click=lambda e: page.close(dialog),
+                style=ft.ButtonStyle(color=Colors.TEXT_SECONDARY)
+            ),
+        ]
+        page.open(dialog)
+
+    ui_state = {"debug": DEBUG_TRACES}
+
+    async def toggle_debug(e):
+        """إظهار أو إخفاء أزمنة مراحل الطلب تحت الإجابات"""
+        ui_state["debug"] = not ui_state["debug"]
+        debug_btn = header.content.controls[1].controls[0]
+        debug_btn.content.color = Colors.PRIMARY_LIGHT if ui_state["debug"] else Colors.TEXT_SECONDARY
+        ui_updates.mark(debug_btn)
+        for message_id in list(rendered):
+            record = chat_messages.get(message_id)
+            if record is not None and record.trace:
+                ui_updates.mark(rerender_record(record))
+        show_snackbar(
+            "Debug timings on" if ui_state["debug"] else "Debug timings off",
+            Colors.PRIMARY
+        )
+
+    pending_requests = {}  # record.id -> مهمة الطلب الجارية
+    discarded_answers = set()  # إجابات محذوفة لا تُحفظ عند توقفها
+    backend_client = None  # جلسة keep-alive مشتركة مع الخادم الخلفي
+    remote_conversations = {}  # conversation_id المحلي -> رمز المحادثة لدى الخادم (وضع HTTP)
+
+    def get_backend_client():
+        """إرجاع جلسة الاتصال المشتركة بالخادم الخلفي"""
+        nonlocal backend_client
+        if backend_client is None:
+            backend_client = httpx.AsyncClient(
+                base_url=BACKEND_URL,
+                timeout=httpx.Timeout(60, connect=5),
             )
-            
-            if response.status_code == 200:
-                result = response.json()
-                answer = result.get("answer", "عذراً، لم أتمكن من معالجة سؤالك.")
+        return backend_client
+
+    async def close_backend_client():
+        """إغلاق جلسة الاتصال عند إغلاق الصفحة"""
+        nonlocal backend_client
+        if backend_client is not None:
+            client, backend_client = backend_client, None
+            await client.aclose()
+
+    async def wait_for_backend():
+        """انتظار جاهزية الخادم: حدث من خيط الخادم المحلي أو فحص /healthz لخادم خارجي"""
+        deadline = time.monotonic() + BACKEND_READY_TIMEOUT
+        while not backend_ready.is_set():
+            try:
+                response = await get_backend_client().get("/healthz", timeout=1)
+                if response.status_code == 200:
+                    backend_ready.set()
+                    break
+            except httpx.TransportError:
+                pass
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    def cancel_question(message_id, discard=False):
+        """إيقاف سؤال جارٍ (مع عدم حفظ إجابته إن كانت محذوفة)"""
+        future = pending_requests.get(message_id)
+        if future is not None:
+            if discard:
+                discarded_answers.add(message_id)
+            future.cancel()
+
+    async def direct_events(question, conversation_id, question_id, trace, debug):
+        """الوضع المدمج: استدعاء طبقة الخدمة مباشرة على حلقة أحداث الواجهة بدون HTTP أو JSON"""
+        service_trace = Trace(trace.request_id)
+        token = current_trace.set(service_trace)
+        try:
+            async for event in answer_events(question, conversation_id, question_id, debug):
+                yield event
+        finally:
+            current_trace.reset(token)
+            finish_trace(service_trace, root_name="answer_events")
+
+    async def http_events(question, conversation_id, question_id, trace, debug):
+        """وضع HTTP: بث NDJSON من الخادم المحلي أو البعيد
+
+        الخادم يحفظ أدوار محادثته بنفسه ويعيد رمزها، فيُرسل الرمز مع الأسئلة التالية لنفس المحادثة.
+        """
+        if not backend_ready.is_set():
+            wait_started = time.perf_counter()
+            ready = await wait_for_backend()
+            trace.add("ui_wait_backend", wait_started)
+            if not ready:
+                raise httpx.ConnectTimeout("backend not ready")
+        headers = {TRACE_HEADER: trace.request_id}
+        if debug:
+            headers[TRACE_DEBUG_HEADER] = "1"
+        async with get_backend_client().stream(
+            "POST", "/ask/stream", json={
+                "question": question,
+                "conversation": remote_conversations.get(conversation_id),
+                "start_conversation": True,  # يُتجاهل عند إرسال رمز
+            }, headers=headers
+        ) as response:
+            if response.status_code != 200:
+                yield {"error": f"عذراً، حدث خطأ في الخادم: {response.status_code}"}
+                return
+            async for line in response.aiter_lines():
+                if line:
+                    event = json.loads(line)
+                    if event.get("conversation"):
+                        remote_conversations[conversation_id] = event["conversation"]
+                    yield event
+
+    async def stream_answer(record, question, conversation_id, question_id, trace):
+        """جلب الإجابة في الخلفية وإلحاق أجزائها بسجل الرسالة دون تجميد الواجهة"""
+        answer = ""
+        last_flush = 0.0
+        server_spans = []
+        started = time.perf_counter()
+        trace.add("ui_dispatch", trace.start, started)
+
+        def show_answer():
+            """تحديث فقاعة الإجابة إن كانت ظاهرة في النافذة"""
+            record.text = answer
+            control = rendered.get(record.id)
+            if control is None:
+                return  # خارج النافذة؛ ستُبنى من السجل عند الرجوع إليها
+            if control.data.get("loading"):
+                ui_updates.mark(rerender_record(record))  # استبدال مؤشر التحميل: هذه الفقاعة فقط
+            else:
+                text = get_ai_text(control)
+                update_markdown_text(text, answer, record.id, get_font_size())
+                ui_updates.mark(text)
+
+        def finish():
+            """عرض النص النهائي وإزالة زر الإيقاف وحفظ الإجابة"""
+            trace.add("ui_total", trace.start)
+            finish_trace(trace, service="crhodis-ui", root_name="ask")
+            record.trace = format_trace(trace.request_id, server_spans + trace.summary())
+            record.text = answer
+            record.pending = False
+            # حتى لو تغيرت المحادثة المعروضة تُحفظ الإجابة في محادثتها الأصلية
+            if record.id in discarded_answers:
+                discarded_answers.discard(record.id)
             else:
-                answer = f"عذراً، حدث خطأ في الخادم: {response.status_code}"
-                
-        except requests.exceptions.Timeout:
+                get_conversation_store().save_message(conversation_id, record)
+            control = rerender_record(record)
+            if control is not None:
+                ui_updates.mark(control)
+
+        try:
+            # بث الإجابة وإلحاق كل جزء بالفقاعة فور وصوله
+            events = direct_events if TRANSPORT == "inprocess" else http_events
+            async for event in events(question, conversation_id, question_id, trace, ui_state["debug"]):
+                if "delta" in event:
+                    first = not answer
+                    if first:
+                        trace.add("ui_first_delta", started)
+                    answer += event["delta"]
+                    now = time.monotonic()
+                    if first or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                        show_answer()
+                        last_flush = now
+                elif "error" in event:
+                    answer = f"{answer}\n\n{event['error']}" if answer else event["error"]
+                elif "trace" in event:
+                    server_spans = event["trace"]["spans"]
+            if not answer:
+                answer = "عذراً، لم أتمكن من معالجة سؤالك."
+
+        except asyncio.CancelledError:
+            answer = f"{answer}\n\n⏹️ تم إيقاف الإجابة." if answer else "⏹️ تم إيقاف الإجابة."
+            finish()
+            raise
+        except httpx.TimeoutException:
             answer = "عذراً، انتهت مهلة الاستجابة. يرجى المحاولة مرة أخرى."
         except Exception as err:
             answer = f"عذراً، حدث خطأ في الاتصال: {err}"
 
-        # إزالة مؤشر التحميل
-        if loading_message in chat.controls:
-            chat.controls.remove(loading_message)
-        
-        # إضافة رسالة الذكاء الاصطناعي
-        ai_message = create_ai_message(answer)
-        chat.controls.append(ai_message)
-        chat_messages.append({"type": "ai", "content": answer, "container": ai_message})
-        
-        page.update()
+        finish()
+
+    async def send_question(e):
+        """إرسال السؤال وتشغيل طلب الإجابة في الخلفية"""
+        question = user_input.value.strip()
+        if not question:
+            return
+
+        # إضافة رسالة المستخدم ومؤشر التحميل (سجل إجابة قيد الجلب)
+        conversation_id = ensure_conversation(question)
+        trace = Trace()  # يبدأ قياس الطلب من لحظة الإرسال
+        question_record = add_record("user", question)
+        get_conversation_store().save_message(conversation_id, question_record)
+        record = add_record("ai", "", pending=True)
+
+        user_input.value = ""
+        user_input.focus()
+        ui_updates.mark(chat, user_input)
+
+        # يمكن إرسال أسئلة أخرى بينما تُجلب هذه الإجابة
+        future = page.run_task(stream_answer, record, question, conversation_id, question_record.id, trace)
+        pending_requests[record.id] = future
+        future.add_done_callback(lambda f: pending_requests.pop(record.id, None))
 
     # زر الإرسال المحسن
     send_btn = ft.Container(
@@ -683,10 +3834,15 @@ def main(page: ft.Page):
     )
 
     # الهيدر المحسن والمتجاوب
-    def create_header():
-        icon_size = get_icon_size()
+    def get_header_sizes():
+        """أحجام عنوان الهيدر والعنوان الفرعي بناءً على حجم الشاشة"""
         title_size = 22 if page.width < 600 else 24 if page.width < 900 else 26
         subtitle_size = 13 if page.width < 600 else 14 if page.width < 900 else 15
+        return title_size, subtitle_size
+
+    def create_header():
+        icon_size = get_icon_size()
+        title_size, subtitle_size = get_header_sizes()
         
         return ft.Container(
             content=ft.Row([
@@ -725,21 +3881,53 @@ def main(page: ft.Page):
                         )
                     ], spacing=2)
                 ], spacing=16),
-                ft.Container(
-                    content=ft.Icon(
-                        Icons.CLEAR_ALL_ROUNDED,
-                        size=icon_size,
-                        color=Colors.TEXT_SECONDARY
+                ft.Row([
+                    ft.Container(
+                        content=ft.Icon(
+                            Icons.BUG_REPORT_OUTLINED,
+                            size=icon_size,
+                            color=Colors.PRIMARY_LIGHT if ui_state["debug"] else Colors.TEXT_SECONDARY
+                        ),
+                        width=44,
+                        height=44,
+                        border_radius=22,
+                        bgcolor="transparent",
+                        on_click=toggle_debug,
+                        tooltip="Debug timings",
+                        ink=True,
+                        animate_scale=an(150, ft.AnimationCurve.EASE_IN_OUT)
                     ),
-                    width=44,
-                    height=44,
-                    border_radius=22,
-                    bgcolor="transparent",
-                    on_click=lambda e: clear_all_chat(),
-                    tooltip="Delete chat",
-                    ink=True,
-                    animate_scale=an(150, ft.AnimationCurve.EASE_IN_OUT)
-                )
+                    ft.Container(
+                        content=ft.Icon(
+                            Icons.HISTORY_ROUNDED,
+                            size=icon_size,
+                            color=Colors.TEXT_SECONDARY
+                        ),
+                        width=44,
+                        height=44,
+                        border_radius=22,
+                        bgcolor="transparent",
+                        on_click=show_conversations,
+                        tooltip="Conversations",
+                        ink=True,
+                        animate_scale=an(150, ft.AnimationCurve.EASE_IN_OUT)
+                    ),
+                    ft.Container(
+                        content=ft.Icon(
+                            Icons.CLEAR_ALL_ROUNDED,
+                            size=icon_size,
+                            color=Colors.TEXT_SECONDARY
+                        ),
+                        width=44,
+                        height=44,
+                        border_radius=22,
+                        bgcolor="transparent",
+                        on_click=lambda e: clear_all_chat(),
+                        tooltip="Delete chat",
+                        ink=True,
+                        animate_scale=an(150, ft.AnimationCurve.EASE_IN_OUT)
+                    )
+                ], spacing=4)
             ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN, 
                vertical_alignment=ft.CrossAxisAlignment.CENTER),
             padding=ft.padding.symmetric(horizontal=24, vertical=20),
@@ -756,6 +3944,18 @@ def main(page: ft.Page):
     # إنشاء الهيدر الثابت
     header = create_header()
 
+    def apply_header_layout():
+        """تحديث أحجام عناصر الهيدر في مكانها"""
+        icon_size = get_icon_size()
+        title_size, subtitle_size = get_header_sizes()
+        brand, buttons = header.content.controls
+        avatar, titles = brand.controls
+        avatar.content.size = icon_size + 4
+        titles.controls[0].size = title_size
+        titles.controls[1].size = subtitle_size
+        for button in buttons.controls:
+            button.content.size = icon_size
+
     # رسالة الترحيب المحسنة
     def add_welcome_message():
         welcome_text = """Welcome Back, I am Chrodis 👋
@@ -772,37 +3972,39 @@ How I Can Help 🩺
 
 How can I help you today ?"""
 
-        welcome_message = create_ai_message(welcome_text)
-        chat.controls.append(welcome_message)
-        chat_messages.append({"type": "ai", "content": welcome_text, "container": welcome_message})
+        add_record("welcome", welcome_text)
 
     # بناء التطبيق مع Stack لجعل الهيدر والفوتر ثابتين
+    layout_state = {"generation": 0, "breakpoint": get_breakpoint(), "bubble_width": get_bubble_width()}
+
     def update_layout(e=None):
-        """تحديث التخطيط عند تغيير حجم النافذة"""
-        # تحديث الهيدر
-        header.content = create_header().content
-        
-        # تحديث جميع الرسائل
-        for i, control in enumerate(chat.controls):
-            if hasattr(control, 'content') and hasattr(control.content, 'controls'):
-                # التحقق من نوع الرسالة وتحديثها
-                if len(chat_messages) > i:
-                    msg_type = chat_messages[i]["type"]
-                    msg_content = chat_messages[i]["content"]
-                    
-                    if msg_type == "user":
-                        new_msg = create_user_message(msg_content)
-                    else:
-                        new_msg = create_ai_message(msg_content)
-                    
-                    # الحفاظ على مرجع الحاوية الأصلي
-                    chat_messages[i]["container"] = new_msg
-                    chat.controls[i] = new_msg
-        
-        page.update()
+        """جدولة تحديث التخطيط بعد توقف أحداث تغيير حجم النافذة"""
+        layout_state["generation"] += 1
+        page.run_task(apply_layout, layout_state["generation"])
+
+    async def apply_layout(generation):
+        """تحديث خصائص العناصر الموجودة فقط عند تغير نقطة التوقف أو عرض الفقاعة"""
+        await asyncio.sleep(RESIZE_DEBOUNCE)
+        if generation != layout_state["generation"]:
+            return  # وصل حدث أحدث، سيتولى هو التحديث
+
+        current_breakpoint = get_breakpoint()
+        bubble_width = get_bubble_width()
+        if current_breakpoint == layout_state["breakpoint"] and bubble_width == layout_state["bubble_width"]:
+            return  # على الكمبيوتر والتابلت العرض ثابت داخل نفس نقطة التوقف
+        layout_state["breakpoint"] = current_breakpoint
+        layout_state["bubble_width"] = bubble_width
+
+        apply_header_layout()
+        font_size = get_font_size()
+        icon_size = get_icon_size()
+        for control in chat.controls:
+            apply_message_layout(control, bubble_width, font_size, icon_size)
+        ui_updates.mark(header, chat)
 
     # إضافة مستمع لتغيير حجم النافذة
     page.on_resize = update_layout
+    chat.on_scroll = on_chat_scroll
 
     # إنشاء منطقة المحادثة مع padding للهيدر والفوتر
     chat_area = ft.Container(
@@ -843,25 +4045,67 @@ How can I help you today ?"""
     add_welcome_message()
 
     # معالج Enter للإرسال
-    def on_keyboard(e: ft.KeyboardEvent):
+    async def on_keyboard(e: ft.KeyboardEvent):
         if e.key == "Enter" and not e.shift:
-            send_question(e)
+            await send_question(e)
 
     page.on_keyboard_event = on_keyboard
+    def on_close(e):
+        page.run_task(close_backend_client)
+        page.run_task(close_http_client)
+        get_conversation_store().flush(timeout=2)
+
+    page.on_close = on_close
     page.update()
 
+    # استعادة آخر محادثة محفوظة في الخلفية
+    page.run_task(restore_latest_conversation)
+
 def run():
-    import threading, time
-    import flet as ft
+    # خادم HTTP فقط عند الحاجة إليه؛ الواجهة تفتح فوراً وأول سؤال عبر HTTP ينتظر جاهزيته
+    if SERVE_HTTP or (TRANSPORT == "http" and "CRHODIS_BACKEND_URL" not in os.environ):
+        backend_thread = threading.Thread(target=run_backend, daemon=True)
+        backend_thread.start()
 
-    # تشغيل الخادم الخلفي
-    backend_thread = threading.Thread(target=run_backend, daemon=True)
-    backend_thread.start()
-    
-    # انتظار تشغيل الخادم
-    time.sleep(2)
-    
     # تشغيل الواجهة
+    import_flet()
     ft.app(target=main)
 
-run()
+# ================ Headless Server ================
+def serve(argv=None):
+    """تشغيل الخادم بدون واجهة Flet، بعدة عمليات تتقاسم حدود المعدل والذاكرة المؤقتة والمقاييس"""
+    parser = argparse.ArgumentParser(prog="main.py serve", description="Crhodis API server without the Flet UI")
+    parser.add_argument("--host", default=os.environ.get("CRHODIS_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("CRHODIS_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("CRHODIS_WORKERS", "1")))
+    parser.add_argument("--drain-timeout", type=float, default=DRAIN_TIMEOUT,
+                        help="seconds to wait for in-flight requests on shutdown")
+    parser.add_argument("--log-level", default=os.environ.get("CRHODIS_LOG_LEVEL", "info"))
+    args = parser.parse_args(argv)
+
+    # العمليات الفرعية تقرأ إعداداتها من البيئة عند استيراد الملف
+    os.environ["CRHODIS_DRAIN_TIMEOUT"] = str(args.drain_timeout)
+    if args.workers > 1:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        os.environ.setdefault("CRHODIS_RATE_LIMIT_BACKEND", "sqlite")
+        os.environ.setdefault("CRHODIS_CACHE_DB", os.path.join(DATA_DIR, "cache.db"))
+        os.environ.setdefault("CRHODIS_METRICS_DB", os.path.join(DATA_DIR, "metrics.db"))
+    if os.environ.get("CRHODIS_METRICS_DB"):
+        SharedMetricsStore(os.environ["CRHODIS_METRICS_DB"]).reset()
+
+    import uvicorn
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        timeout_graceful_shutdown=args.drain_timeout,
+        log_level=args.log_level,
+    )
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["serve"]:
+        serve(sys.argv[2:])
+    else:
+        run()
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# main يقرأ الإعدادات عند الاستيراد، لذا تُضبط قبل أي اختبار
+os.environ.setdefault("CRHODIS_DATA_DIR", tempfile.mkdtemp(prefix="crhodis-test-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
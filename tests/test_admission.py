@@ -0,0 +1,129 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+pytest.importorskip("fastapi")
+
+
+def post(path, body, headers=None):
+    async def send():
+        transport = httpx.ASGITransport(app=main.get_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post(path, json=body, headers=headers)
+
+    return asyncio.run(send())
+
+
+@pytest.fixture
+def answers(monkeypatch):
+    """النموذج يجيب فوراً بنص السؤال، مع تسجيل الأسئلة التي وصلته"""
+    asked = []
+
+    async def ask(question, *args, **kwargs):
+        asked.append(question)
+        return f"answer: {question}"
+
+    monkeypatch.setattr(main, "ask_ai_model", ask)
+    return asked
+
+
+@pytest.fixture
+def rate_limit(monkeypatch):
+    """ثلاثة طلبات لكل عميل دون إعادة تعبئة تُذكر أثناء الاختبار"""
+    limiter = main.RateLimiter(per_minute=0.001, burst=3, store=main.MemoryBucketStore())
+    monkeypatch.setattr(main, "rate_limiter", limiter)
+    return limiter
+
+
+def test_batch_charges_one_token_per_question(answers, rate_limit):
+    resp = post("/ask/batch", {"questions": [f"q{i}" for i in range(5)]})
+    assert resp.status_code == 200
+    results = resp.json()["results"]
+    assert [r["status"] for r in results] == ["ok", "ok", "ok", "error", "error"]
+    assert results[3]["error"] == "Rate limit exceeded"
+    assert answers == ["q0", "q1", "q2"]
+    assert rate_limit.limited == 2
+
+    # الرصيد نفد: دفعة كاملة لا تمر بعد انتظار توكن واحد
+    resp = post("/ask/batch", {"questions": ["q5", "q6"]})
+    assert resp.status_code == 429
+    assert "retry-after" in resp.headers
+    assert post("/ask", {"question": "q7"}).status_code == 429
+    assert answers == ["q0", "q1", "q2"]
+
+
+def test_batch_stream_reports_limited_questions(answers, rate_limit):
+    resp = post("/ask/batch/stream", {"questions": ["a", "b", "c", "d"]})
+    assert resp.status_code == 200
+    lines = [main.json_loads(line) for line in resp.text.splitlines()]
+    assert [line.get("status") for line in lines[:-1]] == ["ok", "ok", "ok", "error"]
+    assert lines[-1] == {"done": True}
+
+
+def test_batch_over_the_limit_is_rejected(answers, monkeypatch):
+    monkeypatch.setattr(main, "BATCH_MAX_QUESTIONS", 2)
+    resp = post("/ask/batch", {"questions": ["a", "b", "c"]})
+    assert resp.status_code == 413
+    assert answers == []
+
+
+def test_busy_server_returns_503(answers, monkeypatch):
+    monkeypatch.setattr(main, "rate_limiter", main.RateLimiter(per_minute=0))
+    busy = main.AdmissionController(max_concurrency=1, max_queue=0)
+    busy.active = 1
+    monkeypatch.setattr(main, "admission", busy)
+    resp = post("/ask", {"question": "q"})
+    assert resp.status_code == 503
+    assert resp.json() == {"detail": "Server busy (queue full)"}
+    assert int(resp.headers["retry-after"]) >= 1
+    assert busy.rejected_queue_full == 1
+    assert answers == []
+
+
+def test_queued_request_gets_the_released_slot():
+    async def scenario():
+        controller = main.AdmissionController(max_concurrency=1, max_queue=1, queue_timeout=1)
+        await controller.acquire()
+        waiter = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(main.AdmissionRejected, match="queue full"):
+            await controller.acquire()
+        controller.release()
+        await waiter
+        assert controller.active == 1
+        controller.release()
+        assert controller.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_is_rejected():
+    async def scenario():
+        controller = main.AdmissionController(max_concurrency=1, max_queue=1, queue_timeout=0.01)
+        await controller.acquire()
+        with pytest.raises(main.AdmissionRejected, match="queue timeout"):
+            await controller.acquire()
+        assert controller.stats()["queued"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_identical_questions_share_one_upstream_call():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    async def scenario():
+        flights = main.SingleFlight()
+        results = await asyncio.gather(*(flights.do("same", fetch) for _ in range(5)))
+        assert results == ["answer"] * 5
+        assert flights.stats() == {"calls": 1, "coalesced": 4, "in_flight": 0}
+
+    asyncio.run(scenario())
+    assert len(calls) == 1
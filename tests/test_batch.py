@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def slow_answers(monkeypatch):
+    """نموذج بطيء قليلاً يسجل أقصى عدد أسئلة متزامنة"""
+    state = {"active": 0, "peak": 0}
+
+    async def ask(question, *args, **kwargs):
+        state["active"] += 1
+        state["peak"] = max(state["peak"], state["active"])
+        try:
+            await asyncio.sleep(0.01)
+            if question == "bad":
+                raise RuntimeError("upstream failed")
+            return f"answer: {question}"
+        finally:
+            state["active"] -= 1
+
+    monkeypatch.setattr(main, "ask_ai_model", ask)
+    monkeypatch.setattr(main, "admission", main.AdmissionController(max_concurrency=100, max_queue=100))
+    return state
+
+
+def collect(questions, **kwargs):
+    async def run():
+        return [result async for result in main.answer_batch(questions, **kwargs)]
+
+    return asyncio.run(run())
+
+
+def test_batch_respects_concurrency_and_order(slow_answers):
+    questions = [f"q{i}" for i in range(10)]
+    results = collect(questions, concurrency=3)
+    assert slow_answers["peak"] == 3
+    assert [r["index"] for r in results] == list(range(10))
+    assert results[4] == {"index": 4, "status": "ok", "answer": "answer: q4"}
+
+
+def test_batch_reports_errors_per_question(slow_answers):
+    results = collect(["a", "bad", "c"], concurrency=2, ordered=False)
+    by_index = {r["index"]: r for r in results}
+    assert by_index[1] == {"index": 1, "status": "error", "error": "upstream failed"}
+    assert by_index[0]["status"] == by_index[2]["status"] == "ok"
+
+
+def test_batch_questions_share_the_admission_limit(slow_answers, monkeypatch):
+    # كل أسئلة الدفعات معاً لا تتجاوز حد التزامن العام
+    monkeypatch.setattr(main, "admission", main.AdmissionController(max_concurrency=2, max_queue=100))
+
+    async def drain(batch):
+        return [result async for result in main.answer_batch(batch, concurrency=4)]
+
+    async def run():
+        return await asyncio.gather(*(drain([f"{b}-{i}" for i in range(4)]) for b in range(3)))
+
+    results = asyncio.run(run())
+    assert slow_answers["peak"] == 2
+    assert all(r["status"] == "ok" for batch in results for r in batch)
+
+
+def test_batch_question_rejected_when_server_busy(slow_answers, monkeypatch):
+    busy = main.AdmissionController(max_concurrency=1, max_queue=0)
+    busy.active = 1  # مكان مشغول بطلب آخر
+    monkeypatch.setattr(main, "admission", busy)
+    results = collect(["a", "b"])
+    assert [r["status"] for r in results] == ["error", "error"]
+    assert results[0]["error"] == "Server busy (queue full)"
+    assert results[0]["retry_after"] >= 1
+    assert slow_answers["peak"] == 0
@@ -0,0 +1,44 @@
+import threading
+import time
+
+import main
+
+
+def test_concurrent_history_does_not_duplicate_turns(monkeypatch):
+    store = main.get_conversation_store()
+    conversation_id = main.new_record_id()
+    store.create_conversation(conversation_id, "q0")
+    for i in range(3):
+        store.save_message(conversation_id, main.ChatRecord(main.new_record_id(), "user", f"q{i}"))
+        store.save_message(conversation_id, main.ChatRecord(main.new_record_id(), "ai", f"a{i}"))
+    store.flush()
+
+    # قراءة بطيئة حتى تتداخل الطلبات المتزامنة على نفس المحادثة
+    load_between = store.load_between
+
+    def slow_load(*args):
+        rows = load_between(*args)
+        time.sleep(0.05)
+        return rows
+
+    monkeypatch.setattr(store, "load_between", slow_load)
+    context = main.ConversationContext()
+    before_id = main.new_record_id()
+    results = []
+
+    def ask():
+        results.append(context.history(conversation_id, before_id, "next"))
+
+    threads = [threading.Thread(target=ask) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    expected = [
+        {"role": role, "content": f"{prefix}{i}"}
+        for i in range(3)
+        for role, prefix in (("user", "q"), ("assistant", "a"))
+    ]
+    assert results == [expected] * 8
+    assert context.history(conversation_id, before_id, "next") == expected
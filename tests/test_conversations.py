@@ -0,0 +1,55 @@
+import asyncio
+import sqlite3
+
+import httpx
+import pytest
+
+import main
+
+pytest.importorskip("fastapi")
+
+
+def post(path, body):
+    async def send():
+        transport = httpx.ASGITransport(app=main.get_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post(path, json=body)
+
+    return asyncio.run(send())
+
+
+def stored_messages():
+    store = main.get_conversation_store()
+    store.flush()
+    with sqlite3.connect(store.path) as db:
+        return db.execute("SELECT count(*) FROM messages").fetchone()[0]
+
+
+@pytest.fixture
+def answers(monkeypatch):
+    """النموذج يجيب بالسؤال وعدد الأدوار السابقة التي وصلته"""
+    async def ask(question, *args, history=(), **kwargs):
+        return f"{question} after {len(history)}"
+
+    monkeypatch.setattr(main, "ask_ai_model", ask)
+    monkeypatch.setattr(main, "rate_limiter", main.RateLimiter(per_minute=0))
+
+
+def test_stateless_question_is_not_stored(answers):
+    before = stored_messages()
+    resp = post("/ask", {"question": "headache?"})
+    assert resp.json() == {"answer": "headache? after 0", "conversation": None}
+    assert stored_messages() == before
+
+
+def test_started_conversation_keeps_context(answers):
+    before = stored_messages()
+    first = post("/ask", {"question": "headache?", "start_conversation": True}).json()
+    assert first["conversation"]
+    second = post("/ask", {"question": "and fever?", "conversation": first["conversation"]}).json()
+    assert second == {"answer": "and fever? after 2", "conversation": first["conversation"]}
+    assert stored_messages() == before + 4
+
+
+def test_unknown_conversation_is_rejected(answers):
+    assert post("/ask", {"question": "hi", "conversation": "not-a-token"}).status_code == 404
@@ -0,0 +1,31 @@
+import main
+
+
+def test_unmatched_marker_stays_literal():
+    assert main.parse_inline("dose is 5*2 mg") == [("dose is 5*2 mg", False, False)]
+    assert main.clean_text("dose is 5*2 mg") == "dose is 5*2 mg"
+
+
+def test_unmatched_marker_next_to_emphasis():
+    assert main.parse_inline("5*2 mg, *twice* daily") == [
+        ("5*2 mg, ", False, False),
+        ("twice", False, True),
+        (" daily", False, False),
+    ]
+    assert main.clean_text("- take **5*2 mg\n- rest") == "• take **5*2 mg\n• rest"
+
+
+def test_matched_markers_are_styled():
+    assert main.parse_inline("**bold** and *it*") == [
+        ("bold", True, False),
+        (" and ", False, False),
+        ("it", False, True),
+    ]
+    assert main.parse_inline("5 * 3") == [("5 * 3", False, False)]
+
+
+def test_streaming_line_keeps_opener_until_complete():
+    blocks, _ = main.parse_markdown("take **5", key="stream-test", final=False)
+    assert blocks[-1][2] == [("take ", False, False), ("5", True, False)]
+    blocks, _ = main.parse_markdown("take **5", key="stream-test", final=True)
+    assert blocks[-1][2] == [("take **5", False, False)]
@@ -0,0 +1,35 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+import main
+
+pytest.importorskip("fastapi")
+
+
+def get(path):
+    async def send():
+        transport = httpx.ASGITransport(app=main.get_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get(path), threading.current_thread()
+
+    return asyncio.run(send())
+
+
+def test_shared_metrics_render_off_the_event_loop(tmp_path, monkeypatch):
+    store = main.SharedMetricsStore(path=str(tmp_path / "metrics.db"))
+    threads = []
+    publish = store.publish
+
+    def record_thread(families):
+        threads.append(threading.current_thread())
+        publish(families)
+
+    monkeypatch.setattr(store, "publish", record_thread)
+    monkeypatch.setattr(main, "shared_metrics", store)
+    resp, loop_thread = get("/metrics")
+    assert resp.status_code == 200
+    assert "# TYPE crhodis_http_requests_total counter" in resp.text
+    assert threads and threads[0] is not loop_thread
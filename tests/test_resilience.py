@@ -0,0 +1,194 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    """نموذج واحد بقاطع يفتح بعد فشل واحد ويسمح بطلب تجريبي فوراً"""
+    breaker = main.CircuitBreaker(failures=1, reset_after=0)
+    monkeypatch.setattr(main, "upstream_models", ["model"])
+    monkeypatch.setattr(main, "circuit_breakers", {"model": breaker})
+    monkeypatch.setattr(main, "RETRY_ATTEMPTS", 1)
+    return breaker
+
+
+async def fail(model):
+    raise main.UpstreamError("upstream down", status=503)
+
+
+async def succeed(model):
+    return "ok"
+
+
+async def hang(model):
+    await asyncio.Event().wait()
+
+
+def test_breaker_opens_after_failures():
+    breaker = main.CircuitBreaker(failures=2, reset_after=60)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_half_open_allows_single_trial():
+    breaker = main.CircuitBreaker(failures=1, reset_after=0)
+    breaker.record_failure()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_cancelled_trial_releases_breaker(breaker):
+    async def scenario():
+        with pytest.raises(main.UpstreamError):
+            await main.call_with_fallback(fail)
+        assert breaker.state == "half_open"
+
+        trial = asyncio.ensure_future(main.call_with_fallback(hang))
+        await asyncio.sleep(0)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+        # الطلب التجريبي التالي مسموح ويحسم حالة القاطع
+        assert await main.call_with_fallback(succeed) == "ok"
+        assert breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_trial_can_reopen(breaker):
+    async def scenario():
+        with pytest.raises(main.UpstreamError):
+            await main.call_with_fallback(fail)
+        trial = asyncio.ensure_future(main.call_with_fallback(hang))
+        await asyncio.sleep(0)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+        breaker.reset_after = 60
+        breaker.opened_at -= 60
+        with pytest.raises(main.UpstreamError, match="upstream down"):
+            await main.call_with_fallback(fail)
+        assert breaker.state == "open"
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def models(monkeypatch):
+    """نموذج أساسي وبديل بقواطع جديدة وبدون انتظار بين المحاولات"""
+    monkeypatch.setattr(main, "upstream_models", ["primary", "backup"])
+    monkeypatch.setattr(main, "circuit_breakers", {"primary": main.CircuitBreaker(), "backup": main.CircuitBreaker()})
+    monkeypatch.setattr(main, "RETRY_ATTEMPTS", 3)
+    monkeypatch.setattr(main, "RETRY_BASE_DELAY", 0)
+    return main.circuit_breakers
+
+
+def test_retries_then_succeeds(models):
+    calls = []
+
+    async def flaky(model):
+        calls.append(model)
+        if len(calls) < 3:
+            raise main.UpstreamError("busy", status=503)
+        return model
+
+    assert asyncio.run(main.call_with_fallback(flaky)) == "primary"
+    assert calls == ["primary"] * 3
+    assert models["primary"].failures == 0
+
+
+def test_falls_back_after_retries(models):
+    calls = []
+
+    async def primary_down(model):
+        calls.append(model)
+        if model == "primary":
+            raise main.UpstreamError("down", status=502)
+        return model
+
+    assert asyncio.run(main.call_with_fallback(primary_down)) == "backup"
+    assert calls == ["primary"] * 3 + ["backup"]
+
+
+def test_client_errors_are_not_retried(models):
+    calls = []
+
+    async def bad_request(model):
+        calls.append(model)
+        raise main.UpstreamError("bad request", status=400)
+
+    with pytest.raises(main.UpstreamError, match="bad request"):
+        asyncio.run(main.call_with_fallback(bad_request))
+    assert calls == ["primary"]
+
+
+def test_missing_model_moves_to_fallback(models):
+    async def not_found(model):
+        if model == "primary":
+            raise main.UpstreamError("no such model", status=404)
+        return model
+
+    assert asyncio.run(main.call_with_fallback(not_found)) == "backup"
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    monkeypatch.setattr(main, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(main, "HEDGE_DELAY", 0.01)
+    monkeypatch.setattr(main, "upstream_latency", main.LatencyTracker())
+
+
+def test_slow_request_is_hedged(hedging):
+    calls = []
+
+    async def send():
+        calls.append(1)
+        if len(calls) == 1:
+            await asyncio.sleep(1)
+            return "slow"
+        return "fast"
+
+    async def scenario():
+        started = asyncio.get_running_loop().time()
+        result = await main.hedged(send)
+        return result, asyncio.get_running_loop().time() - started
+
+    result, elapsed = asyncio.run(scenario())
+    assert result == "fast"
+    assert len(calls) == 2
+    assert elapsed < 0.5
+
+
+def test_fast_request_is_not_hedged(hedging):
+    calls = []
+
+    async def send():
+        calls.append(1)
+        return "fast"
+
+    assert asyncio.run(main.hedged(send)) == "fast"
+    assert len(calls) == 1
+
+
+def test_hedge_waits_for_a_success(hedging):
+    calls = []
+
+    async def send():
+        calls.append(1)
+        if len(calls) == 1:
+            await asyncio.sleep(0.05)
+            return "first"
+        raise main.UpstreamError("hedge failed", status=503)
+
+    assert asyncio.run(main.hedged(send)) == "first"
@@ -0,0 +1,54 @@
+import asyncio
+
+import main
+
+
+def test_answers_survive_restart(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = main.ResponseCache(db_path=path)
+    cache.set("key", "answer")
+    assert asyncio.run(cache.get("key")) == "answer"
+    assert cache.flush(timeout=5)
+    cache.close()
+
+    restarted = main.ResponseCache(db_path=path)
+    assert asyncio.run(restarted.get("key")) == "answer"
+    assert asyncio.run(restarted.get("other")) is None
+    stats = restarted.stats()
+    assert (stats["hits"], stats["disk_hits"], stats["misses"]) == (1, 1, 1)
+    restarted.close()
+
+
+def test_disk_reads_run_off_the_event_loop(tmp_path, monkeypatch):
+    cache = main.ResponseCache(db_path=str(tmp_path / "cache.db"))
+    threads = []
+    read = cache._read
+
+    def record_thread(key):
+        threads.append(main.threading.current_thread())
+        return read(key)
+
+    monkeypatch.setattr(cache, "_read", record_thread)
+
+    async def lookup():
+        return await cache.get("missing"), main.threading.current_thread()
+
+    answer, loop_thread = asyncio.run(lookup())
+    assert answer is None
+    assert threads and threads[0] is not loop_thread
+    cache.close()
+
+
+def test_fallback_answers_served_only_while_primary_is_down(monkeypatch):
+    primary = main.CircuitBreaker(failures=1, reset_after=60)
+    monkeypatch.setattr(main, "upstream_models", ["primary", "backup"])
+    monkeypatch.setattr(main, "circuit_breakers", {"primary": primary, "backup": main.CircuitBreaker()})
+    monkeypatch.setattr(main, "response_cache", main.ResponseCache())
+    main.remember_answer("fallback question", "backup answer", model="backup")
+
+    assert asyncio.run(main.lookup_cached_answer("fallback question")) is None
+    primary.record_failure()
+    assert asyncio.run(main.lookup_cached_answer("fallback question")) == "backup answer"
+    primary.record_success()
+    main.remember_answer("fallback question", "primary answer", model="primary")
+    assert asyncio.run(main.lookup_cached_answer("fallback question")) == "primary answer"
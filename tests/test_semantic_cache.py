@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+import main
+
+pytest.importorskip("numpy")
+
+FINGERPRINT = main.generation_fingerprint()
+
+def cached(question):
+    cache = main.SemanticCache(capacity=8)
+    cache.add(question, FINGERPRINT, "cached answer")
+    return cache
+
+@pytest.mark.parametrize("stored, asked", [
+    ("My child has a fever, can I give aspirin?", "My child has a fever, can I give paracetamol?"),
+    ("I am pregnant, can I take ibuprofen?", "I am not pregnant, can I take ibuprofen?"),
+    ("I am not pregnant, can I take ibuprofen?", "I am pregnant, can I take ibuprofen?"),
+    ("type 1 diabetes diet", "type 2 diabetes diet"),
+    ("هل يمكن أخذ الأسبرين للحامل؟", "هل يمكن أخذ الباراسيتامول للحامل؟"),
+    ("أنا حامل، هل الإيبوبروفين آمن؟", "أنا لست حامل، هل الإيبوبروفين آمن؟"),
+    ("can I take ibuprofen", "can I take ibuprofen while pregnant"),
+    ("how to take ibuprofen", "can I take ibuprofen"),
+])
+def test_answer_changing_edits_miss(stored, asked):
+    assert cached(stored).lookup(asked, FINGERPRINT) is None
+
+@pytest.mark.parametrize("stored, asked", [
+    ("symptoms of diabetes", "what are the symptoms of diabetes?"),
+    ("Symptoms of  Diabetes!", "symptoms of diabetes"),
+    ("ما أعراض السكري؟", "ما هي اعراض السكري"),
+    ("What are the common symptoms of diabetes?", "Which symptoms of diabetes are common?"),
+    ("How is diabetes treated?", "diabetes treatment"),
+    ("Is ibuprofen safe during pregnancy?", "is ibuprofen safe while pregnant"),
+])
+def test_paraphrases_hit(stored, asked):
+    assert cached(stored).lookup(asked, FINGERPRINT) == "cached answer"
+
+@pytest.mark.skipif("CRHODIS_SEMANTIC_CACHE" in os.environ, reason="overridden by the environment")
+def test_disabled_by_default():
+    assert not main.SEMANTIC_CACHE_ENABLED
+    assert main.semantic_cache is None
@@ -0,0 +1,18 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_backend_does_not_import_flet():
+    # عملية جديدة حتى لا يتأثر الاختبار بوحدات استوردتها اختبارات أخرى
+    code = "import sys, main; main.get_app(); print('flet' in sys.modules)"
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True, env=os.environ.copy()
+    )
+    assert result.stdout.strip() == "False"